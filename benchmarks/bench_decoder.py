@@ -0,0 +1,126 @@
+#! coding: utf-8
+"""
+Tracker reply decoding benchmark.
+
+Compares the old parse_qs based decoding plus ``'key_%d' % x`` lookups
+against the one pass Records decoder, on a 1000 key ``list_keys`` reply
+and a 10k row ``get_devices`` reply.
+
+    python benchmarks/bench_decoder.py [--repeat N] [--json FILE]
+"""
+import os
+import sys
+import json
+import time
+import urllib
+from cgi import parse_qs
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pymogile.backend import OK_RE, Records    # noqa
+
+
+def old_decode(line):
+    params = {}
+    for k, values in parse_qs(OK_RE.match(line).group(1)).items():
+        params[k] = values[0]
+    return params
+
+
+def list_keys_reply(count):
+    args = {'key_count': count, 'next_after': 'key/%08d' % count}
+    for x in xrange(1, count + 1):
+        args['key_%d' % x] = 'some/prefix/key/%08d.jpg' % x
+    return 'OK %s\r\n' % urllib.urlencode(args)
+
+
+def get_devices_reply(count):
+    args = {'devices': count}
+    for x in xrange(1, count + 1):
+        args['dev%d_devid' % x] = x
+        args['dev%d_hostid' % x] = x % 100
+        args['dev%d_status' % x] = 'alive'
+        args['dev%d_observed_state' % x] = 'writeable'
+        args['dev%d_utilization' % x] = '12.5'
+        args['dev%d_mb_total' % x] = 1907729
+        args['dev%d_mb_used' % x] = 1034567
+        args['dev%d_weight' % x] = 100
+    return 'OK %s\r\n' % urllib.urlencode(args)
+
+
+def old_list_keys(line):
+    res = old_decode(line)
+    return [res['key_%d' % x] for x in xrange(1, int(res['key_count']) + 1)]
+
+
+def new_list_keys(line):
+    res = Records(OK_RE.match(line).group(1))
+    return res.list('key', res['key_count'])
+
+
+DEVICE_FIELDS = (
+    'devid', 'hostid', 'status', 'observed_state', 'utilization', 'mb_total',
+    'mb_used', 'weight'
+)
+
+
+def old_get_devices(line):
+    res = old_decode(line)
+    return [
+        dict((k, res.get('dev%d_%s' % (x, k))) for k in DEVICE_FIELDS)
+        for x in xrange(1, int(res['devices']) + 1)
+    ]
+
+
+def new_get_devices(line):
+    res = Records(OK_RE.match(line).group(1))
+    return res.rows('dev', res['devices'])
+
+
+def timeit(func, arg, repeat):
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        func(arg)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-r', '--repeat', type='int', default=20)
+    parser.add_option('-j', '--json', help='write results to this file')
+    options, _ = parser.parse_args(argv)
+
+    cases = [
+        ('list_keys x1000', list_keys_reply(1000), old_list_keys,
+         new_list_keys),
+        ('get_devices x10000', get_devices_reply(10000), old_get_devices,
+         new_get_devices),
+    ]
+
+    results = {}
+    for name, line, old, new in cases:
+        assert len(old(line)) == len(new(line))
+        t_old = timeit(old, line, options.repeat)
+        t_new = timeit(new, line, options.repeat)
+        results[name] = {
+            'bytes': len(line),
+            'old_ms': t_old * 1000,
+            'new_ms': t_new * 1000,
+            'speedup': t_old / t_new,
+        }
+        print '%-20s %9d bytes  old %8.2f ms  new %8.2f ms  x%.2f' % (
+            name, len(line), t_old * 1000, t_new * 1000, t_old / t_new
+        )
+
+    if options.json:
+        with open(options.json, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+#! coding: utf-8
+"""
+Storage transfer benchmark.
+
+Measures MB/s and peak RSS of store_content, store_file, NormalHTTPFile
+and LargeHTTPFile writes, LargeHTTPFile reads and get_file_data for each
+object size, against an emulated cluster on loopback (see
+pymogile.emulator), or against real trackers given with ``--trackers``.
+
+Every case runs in a forked child so its peak RSS is not hidden by an
+earlier, larger case.  ``rss_delta_mb`` is the growth over the RSS of the
+child before the case ran; for store_content it includes the content.
+
+    python benchmarks/bench_storage.py [--sizes 1K,64K,1M,16M,64M,1G]
+        [--repeat N] [--chunk 64K] [--json FILE]
+
+The emulator keeps files in memory, so sizes up to 1G need a few GB of
+free RAM.
+"""
+import os
+import json
+import time
+import resource
+import tempfile
+from optparse import OptionParser
+
+from util import EmulatorProcess, parse_size, format_size, write_results
+
+from pymogile import Client    # noqa
+
+DOMAIN = 'bench'
+SIZES = '1K,64K,1M,16M,64M'
+
+
+def max_rss():
+    """Peak RSS of this process in bytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def write_chunks(fp, size, chunk):
+    block = 'x' * min(size, chunk)
+    left = size
+    while left > 0:
+        fp.write(block[:left])
+        left -= len(block)
+
+
+def make_file(size, chunk):
+    fp = tempfile.TemporaryFile()
+    write_chunks(fp, size, chunk)
+    fp.seek(0)
+    return fp
+
+
+def store_content(client, key, size, chunk):
+    content = 'x' * size
+    start = time.time()
+    client.store_content(key, content)
+    return time.time() - start
+
+
+def store_file(client, key, size, chunk):
+    fp = make_file(size, chunk)
+    start = time.time()
+    client.store_file(key, fp, chunk_size=chunk)
+    return time.time() - start
+
+
+def new_file(client, key, size, chunk, largefile=False):
+    start = time.time()
+    fp = client.new_file(key, largefile=largefile)
+    write_chunks(fp, size, chunk)
+    fp.close()
+    return time.time() - start
+
+
+def normal_write(client, key, size, chunk):
+    return new_file(client, key, size, chunk)
+
+
+def large_write(client, key, size, chunk):
+    return new_file(client, key, size, chunk, largefile=True)
+
+
+def large_read(client, key, size, chunk):
+    start = time.time()
+    fp = client.read_file(key)
+    # ranged reads of LargeHTTPFile are not usable, read it whole
+    assert len(fp.read()) == size
+    fp.close()
+    return time.time() - start
+
+
+def get_file_data(client, key, size, chunk):
+    start = time.time()
+    assert len(client.get_file_data(key, timeout=60)) == size
+    return time.time() - start
+
+
+CASES = [
+    ('store_content', store_content),
+    ('store_file', store_file),
+    ('NormalHTTPFile.write', normal_write),
+    ('LargeHTTPFile.write', large_write),
+    ('LargeHTTPFile.read', large_read),
+    ('get_file_data', get_file_data),
+]
+
+
+def run_case(trackers, domain, func, key, size, chunk, repeat):
+    """
+    Runs ``func`` ``repeat`` times in a child process and returns the best
+    time and the peak RSS of the child.
+    """
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        status = 1
+        try:
+            client = Client(domain, trackers, http_timeout=60)
+            baseline = max_rss()
+            best = min(
+                func(client, key, size, chunk) for _ in xrange(repeat)
+            )
+            os.write(wfd, json.dumps([best, baseline, max_rss()]))
+            status = 0
+        finally:
+            os._exit(status)
+
+    os.close(wfd)
+    data = ''
+    while True:
+        buf = os.read(rfd, 4096)
+        if not buf:
+            break
+        data += buf
+    os.close(rfd)
+    _, status = os.waitpid(pid, 0)
+    if status:
+        raise RuntimeError('benchmark child failed')
+    return json.loads(data)
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option(
+        '-s', '--sizes', default=SIZES,
+        help='comma separated object sizes [%default]'
+    )
+    parser.add_option('-r', '--repeat', type='int', default=3)
+    parser.add_option(
+        '-c', '--chunk', default='64K', help='write size [%default]'
+    )
+    parser.add_option(
+        '--trackers', help='comma separated trackers instead of the emulator'
+    )
+    parser.add_option(
+        '--domain', default=DOMAIN, help='domain on --trackers'
+    )
+    parser.add_option('-j', '--json', help='write results to this file')
+    options, _ = parser.parse_args(argv)
+
+    sizes = [parse_size(s) for s in options.sizes.split(',')]
+    chunk = parse_size(options.chunk)
+
+    emulator = None
+    if options.trackers:
+        trackers = options.trackers.split(',')
+    else:
+        emulator = EmulatorProcess('--domain', options.domain)
+        trackers = emulator.trackers
+
+    results = {}
+    try:
+        for size in sizes:
+            key = 'bench/%s' % format_size(size)
+            results[format_size(size)] = by_case = {}
+            for name, func in CASES:
+                best, baseline, peak = run_case(
+                    trackers, options.domain, func, key, size, chunk,
+                    options.repeat
+                )
+                by_case[name] = res = {
+                    'bytes': size,
+                    'seconds': best,
+                    'mb_per_sec': size / best / (1 << 20),
+                    'peak_rss_mb': peak / float(1 << 20),
+                    'rss_delta_mb': (peak - baseline) / float(1 << 20),
+                }
+                print '%5s %-22s %9.2f MB/s  peak RSS %8.1f MB (+%.1f)' % (
+                    format_size(size), name, res['mb_per_sec'],
+                    res['peak_rss_mb'], res['rss_delta_mb']
+                )
+    finally:
+        if emulator:
+            emulator.stop()
+
+    if options.json:
+        write_results(options.json, 'storage', vars(options), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+#! coding: utf-8
+"""
+Tracker request benchmark.
+
+Measures ops/sec and p50/p99 latency of Backend.do_request for
+``get_paths``, ``list_keys`` and ``create_open``/``create_close`` against
+an emulated cluster on loopback (see pymogile.emulator), or against real
+trackers given with ``--trackers``.
+
+    python benchmarks/bench_tracker.py [--requests N] [--threads N]
+        [--trackers HOST:PORT,...] [--json FILE]
+"""
+import time
+import httplib
+import urlparse
+import threading
+from optparse import OptionParser
+
+from util import EmulatorProcess, latency_summary, write_results
+
+from pymogile import Client    # noqa
+from pymogile.backend import decode_records    # noqa
+
+DOMAIN = 'bench'
+
+
+def run(threads, requests, func):
+    """Calls ``func(n)`` ``requests`` times spread over ``threads``."""
+    samples = []
+    lock = threading.Lock()
+
+    def worker(offset):
+        local = []
+        for n in xrange(offset, requests, threads):
+            start = time.time()
+            func(n)
+            local.append(time.time() - start)
+        with lock:
+            samples.extend(local)
+
+    workers = [
+        threading.Thread(target=worker, args=(x, )) for x in xrange(threads)
+    ]
+    start = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return latency_summary(samples, time.time() - start)
+
+
+def put(url, content):
+    url = urlparse.urlsplit(url)
+    conn = httplib.HTTPConnection(url.netloc)
+    conn.request('PUT', url.path, content)
+    conn.getresponse().read()
+    conn.close()
+
+
+def populate(client, count):
+    for n in xrange(count):
+        client.store_content('bench/%08d' % n, 'x')
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--requests', type='int', default=2000)
+    parser.add_option('-t', '--threads', type='int', default=1)
+    parser.add_option(
+        '--keys', type='int', default=100,
+        help='keys to store before measuring'
+    )
+    parser.add_option(
+        '--trackers', help='comma separated trackers instead of the emulator'
+    )
+    parser.add_option(
+        '--domain', default=DOMAIN, help='domain on --trackers'
+    )
+    parser.add_option('-j', '--json', help='write results to this file')
+    options, _ = parser.parse_args(argv)
+
+    emulator = None
+    if options.trackers:
+        trackers = options.trackers.split(',')
+    else:
+        emulator = EmulatorProcess('--domain', options.domain)
+        trackers = emulator.trackers
+
+    try:
+        client = Client(options.domain, trackers)
+        backend = client.backend
+        populate(client, options.keys)
+
+        def get_paths(n):
+            backend.do_request(
+                'get_paths', {
+                    'domain': options.domain,
+                    'key': 'bench/%08d' % (n % options.keys),
+                    'noverify': 1,
+                    'pathcount': 2
+                },
+                decoder=decode_records
+            )
+
+        def list_keys(n):
+            backend.do_request(
+                'list_keys', {
+                    'domain': options.domain,
+                    'prefix': 'bench/',
+                    'limit': 100
+                },
+                decoder=decode_records
+            )
+
+        # create_close needs the fid from create_open, so open all files
+        # first and close them in a second pass
+        opened = {}
+
+        def create_open(n):
+            opened[n] = backend.do_request(
+                'create_open', {
+                    'domain': options.domain,
+                    'key': 'bench/new/%08d' % n,
+                    'fid': 0,
+                    'multi_dest': 1
+                },
+                decoder=decode_records
+            )
+
+        def create_close(n):
+            res = opened.pop(n)
+            backend.do_request(
+                'create_close', {
+                    'domain': options.domain,
+                    'key': 'bench/new/%08d' % n,
+                    'fid': res['fid'],
+                    'devid': res.list('devid', 1)[0],
+                    'path': res.list('path', 1)[0],
+                    'size': 1
+                }
+            )
+
+        cases = [
+            ('get_paths', get_paths),
+            ('list_keys', list_keys),
+            ('create_open', create_open),
+            ('create_close', create_close),
+        ]
+        results = {}
+        for name, func in cases:
+            if name == 'create_close':
+                # the tracker checks the size on the storage node
+                for res in opened.itervalues():
+                    put(res.list('path', 1)[0], 'x')
+            results[name] = res = run(
+                options.threads, options.requests, func
+            )
+            print '%-14s %8.0f ops/s  p50 %7.3f ms  p99 %7.3f ms' % (
+                name, res['ops_per_sec'], res['p50_ms'], res['p99_ms']
+            )
+        backend.close()
+    finally:
+        if emulator:
+            emulator.stop()
+
+    if options.json:
+        write_results(options.json, 'tracker', vars(options), results)
+
+
+if __name__ == '__main__':
+    main()
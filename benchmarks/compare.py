@@ -0,0 +1,73 @@
+#! coding: utf-8
+"""
+Compares two JSON result files of the same benchmark, e.g. from two
+commits, and prints the change of every metric.
+
+    python benchmarks/compare.py old.json new.json [--threshold PCT]
+
+Exits with status 1 when a metric got worse by more than the threshold.
+"""
+import sys
+import json
+from optparse import OptionParser
+
+# metrics where a smaller value is better, the rest are throughput
+LOWER_IS_BETTER = (
+    '_ms', 'seconds', 'peak_rss_mb', 'rss_delta_mb'
+)
+IGNORED = ('ops', 'bytes')
+
+
+def flatten(results, prefix=''):
+    """{'get_paths': {'p50_ms': 1}} -> {'get_paths p50_ms': 1}"""
+    flat = {}
+    for name, value in results.items():
+        name = prefix and '%s %s' % (prefix, name) or name
+        if isinstance(value, dict):
+            flat.update(flatten(value, name))
+        elif isinstance(value, (int, long, float)):
+            flat[name] = value
+    return flat
+
+
+def load(path):
+    with open(path) as fp:
+        doc = json.load(fp)
+    # bench_decoder writes the bare results
+    return doc.get('commit'), flatten(doc.get('results', doc))
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] OLD NEW')
+    parser.add_option(
+        '-t', '--threshold', type='float', default=10.0,
+        help='percent change reported as a regression [%default]'
+    )
+    options, args = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.error('need two result files')
+
+    old_commit, old = load(args[0])
+    new_commit, new = load(args[1])
+    print '%s -> %s' % (old_commit or args[0], new_commit or args[1])
+
+    regressions = 0
+    for name in sorted(set(old) & set(new)):
+        if name.rsplit(' ', 1)[-1] in IGNORED or not old[name]:
+            continue
+        change = (new[name] - old[name]) * 100.0 / old[name]
+        worse = change
+        if not name.endswith(LOWER_IS_BETTER):
+            worse = -change
+        mark = ''
+        if worse > options.threshold:
+            mark = '  REGRESSION'
+            regressions += 1
+        print '%-45s %12.3f %12.3f %+8.1f%%%s' % (
+            name, old[name], new[name], change, mark
+        )
+    return regressions and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+#! coding: utf-8
+"""
+Helpers shared by the benchmark scripts: an emulated cluster in a child
+process, latency percentiles and JSON result files.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+
+class EmulatorProcess(object):
+    """
+    ``python -m pymogile.emulator`` in a child process, so the servers
+    neither compete with the benchmark for the GIL nor add to its memory.
+    """
+
+    def __init__(self, *args):
+        cmd = [sys.executable, '-m', 'pymogile.emulator', '--port', '0']
+        self.proc = subprocess.Popen(
+            cmd + list(args), cwd=ROOT, stdout=subprocess.PIPE
+        )
+        line = self.proc.stdout.readline()
+        if not line.startswith('trackers:'):
+            self.stop()
+            raise RuntimeError('emulator did not start: %r' % line)
+        self.trackers = line.split()[1:]
+        self.nodes = self.proc.stdout.readline().split()[2:]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def stop(self):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            self.proc.wait()
+
+
+def percentile(samples, pct):
+    """``pct`` percentile of the already sorted ``samples``."""
+    if not samples:
+        return None
+    idx = int(round((len(samples) - 1) * pct / 100.0))
+    return samples[idx]
+
+
+def latency_summary(samples, elapsed):
+    """ops/sec over ``elapsed`` seconds and latency percentiles in ms."""
+    samples = sorted(samples)
+    return {
+        'ops': len(samples),
+        'ops_per_sec': len(samples) / elapsed,
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p99_ms': percentile(samples, 99) * 1000,
+        'max_ms': samples[-1] * 1000,
+    }
+
+
+def parse_size(text):
+    """'64K', '16M' or '1G' in bytes."""
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    text = text.strip().upper()
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def format_size(size):
+    for unit, factor in (('G', 1 << 30), ('M', 1 << 20), ('K', 1 << 10)):
+        if size >= factor and not size % factor:
+            return '%d%s' % (size / factor, unit)
+    return str(size)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stderr=open(os.devnull, 'w')
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(path, benchmark, options, results):
+    """Write ``results`` with enough context to compare two runs."""
+    doc = {
+        'benchmark': benchmark,
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'options': options,
+        'results': results,
+    }
+    with open(path, 'w') as fp:
+        json.dump(doc, fp, indent=2, sort_keys=True)
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from pymogile.client import Client
 from pymogile.admin import Admin
+from pymogile.aio import AsyncClient, AsyncBackend
 from pymogile.local import Client as FakeClient
 from pymogile.local import Admin as FakeAdmin
-from pymogile.exceptions import MogileFSError, HTTPError
+from pymogile.deadline import Deadline
+from pymogile.exceptions import MogileFSError, HTTPError, DeadlineExceeded
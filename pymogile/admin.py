@@ -1,6 +1,6 @@
 #! coding: utf-8
 
-from pymogile.backend import Backend
+from pymogile.backend import Backend, decode_records
 from pymogile.exceptions import MogileFSError
 
 
@@ -17,17 +17,16 @@ class Admin(object):
             params = {'hostid': hostid}
         else:
             params = None
-        res = self.backend.do_request("get_hosts", params)
+        res = self.backend.do_request(
+            "get_hosts", params, decoder=decode_records
+        )
         results = []
         fields = [
             "hostid", "status", "hostname", "hostip", "http_port",
             "http_get_port", "altip altmask"
         ]
-        hosts = int(res['hosts']) + 1
-        for ct in xrange(1, hosts):
-            results.append(
-                dict([(f, res.get('host%d_%s' % (ct, f))) for f in fields])
-            )
+        for row in res.rows('host', res['hosts']):
+            results.append(dict([(f, row.get(f)) for f in fields]))
         return results
 
     def get_devices(self, devid=None):
@@ -35,17 +34,19 @@ class Admin(object):
             params = {'devid': devid}
         else:
             params = None
-        res = self.backend.do_request("get_devices", params)
+        res = self.backend.do_request(
+            "get_devices", params, decoder=decode_records
+        )
         ret = []
-        for x in xrange(1, int(res['devices']) + 1):
+        for row in res.rows('dev', res['devices']):
             device = {}
             for k in (
                 'devid', 'hostid', 'status', 'observed_state', 'utilization'
             ):
-                device[k] = res.get('dev%d_%s' % (x, k))
+                device[k] = row.get(k)
 
             for k in ('mb_total', 'mb_used', 'weight'):
-                value = res.get('dev%d_%s' % (x, k))
+                value = row.get(k)
                 if value:
                     device[k] = int(value)
                 else:
@@ -62,12 +63,13 @@ class Admin(object):
         """
         res = self.backend.do_request(
             'list_fids', {'from': from_fid,
-                          'to': to_fid}
+                          'to': to_fid},
+            decoder=decode_records
         )
         results = {}
-        for x in xrange(1, int(res['fid_count']) + 1):
-            key = 'fid_%d_fid' % x
-            results[key] = dict([(k, res['fid_%d_%s' % (x, k)]) \
+        for x, row in enumerate(res.rows('fid', res['fid_count'])):
+            key = 'fid_%d_fid' % (x + 1)
+            results[key] = dict([(k, row[k]) \
                                  for k in ('key', 'length', 'class', 'domain', 'devcount')])
         return results
 
@@ -331,14 +333,15 @@ class Admin(object):
         params = {}
         if after_logid:
             params['after_logid'] = after_logid
-        res = self.backend.do_request("fsck_getlog", params)
+        res = self.backend.do_request(
+            "fsck_getlog", params, decoder=decode_records
+        )
 
-        row_count = int(res['row_count'])
         ret = []
-        for x in xrange(1, row_count + 1):
+        for row in res.rows('row', res['row_count']):
             rec = {}
             for k in ("logid", "utime", "fid", "evcode", "devid"):
-                rec[k] = res.get("row_%d_%s" % (x, k))
+                rec[k] = row.get(k)
             ret.append(rec)
         return ret
 
@@ -389,38 +392,37 @@ class Admin(object):
 
     def get_stats(self):
         params = {'all': 1}
-        res = self.backend.do_request('stats', params)
+        res = self.backend.do_request('stats', params, decoder=decode_records)
 
         ret = {}
         # get replication statistics
         if 'replicationcount' in res:
             replication = ret.setdefault('replication', {})
-            for x in xrange(1, int(res['replicationcount']) + 1):
-                domain = res.get('replication%ddomain' % x, '')
-                cls = res.get('replication%dclass' % x, '')
-                devcount = res.get('replication%ddevcount' % x, '')
-                fields = res.get('replication%dfields' % x)
+            for row in res.rows('replication', res['replicationcount']):
+                domain = row.get('domain', '')
+                cls = row.get('class', '')
+                devcount = row.get('devcount', '')
+                fields = row.get('fields')
                 (replication.setdefault(domain, {}).setdefault(cls, {})
                  )[devcount] = fields
 
         # get file statistics
         if 'filescount' in res:
             files = ret.setdefault('files', {})
-            for x in xrange(1, int(res['filescount']) + 1):
-                domain = res.get('files%ddomain' % x, '')
-                cls = res.get('files%dclass' % x, '')
-                (files.setdefault(domain, {}
-                                  ))[cls] = res.get('files%dfiles' % x)
+            for row in res.rows('files', res['filescount']):
+                domain = row.get('domain', '')
+                cls = row.get('class', '')
+                (files.setdefault(domain, {}))[cls] = row.get('files')
 
         # get device statistics
         if 'devicescount' in res:
             devices = ret.setdefault('devices', {})
-            for x in xrange(1, int(res['devicescount']) + 1):
-                key = res.get('devices%did' % x, '')
+            for row in res.rows('devices', res['devicescount']):
+                key = row.get('id', '')
                 devices[key] = {
-                    'host': res.get('devices%dhost' % x),
-                    'status': res.get('devices%dstatus' % x),
-                    'files': res.get('devices%dfiles' % x),
+                    'host': row.get('host'),
+                    'status': row.get('status'),
+                    'files': row.get('files'),
                 }
 
         if 'fidmax' in res:
@@ -0,0 +1,747 @@
+#! coding: utf-8
+"""
+asyncio flavoured MogileFS client.
+
+AsyncClient mirrors the blocking Client but every tracker command and
+storage node transfer is a coroutine, so many lookups and transfers can
+share one event loop.  On Python 2 this needs the trollius port of asyncio,
+which is why coroutines are written with ``yield From(...)`` and
+``raise Return(...)``.
+"""
+import time
+import socket
+import urlparse
+
+try:
+    import trollius as asyncio
+    from trollius import From, Return
+except ImportError:
+    asyncio = None
+
+from pymogile.backend import (
+    Backend, LOG, READ_COMMANDS, decode_records, _encode_url_string,
+    _much_worse
+)
+from pymogile.singleflight import SingleFlight, share
+from pymogile.deadline import Deadline, timeout_for
+from pymogile.exceptions import MogileFSError, HTTPError, DeadlineExceeded
+
+
+def _require_asyncio():
+    if asyncio is None:
+        raise ImportError("pymogile.aio requires trollius on Python 2")
+
+
+def coroutine(func):
+    if asyncio is None:
+        return func
+    return asyncio.coroutine(func)
+
+
+class AsyncTrackerConnection(object):
+    """A tracker stream pair plus the tracker it is connected to."""
+
+    def __init__(self, reader, writer, host, loop=None):
+        self.reader = reader
+        self.writer = writer
+        self.host = host
+        self._loop = loop
+
+    def __repr__(self):
+        return '<AsyncTrackerConnection %s:%s>' % self.host
+
+    def write(self, data):
+        self.writer.write(data)
+
+    @coroutine
+    def flush(self):
+        yield From(self.writer.drain())
+
+    @coroutine
+    def readline(self, timeout=None):
+        line = yield From(
+            asyncio.wait_for(self.reader.readline(), timeout, loop=self._loop)
+        )
+        if not line:
+            raise socket.error('connection closed by tracker')
+        raise Return(line)
+
+    def is_alive(self):
+        return not self.reader.at_eof()
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncTrackerPool(object):
+    """
+    Event loop counterpart of TrackerPool.  No locking is needed inside one
+    loop; coroutines waiting for a free connection are parked on futures.
+    """
+
+    def __init__(self, max_per_host=10, max_idle_time=60, loop=None):
+        self.max_per_host = max_per_host
+        self.max_idle_time = max_idle_time
+        self._loop = loop
+        self._idle = []
+        self._count = {}
+        self._waiters = []
+
+    def connection_counts(self):
+        return dict((h, n) for h, n in self._count.items() if n)
+
+    def idle_count(self):
+        return len(self._idle)
+
+    def get(self, rank=None, limit=None):
+        return self._pop_idle(rank, limit)
+
+    @coroutine
+    def wait(self, timeout):
+        """
+        Wait up to ``timeout`` seconds for a connection to be checked in or
+        a slot to be freed.
+        """
+        waiter = asyncio.Future(loop=self._loop)
+        self._waiters.append(waiter)
+        try:
+            yield From(asyncio.wait_for(waiter, timeout, loop=self._loop))
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def _pop_idle(self, rank=None, limit=None):
+        now = time.time()
+        while self._idle:
+            idx = -1
+            if rank is not None:
+                best = None
+                for i in xrange(len(self._idle) - 1, -1, -1):
+                    cost = rank(self._idle[i][0].host)
+                    if best is None or cost < best:
+                        best, idx = cost, i
+                if limit is not None and _much_worse(best, limit):
+                    return None
+            conn, since = self._idle.pop(idx)
+            if now - since < self.max_idle_time and conn.is_alive():
+                return conn
+            self._drop(conn)
+        return None
+
+    def has_slot(self, host):
+        return self._count.get(host, 0) < self.max_per_host
+
+    def reserve(self, hosts):
+        """
+        Claim a connection slot on the first of ``hosts`` below its limit
+        and return that host, or None if they are all full.
+        """
+        for host in hosts:
+            count = self._count.get(host, 0)
+            if count < self.max_per_host:
+                self._count[host] = count + 1
+                return host
+        return None
+
+    def release(self, host):
+        self._count[host] -= 1
+        self._wakeup()
+
+    def put(self, conn):
+        self._idle.append((conn, time.time()))
+        self._wakeup()
+
+    def discard(self, conn):
+        self._drop(conn)
+        self._wakeup()
+
+    def clear(self):
+        while self._idle:
+            self._drop(self._idle.pop()[0])
+
+    def _drop(self, conn):
+        conn.close()
+        self._count[conn.host] -= 1
+
+    def _wakeup(self):
+        while self._waiters:
+            waiter = self._waiters.pop(0)
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+
+class AsyncSingleFlight(SingleFlight):
+    """
+    SingleFlight for coroutines: callers of a request already in flight
+    wait on a future for its result instead of sending it again.
+    """
+
+    def __init__(self, loop=None):
+        super(AsyncSingleFlight, self).__init__()
+        self._loop = loop
+
+    def in_flight(self):
+        return len(self._calls)
+
+    @coroutine
+    def do(self, key, timeout, func, *args):
+        future = self._calls.get(key)
+        if future is not None:
+            self.collapsed += 1
+            try:
+                # shield, so a waiter timing out does not cancel the request
+                result = yield From(
+                    asyncio.wait_for(
+                        asyncio.shield(future, loop=self._loop), timeout,
+                        loop=self._loop
+                    )
+                )
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded(
+                    "deadline exceeded waiting for a coalesced request"
+                )
+            raise Return(share(result))
+
+        future = self._calls[key] = asyncio.Future(loop=self._loop)
+        self.executed += 1
+        try:
+            result = yield From(func(*args))
+        except Exception, e:
+            future.set_exception(e)
+            # nobody may be waiting, keep the loop from logging it
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self._calls[key]
+        raise Return(result)
+
+
+class AsyncBackend(Backend):
+    """
+    Backend whose do_request and do_pipeline are coroutines running on an
+    asyncio event loop, with its own pool of tracker streams.
+    """
+
+    def __init__(
+        self,
+        trackers,
+        timeout=None,
+        max_connections=10,
+        max_idle_time=60,
+        loop=None,
+        coalesce=False
+    ):
+        _require_asyncio()
+        super(AsyncBackend, self).__init__(
+            trackers,
+            timeout,
+            max_connections,
+            max_idle_time,
+            coalesce=coalesce
+        )
+        self._loop = loop
+        self.pool = AsyncTrackerPool(max_connections, max_idle_time, loop)
+        self.singleflight = AsyncSingleFlight(loop)
+
+    @coroutine
+    def do_request(self, cmd, args=None, decoder=None, deadline=None):
+        req = '%s %s\r\n' % (cmd, _encode_url_string(args))
+        deadline = Deadline.coerce(deadline)
+
+        if self.coalesce and cmd in READ_COMMANDS:
+            res = yield From(
+                self.singleflight.do(
+                    (req, decoder), timeout_for(deadline, None),
+                    self._do_request, cmd, req, decoder, deadline
+                )
+            )
+        else:
+            res = yield From(self._do_request(cmd, req, decoder, deadline))
+        raise Return(res)
+
+    @coroutine
+    def _do_request(self, cmd, req, decoder, deadline):
+        conn, reused = yield From(self._checkout(deadline=deadline))
+        idempotent = cmd in READ_COMMANDS
+        if reused and not idempotent and not conn.is_alive():
+            # as in Backend._do_request, a command that changes something
+            # is not sent again once the tracker may have seen it
+            self.pool.discard(conn)
+            conn, reused = yield From(
+                self._checkout(reuse=False, deadline=deadline)
+            )
+        while True:
+            start = time.time()
+            if self._hooks:
+                self.run_hook('do_request_start', cmd, conn.host, 0, 0, 0.0,
+                              start)
+            LOG.debug("CONN: %r, REQ: %r", conn, req)
+
+            conn.write(req)
+            flushed = False
+            try:
+                yield From(conn.flush())
+                flushed = True
+                line = yield From(
+                    conn.readline(timeout_for(deadline, self._timeout))
+                )
+            except asyncio.TimeoutError:
+                self.pool.discard(conn)
+                if self._hooks:
+                    self._run_request_hook(
+                        'do_request_read_timeout', cmd, conn.host, req, '',
+                        start
+                    )
+                if deadline is not None and deadline.expired():
+                    raise DeadlineExceeded(
+                        "deadline exceeded waiting for %s to answer "
+                        "command: [%s]" % (conn.host, req)
+                    )
+                self._record_failure(conn.host)
+                raise MogileFSError(
+                    "tracker %s did not answer command: [%s]" %
+                    (conn.host, req)
+                )
+            except (socket.error, IOError), e:
+                self.pool.discard(conn)
+                if self._hooks:
+                    self._run_request_hook(
+                        'do_request_send_error', cmd, conn.host, req, '',
+                        start
+                    )
+                if reused and (idempotent or not flushed):
+                    conn, reused = yield From(
+                        self._checkout(reuse=False, deadline=deadline)
+                    )
+                    continue
+                if not reused:
+                    self._record_failure(conn.host)
+                raise MogileFSError(
+                    "couldn't send command: [%s]. reason: %s" % (req, e)
+                )
+            break
+
+        self._record_success(conn.host, time.time() - start)
+
+        if self._hooks:
+            self._run_request_hook(
+                'do_request_finished', cmd, conn.host, req, line, start
+            )
+        LOG.debug('RESPONSE: %r', line)
+
+        try:
+            res = self._parse_response(line, decoder)
+        except MogileFSError:
+            self.pool.discard(conn)
+            raise
+        self._checkin(conn)
+        if isinstance(res, MogileFSError):
+            raise res
+        raise Return(res)
+
+    @coroutine
+    def do_pipeline(self, requests, depth=128, decoder=None):
+        requests = list(requests)
+        results = []
+        if not requests:
+            raise Return(results)
+
+        idempotent = all(cmd in READ_COMMANDS for cmd, _ in requests)
+        conn, reused = yield From(self._checkout())
+        if reused and not idempotent and not conn.is_alive():
+            self.pool.discard(conn)
+            conn, reused = yield From(self._checkout(reuse=False))
+        start = 0
+        try:
+            while start < len(requests):
+                batch = requests[start:start + depth]
+                for cmd, args in batch:
+                    conn.write('%s %s\r\n' % (cmd, _encode_url_string(args)))
+                sent = time.time()
+                flushed = False
+                try:
+                    yield From(conn.flush())
+                    flushed = True
+                    line = yield From(conn.readline(self._timeout))
+                except asyncio.TimeoutError:
+                    raise
+                except (socket.error, IOError):
+                    # like _do_request, only what the tracker cannot have
+                    # run yet, or can run twice, is sent again
+                    if not (reused and (idempotent or not flushed)):
+                        raise
+                    self.pool.discard(conn)
+                    conn, reused = yield From(self._checkout(reuse=False))
+                    continue
+                reused = False
+                self._record_success(conn.host, time.time() - sent)
+                for _ in batch:
+                    if line is None:
+                        line = yield From(conn.readline(self._timeout))
+                    results.append(self._parse_response(line, decoder))
+                    line = None
+                start += len(batch)
+        except (asyncio.TimeoutError, socket.error, IOError,
+                MogileFSError), e:
+            self.pool.discard(conn)
+            if not isinstance(e, MogileFSError):
+                self._record_failure(conn.host)
+            raise MogileFSError(
+                "pipeline to %s failed after %d of %d replies: %r" %
+                (conn.host, len(results), len(requests), e)
+            )
+
+        self._checkin(conn)
+        raise Return(results)
+
+    @coroutine
+    def _checkout(self, reuse=True, deadline=None):
+        trackers = self._trackers_to_try()
+        end = time.time() + timeout_for(deadline, self._timeout)
+        while trackers:
+            if reuse:
+                limit = None
+                for tracker in trackers:
+                    if self.pool.has_slot(tracker):
+                        limit = self._rank(tracker)
+                        break
+                conn = self.pool.get(self._rank, limit)
+                if conn is not None:
+                    raise Return((conn, True))
+            reuse = True
+
+            tracker = self.pool.reserve(trackers)
+            if tracker is None:
+                now = time.time()
+                if now >= end:
+                    break
+                yield From(self.pool.wait(end - now))
+                continue
+
+            conn = yield From(self._open_connection(tracker))
+            if conn is None:
+                self.pool.release(tracker)
+                self._record_failure(tracker)
+                trackers.remove(tracker)
+                continue
+            raise Return((conn, False))
+
+        if deadline is not None and deadline.expired():
+            raise DeadlineExceeded(
+                "deadline exceeded connecting to mogilefs backends: %s" %
+                self._hosts
+            )
+        raise MogileFSError(
+            "couldn't connect to any mogilefs backends: %s" % self._hosts
+        )
+
+    @coroutine
+    def _open_connection(self, tracker):
+        addrs = []
+        if tracker[0] in self._pref_ip:
+            addrs.append(((self._pref_ip[tracker[0]], tracker[1]), 0.1))
+        addrs.append((tracker, 0.25))
+
+        for addr, timeout in addrs:
+            try:
+                reader, writer = yield From(
+                    asyncio.wait_for(
+                        asyncio.open_connection(
+                            addr[0], addr[1], loop=self._loop
+                        ), timeout, loop=self._loop
+                    )
+                )
+            except (asyncio.TimeoutError, socket.error, OSError):
+                LOG.debug("failed connect to tracker %s" % str(addr))
+                continue
+            self.last_host_connected = addr
+            raise Return(
+                AsyncTrackerConnection(reader, writer, tracker, self._loop)
+            )
+        raise Return(None)
+
+
+@coroutine
+def http_request(
+    url, method='GET', body=None, headers=None, loop=None, timeout=None
+):
+    """
+    Minimal HTTP/1.1 exchange with a storage node over asyncio streams.
+    Returns ``(status, headers, content)``.  Raises socket.timeout when
+    the whole exchange takes longer than ``timeout`` seconds.
+    """
+    try:
+        res = yield From(
+            asyncio.wait_for(
+                _http_exchange(url, method, body, headers, loop), timeout,
+                loop=loop
+            )
+        )
+    except asyncio.TimeoutError:
+        raise socket.timeout("%s %s timed out" % (method, url))
+    raise Return(res)
+
+
+@coroutine
+def _http_exchange(url, method, body, headers, loop):
+    parts = urlparse.urlsplit(url)
+    if parts.scheme != 'http':
+        raise ValueError("unsupported url scheme '%s'" % parts.scheme)
+    host = parts.hostname
+    port = parts.port or 80
+    target = parts.path or '/'
+    if parts.query:
+        target += '?' + parts.query
+
+    headers = dict(headers or {})
+    headers.setdefault('Host', parts.netloc)
+    headers['Connection'] = 'close'
+    if body is not None or method == 'PUT':
+        headers['Content-Length'] = len(body or '')
+
+    reader, writer = yield From(
+        asyncio.open_connection(host, port, loop=loop)
+    )
+    try:
+        buf = ['%s %s HTTP/1.1\r\n' % (method, target)]
+        for k, v in headers.items():
+            buf.append('%s: %s\r\n' % (k, v))
+        buf.append('\r\n')
+        writer.write(''.join(buf))
+        if body:
+            writer.write(body)
+
+        status_line = yield From(reader.readline())
+        try:
+            status = int(status_line.split(None, 2)[1])
+        except (IndexError, ValueError):
+            raise HTTPError(0, 'invalid status line %r' % status_line)
+
+        res_headers = {}
+        while True:
+            line = yield From(reader.readline())
+            if line in ('\r\n', '\n', ''):
+                break
+            k, _, v = line.partition(':')
+            res_headers[k.strip().lower()] = v.strip()
+
+        if method == 'HEAD' or status in (204, 304):
+            content = ''
+        elif res_headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((yield From(reader.readline())).split(';')[0], 16)
+                if not size:
+                    break
+                chunks.append((yield From(reader.readexactly(size))))
+                yield From(reader.readline())
+            content = ''.join(chunks)
+        elif 'content-length' in res_headers:
+            content = yield From(
+                reader.readexactly(int(res_headers['content-length']))
+            )
+        else:
+            content = yield From(reader.read())
+    finally:
+        writer.close()
+
+    raise Return((status, res_headers, content))
+
+
+class AsyncNewFile(object):
+    """
+    Buffer returned by AsyncClient.new_file.  Data written is PUT to the
+    first destination that accepts it when the ``close()`` coroutine runs.
+    """
+
+    def __init__(self, mg, fid, key, dests, create_close_arg=None):
+        self.mg = mg
+        self.fid = fid
+        self.key = key
+        self._dests = dests
+        self._buf = []
+        self.create_close_arg = create_close_arg or {}
+        self._is_closed = False
+
+    def paths(self):
+        return self._dests
+
+    def write(self, content):
+        if self._is_closed:
+            raise ValueError("I/O operation on closed file")
+        self._buf.append(content)
+
+    @coroutine
+    def close(self):
+        if self._is_closed:
+            raise Return(None)
+        self._is_closed = True
+        content = ''.join(self._buf)
+        self._buf = []
+
+        for devid, path in self._dests:
+            try:
+                status, _, _ = yield From(
+                    http_request(
+                        path, 'PUT', content, loop=self.mg._loop,
+                        timeout=self.mg.http_timeout
+                    )
+                )
+            except (socket.error, IOError, HTTPError), e:
+                LOG.debug("PUT to %s failed: %s" % (path, e))
+                continue
+            if 200 <= status < 300:
+                break
+        else:
+            raise HTTPError(0, "couldn't store %s on any storage node" %
+                            self.key)
+
+        params = {
+            'fid': self.fid,
+            'domain': self.mg.domain,
+            'key': self.key,
+            'path': path,
+            'devid': devid,
+            'size': len(content)
+        }
+        params.update(self.create_close_arg)
+        try:
+            yield From(self.mg.backend.do_request('create_close', params))
+        except MogileFSError, e:
+            if e.err != 'empty_file':
+                raise
+        raise Return(len(content))
+
+
+class AsyncClient(object):
+    """
+    asyncio counterpart of Client.  Methods are coroutines:
+
+        paths = yield From(client.get_paths(key))
+    """
+
+    def __init__(
+        self,
+        domain,
+        trackers,
+        readonly=False,
+        loop=None,
+        timeout=3,
+        coalesce=False,
+        http_timeout=10
+    ):
+        _require_asyncio()
+        self.readonly = bool(readonly)
+        self.domain = domain
+        self.http_timeout = http_timeout
+        self._loop = loop
+        self.backend = AsyncBackend(
+            trackers, timeout=timeout, loop=loop, coalesce=coalesce
+        )
+
+    @property
+    def last_tracker(self):
+        return self.backend.last_host_connected
+
+    def close(self):
+        self.backend.close()
+
+    @coroutine
+    def new_file(self, key, cls=None, create_close_arg=None):
+        params = {'domain': self.domain, 'key': key, 'fid': 0, 'multi_dest': 1}
+        if cls is not None:
+            params['class'] = cls
+        res = yield From(
+            self.backend.do_request(
+                'create_open', params, decoder=decode_records
+            )
+        )
+
+        if 'dev_count' not in res:
+            dests = [(res['devid'], res['path'])]
+        else:
+            count = res['dev_count']
+            dests = zip(res.list('devid', count), res.list('path', count))
+        raise Return(
+            AsyncNewFile(self, res['fid'], key, dests, create_close_arg)
+        )
+
+    @coroutine
+    def store_content(self, key, content, cls=None):
+        if self.readonly:
+            raise Return(False)
+        fp = yield From(self.new_file(key, cls))
+        fp.write(content)
+        length = yield From(fp.close())
+        raise Return(length)
+
+    @coroutine
+    def get_paths(self, key, noverify=1, zone='alt', pathcount=2):
+        params = {
+            'domain': self.domain,
+            'key': key,
+            'noverify': noverify and 1 or 0,
+            'zone': zone,
+            'pathcount': pathcount
+        }
+        res = yield From(
+            self.backend.do_request(
+                'get_paths', params, decoder=decode_records
+            )
+        )
+        raise Return(res.list('path', res['paths']))
+
+    @coroutine
+    def get_file_data(self, key):
+        paths = yield From(self.get_paths(key))
+        for path in paths:
+            try:
+                status, _, content = yield From(
+                    http_request(
+                        path, 'GET', loop=self._loop,
+                        timeout=self.http_timeout
+                    )
+                )
+            except (socket.error, IOError), e:
+                LOG.debug("GET %s failed: %s" % (path, e))
+                continue
+            if 200 <= status < 300:
+                raise Return(content)
+        raise Return(None)
+
+    @coroutine
+    def delete(self, key):
+        if self.readonly:
+            raise Return(False)
+        try:
+            yield From(
+                self.backend.do_request(
+                    'delete', {'domain': self.domain,
+                               'key': key}
+                )
+            )
+        except MogileFSError:
+            raise Return(False)
+        raise Return(True)
+
+    @coroutine
+    def list_keys(self, prefix=None, after=None, limit=None):
+        params = {'domain': self.domain}
+        if prefix:
+            params['prefix'] = prefix
+        if after:
+            params['after'] = after
+        if limit:
+            params['limit'] = limit
+
+        res = yield From(
+            self.backend.do_request(
+                'list_keys', params, decoder=decode_records
+            )
+        )
+        raise Return(res.list('key', res['key_count']))
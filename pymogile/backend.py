@@ -8,10 +8,14 @@ import signal
 import random
 import urllib
 import logging
-from cgi import parse_qs
-from errno import EINPROGRESS, EISCONN
+import threading
+import collections
+from errno import EINPROGRESS
 
-from pymogile.exceptions import MogileFSError
+from pymogile.hooks import Hooks
+from pymogile.singleflight import SingleFlight
+from pymogile.deadline import Deadline, timeout_for
+from pymogile.exceptions import MogileFSError, DeadlineExceeded
 
 CONSOLE_HANDLER = logging.StreamHandler()
 
@@ -20,11 +24,26 @@ LOG.setLevel(logging.INFO)
 LOG.addHandler(CONSOLE_HANDLER)
 
 PROTO_TCP = socket.getprotobyname('tcp')
+# connect timeouts for a tracker and for its preferred ip, and the delay
+# before racing a connect to the next address
+CONNECT_TIMEOUT = 0.25
+PREF_CONNECT_TIMEOUT = 0.1
+CONNECT_STAGGER = 0.05
 MSG_NOSIGNAL = 0x4000
 FLAG_NOSIGNAL = MSG_NOSIGNAL
 
 ERR_RE = re.compile(r'^ERR\s+(\w+)\s*(\S*)')
 OK_RE = re.compile(r'^OK\s+\d*\s*(\S*)')
+# read-only commands, which may be sent to a second tracker when the first
+# is slow and whose concurrent duplicates may share one reply
+READ_COMMANDS = frozenset([
+    'get_paths', 'file_info', 'list_keys', 'file_debug', 'list_fids',
+    'get_domains', 'get_hosts', 'get_devices', 'stats', 'server_settings',
+    'server_setting'
+])
+
+# numbered reply fields: key_3, path2, dev4_mb_used, fid_1_length, ...
+INDEXED_RE = re.compile(r'([a-z]+?)_?(\d+)(?:_?([a-z_]+))?$')
 
 
 def _encode_url_string(args):
@@ -38,18 +57,484 @@ def _encode_url_string(args):
     return '&'.join(buf)
 
 
+def _unquote(s):
+    if '%' in s or '+' in s:
+        return urllib.unquote_plus(s)
+    return s
+
+
+def _split_pairs(arg):
+    """
+    Split an url-encoded string into a list of keys and a list of decoded
+    values.  Keys are left encoded, tracker field names never need it.
+    """
+    if arg.count('=') == arg.count('&') + 1:
+        # every field has exactly one '=', split everything at once
+        items = arg.replace('=', '&').split('&')
+        keys = items[0::2]
+        values = items[1::2]
+    else:
+        keys = []
+        values = []
+        for pair in arg.split('&'):
+            k, _, v = pair.partition('=')
+            keys.append(k)
+            values.append(v)
+
+    # unquote all values with one call: a NUL can't show up in a value
+    # unless it was sent as %00, so it is safe to join and split on it
+    joined = '\x00'.join(values)
+    if '%' in joined or '+' in joined:
+        if '%00' in joined or '\x00' in arg:
+            values = [_unquote(v) for v in values]
+        else:
+            values = urllib.unquote_plus(joined).split('\x00')
+    return keys, values
+
+
+_FIELD_CACHE = {}
+
+
+def _parse_field(k):
+    """
+    Returns ``(name, index, field)`` for a numbered field name such as
+    ``dev3_mb_used``, or None.  Field names repeat from reply to reply, so
+    they are only matched against INDEXED_RE once.
+    """
+    matcher = INDEXED_RE.match(k)
+    if matcher is None:
+        parsed = None
+    else:
+        name, idx, field = matcher.groups()
+        parsed = (name, int(idx) - 1, field)
+    if len(_FIELD_CACHE) >= 100000:
+        _FIELD_CACHE.clear()
+    _FIELD_CACHE[k] = parsed
+    return parsed
+
+
 def _decode_url_string(arg):
     params = {}
-    for k, values in parse_qs(arg).items():
-        params[k] = values[0]
+    if not arg:
+        return params
+    keys, values = _split_pairs(arg)
+    for k, v in zip(keys, values):
+        # like parse_qs, fields without a value are left out
+        if v and k:
+            params[_unquote(k)] = v
     return params
 
 
-class Backend(object):
-    def __init__(self, trackers, timeout=None):
+class Records(object):
+    """
+    A tracker reply decoded in one pass into typed, indexed records.
+
+    Numbered fields are collected into lists, so ``key_1, key_2, ...``
+    become ``records.list('key')``, and numbered groups of fields into rows,
+    so ``dev1_devid, dev1_status, ...`` become ``records.rows('dev')``.
+    Everything else is available with the usual mapping interface.
+    """
+
+    def __init__(self, arg=None):
+        self.fields = {}
+        self._lists = {}
+        self._rows = {}
+        if arg:
+            self._decode(arg)
+
+    def __repr__(self):
+        return '<Records fields=%r lists=%r rows=%r>' % (
+            self.fields, sorted(self._lists), sorted(self._rows)
+        )
+
+    def _decode(self, arg):
+        fields = self.fields
+        lists = self._lists
+        rows = self._rows
+        cached = _FIELD_CACHE.get
+        keys, values = _split_pairs(arg)
+        for k, v in zip(keys, values):
+            parsed = cached(k, False)
+            if parsed is False:
+                parsed = _parse_field(k)
+            if parsed is None:
+                if v and k:
+                    fields[_unquote(k)] = v
+                continue
+
+            name, idx, field = parsed
+            if field is None:
+                items = lists.get(name)
+                if items is None:
+                    items = lists[name] = []
+            else:
+                items = rows.get(name)
+                if items is None:
+                    items = rows[name] = []
+            if idx >= len(items):
+                items.extend([None] * (idx + 1 - len(items)))
+            if field is None:
+                items[idx] = v
+            elif v:
+                row = items[idx]
+                if row is None:
+                    row = items[idx] = {}
+                row[field] = v
+
+    def __nonzero__(self):
+        return bool(self.fields or self._lists or self._rows)
+
+    def __getitem__(self, key):
+        return self.fields[key]
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def get(self, key, default=None):
+        return self.fields.get(key, default)
+
+    def list(self, name, count=None):
+        """
+        Values of the numbered fields ``name1`` or ``name_1`` ... in order,
+        cut or padded with None to ``count`` items if given.
+        """
+        items = self._lists.get(name, [])
+        if count is not None:
+            count = int(count)
+            items = items[:count] + [None] * (count - len(items))
+        return items
+
+    def rows(self, name, count=None):
+        """
+        Dicts of the numbered field groups ``name1_field`` or
+        ``name_1_field`` ... in order, cut or padded to ``count`` rows.
+        """
+        items = self._rows.get(name, [])
+        if count is not None:
+            count = int(count)
+            items = items[:count] + [None] * (count - len(items))
+        return [row or {} for row in items]
+
+
+def decode_records(arg):
+    return Records(arg)
+
+
+def _ignore_sigpipe():
+    if FLAG_NOSIGNAL:
+        try:
+            signal.signal(signal.SIGPIPE, signal.SIG_IGN)
+        except:
+            pass
+
+
+class TrackerConnection(object):
+    """
+    A connected tracker socket.  Each connection owns one long-lived
+    buffered reader, so bytes read past a reply line are kept for the next
+    reply, and a write buffer that is reused between commands.  Reads are
+    bounded by the socket timeout rather than a select() per command.
+    """
+
+    def __init__(self, sock, host, timeout=None):
+        self.sock = sock
+        self.host = host
+        sock.settimeout(timeout)
+        self._rfile = sock.makefile('rb')
+        self._wbuf = bytearray()
+
+    def __repr__(self):
+        return '<TrackerConnection %s:%s>' % self.host
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def write(self, data):
+        self._wbuf.extend(data)
+
+    def flush(self):
+        if self._wbuf:
+            try:
+                self.sock.sendall(self._wbuf, FLAG_NOSIGNAL)
+            finally:
+                del self._wbuf[:]
+
+    def readline(self):
+        line = self._rfile.readline()
+        if not line:
+            raise socket.error('connection closed by tracker')
+        return line
+
+    def is_alive(self):
+        """
+        An idle connection must have nothing to read.  If it is readable the
+        tracker either closed it or sent something nobody asked for.
+        """
+        try:
+            return not select.select([self.sock], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return False
+
+    def close(self):
+        try:
+            self._rfile.close()
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+def _much_worse(cost, other):
+    """Whether a tracker costing ``cost`` is clearly slower than ``other``."""
+    return cost > 2 * other and cost - other > 0.001
+
+
+class TrackerPool(object):
+    """
+    A bounded, thread-safe pool of tracker connections.
+
+    Every tracker may have at most ``max_per_host`` open connections, idle
+    or checked out.  Idle connections are handed out most recently used
+    first, closed once they have been idle for ``max_idle_time`` seconds
+    and health checked before reuse when idle for ``check_idle_time``.
+    """
+
+    def __init__(self, max_per_host=10, max_idle_time=60, check_idle_time=1):
+        self.max_per_host = max_per_host
+        self.max_idle_time = max_idle_time
+        self.check_idle_time = check_idle_time
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = []
+        self._count = {}
+
+    def connection_counts(self):
+        """Returns a dict of open connections per tracker."""
+        with self._cond:
+            return dict((h, n) for h, n in self._count.items() if n)
+
+    def idle_count(self):
+        with self._cond:
+            return len(self._idle)
+
+    def acquire(self, hosts, deadline, reuse=True, rank=None, exclude=()):
+        """
+        Returns ``(connection, None)`` for an idle connection, or
+        ``(None, host)`` after claiming a connection slot for the first of
+        ``hosts`` below its limit; the caller then connects to that host or
+        gives the slot back with release().
+
+        ``rank(host)`` is the expected cost of a tracker.  Idle connections
+        to the cheapest tracker are preferred, and are passed over for a new
+        connection when the host we could connect to is a lot cheaper.
+        Idle connections to trackers in ``exclude`` are left alone.  Waits
+        until ``deadline`` for a checkin when every host is at its limit,
+        then returns ``(None, None)``.
+        """
+        with self._cond:
+            while True:
+                host = None
+                for candidate in hosts:
+                    if self._count.get(candidate, 0) < self.max_per_host:
+                        host = candidate
+                        break
+
+                if reuse:
+                    limit = None
+                    if host is not None and rank is not None:
+                        limit = rank(host)
+                    conn = self._pop_idle(rank, limit, exclude)
+                    if conn is not None:
+                        return conn, None
+                reuse = True
+
+                if host is not None:
+                    self._count[host] = self._count.get(host, 0) + 1
+                    return None, host
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None, None
+                self._cond.wait(remaining)
+
+    def _pop_idle(self, rank=None, limit=None, exclude=()):
+        now = time.time()
+        while self._idle:
+            idx = None
+            best = None
+            for i in xrange(len(self._idle) - 1, -1, -1):
+                host = self._idle[i][0].host
+                if host in exclude:
+                    continue
+                if rank is None:
+                    idx = i
+                    break
+                cost = rank(host)
+                if best is None or cost < best:
+                    best, idx = cost, i
+            if idx is None:
+                return None
+            if limit is not None and _much_worse(best, limit):
+                return None
+            conn, since = self._idle.pop(idx)
+            idle = now - since
+            if idle < self.check_idle_time or (
+                idle < self.max_idle_time and conn.is_alive()
+            ):
+                return conn
+            LOG.debug("dropping idle tracker connection %r" % conn)
+            self._drop(conn)
+        return None
+
+    def reserve(self, host):
+        """Claim a connection slot for ``host`` if one is free right now."""
+        with self._cond:
+            if self._count.get(host, 0) >= self.max_per_host:
+                return False
+            self._count[host] = self._count.get(host, 0) + 1
+            return True
+
+    def release(self, host):
+        """Give back a slot claimed with acquire() that was never used."""
+        with self._cond:
+            self._count[host] -= 1
+            self._cond.notify()
+
+    def put(self, conn):
+        now = time.time()
+        with self._cond:
+            self._idle.append((conn, now))
+            while now - self._idle[0][1] >= self.max_idle_time:
+                self._drop(self._idle.pop(0)[0])
+            self._cond.notify()
+
+    def discard(self, conn):
+        with self._cond:
+            self._drop(conn)
+            self._cond.notify()
+
+    def clear(self):
+        with self._cond:
+            while self._idle:
+                self._drop(self._idle.pop()[0])
+            self._cond.notify_all()
+
+    def _drop(self, conn):
+        conn.close()
+        self._count[conn.host] -= 1
+
+
+class TrackerStats(object):
+    """
+    Latency and health figures for one tracker: an exponentially weighted
+    moving average of the round trip time and of the error rate, plus the
+    number of consecutive failures, which drives an exponential backoff.
+    """
+
+    alpha = 0.2
+    backoff_base = 1.0
+    backoff_max = 60.0
+    # measurements older than this are no longer trusted
+    max_age = 30.0
+
+    def __init__(self):
+        self.rtt = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.retry_at = 0
+        self.requests = 0
+        self.updated = 0
+
+    def __repr__(self):
+        return '<TrackerStats rtt=%s error_rate=%.3f failures=%d>' % (
+            self.rtt, self.error_rate, self.failures
+        )
+
+    def record_success(self, elapsed):
+        self.requests += 1
+        if self.rtt is None:
+            self.rtt = elapsed
+        else:
+            self.rtt += self.alpha * (elapsed - self.rtt)
+        self.error_rate -= self.alpha * self.error_rate
+        self.failures = 0
+        self.retry_at = 0
+        self.updated = time.time()
+
+    def record_failure(self, now):
+        self.requests += 1
+        self.error_rate += self.alpha * (1 - self.error_rate)
+        self.failures += 1
+        backoff = self.backoff_base * 2 ** (self.failures - 1)
+        self.retry_at = now + min(backoff, self.backoff_max)
+        self.updated = now
+
+    def is_healthy(self):
+        return not self.failures
+
+    def score(self):
+        """
+        Expected cost of using this tracker in seconds, lower is better.
+        Failing trackers always cost more than healthy ones.
+        """
+        if self.failures:
+            return 1000.0 + self.failures
+        if self.rtt is None or time.time() - self.updated > self.max_age:
+            # not measured lately, give it a chance to prove itself
+            return 0.0
+        return self.rtt * (1 + 10 * self.error_rate)
+
+
+class LatencyWindow(object):
+    """The most recent latencies of one command, for percentile estimates."""
+
+    def __init__(self, size=500):
+        self._samples = collections.deque(maxlen=size)
+        self._sorted = []
+        self._stale = 0
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, elapsed):
+        self._samples.append(elapsed)
+        self._stale += 1
+
+    def percentile(self, pct):
+        # re-sort only after a tenth of the window has been replaced
+        if self._stale * 10 >= len(self._samples) or not self._sorted:
+            self._sorted = sorted(self._samples)
+            self._stale = 0
+        if not self._sorted:
+            return None
+        idx = int(len(self._sorted) * pct / 100.0)
+        return self._sorted[min(idx, len(self._sorted) - 1)]
+
+
+class Backend(Hooks):
+    def __init__(
+        self,
+        trackers,
+        timeout=None,
+        max_connections=10,
+        max_idle_time=60,
+        hedge=False,
+        hedge_percentile=95,
+        hedge_delay=0.05,
+        hedge_min_samples=20,
+        coalesce=False
+    ):
+        """
+        With ``hedge`` on, read-only commands (READ_COMMANDS) that get no
+        answer within the ``hedge_percentile`` latency of that command are
+        sent to a second tracker as well, and the first answer wins.  Until
+        ``hedge_min_samples`` latencies are known ``hedge_delay`` is used.
+
+        With ``coalesce`` on, a read-only command that is already in flight
+        from another thread is not sent again; the caller waits for that
+        reply instead.  See coalesce_stats().
+        """
         self.last_host_connected = None
         self._hosts = []
-        self._sock_cache = None
+        self.pool = TrackerPool(max_connections, max_idle_time)
         for tracker in trackers:
             try:
                 addr, port = tracker.split(':', 1)
@@ -66,16 +551,29 @@ class Backend(object):
             self._hosts.append((addr, port))
 
         if timeout is None:
-            self._timeout = 3
+            self._timeout = 3.0
         else:
             try:
-                self._timeout = int(timeout)
-            except ValueError:
+                self._timeout = float(timeout)
+            except (TypeError, ValueError):
                 raise ValueError("timeout argument must be a number")
+            if self._timeout <= 0:
+                raise ValueError("timeout argument must be positive")
 
-        self._host_dead = {}
+        self._stats = dict((host, TrackerStats()) for host in self._hosts)
         self._pref_ip = {}
 
+        self.hedge = bool(hedge)
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = hedge_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.hedged_requests = 0
+        self.hedge_wins = 0
+        self._latency = {}
+        self.coalesce = bool(coalesce)
+        self.singleflight = SingleFlight()
+        _ignore_sigpipe()
+
     def set_pref_ip(self, pref_ip):
         if not isinstance(pref_ip, dict):
             try:
@@ -84,102 +582,443 @@ class Backend(object):
                 raise ValueError("argument pref_ip must a dict")
         self._pref_ip = pref_ip
 
-    def _wait_for_readability(self, fileno, timeout):
-        if not fileno or not timeout:
-            return 0
-        return not not (select.select([fileno], [], [], timeout)[0])
+    def do_request(
+        self, cmd, args=None, decoder=None, deadline=None, tracker_hint=None
+    ):
+        """
+        Send one command to a tracker and return its decoded reply.  The
+        reply is a dict unless another ``decoder``, such as decode_records,
+        is given.  Raises MogileFSError for ERR replies.
 
-    def do_request(self, cmd, args=None):
+        ``deadline``, a Deadline or seconds from now, bounds the whole call
+        including connecting and waiting for a pooled connection; when it
+        runs out DeadlineExceeded is raised.
+
+        Concurrent callers can spread their requests over the trackers by
+        giving each a different ``tracker_hint``: with hint ``n`` the n-th
+        best tracker is preferred, counting around when there are fewer.
+        """
         req = '%s %s\r\n' % (cmd, _encode_url_string(args))
-        reqlen = len(req)
+        deadline = Deadline.coerce(deadline)
+        avoid = self._avoid(tracker_hint)
 
-        if FLAG_NOSIGNAL:
-            try:
-                signal.signal(signal.SIGPIPE, signal.SIG_IGN)
-            except:
-                pass
+        if self.coalesce and cmd in READ_COMMANDS:
+            return self.singleflight.do(
+                (req, decoder), timeout_for(deadline, None), self._do_request,
+                cmd, req, decoder, deadline, avoid
+            )
+        return self._do_request(cmd, req, decoder, deadline, avoid)
 
-        rv = 0
-        sock = self._sock_cache
-        if sock:
-            self.run_hook('do_request_start', cmd, self.last_host_connected)
-            LOG.debug("SOCK: cached = %r, REQ: %r" % (sock, req))
+    def _do_request(self, cmd, req, decoder, deadline, avoid=()):
+        if self.hedge and cmd in READ_COMMANDS and len(self._hosts) > 1:
+            return self._do_hedged_request(cmd, req, decoder, deadline)
 
-            # send FLAG_NOSIGNAL
+        conn, reused = self._checkout_avoiding(avoid, deadline)
+        idempotent = cmd in READ_COMMANDS
+        if reused and not idempotent and not conn.is_alive():
+            # a command that changes something is not sent again once the
+            # tracker may have seen it, so don't risk a stale connection
+            self.pool.discard(conn)
+            conn, reused = self._checkout(False, deadline=deadline)
+        while True:
+            start = time.time()
+            if self._hooks:
+                self.run_hook('do_request_start', cmd, conn.host, 0, 0, 0.0,
+                              start)
+            LOG.debug("CONN: %r, REQ: %r", conn, req)
+
+            conn.write(req)
+            flushed = False
             try:
-                rv = sock.send(req, FLAG_NOSIGNAL)
-                if rv != reqlen:
-                    self.run_hook(
-                        'do_request_length_mismatch', cmd,
-                        self.last_host_connected
+                conn.flush()
+                flushed = True
+                line = conn.readline()
+            except socket.timeout:
+                self.pool.discard(conn)
+                if self._hooks:
+                    self._run_request_hook(
+                        'do_request_read_timeout', cmd, conn.host, req, '',
+                        start
                     )
-                    raise MogileFSError(
-                        """
-                        send() didn't return expected length (%s, not %s)
-                        """ % (rv, reqlen)
+                if deadline is not None and deadline.expired():
+                    # the caller's budget ran out, not the tracker's
+                    raise DeadlineExceeded(
+                        "deadline exceeded waiting for %s to answer "
+                        "command: [%s]" % (conn.host, req)
                     )
+                self._record_failure(conn.host)
+                raise MogileFSError("""
+                    tracker socket never became readable (%s) when sending command: [%s]
+                    """ % (conn.host, req))
             except socket.error, e:
-                self.run_hook(
-                    'do_request_send_error', cmd, self.last_host_connected
-                )
-                self._sock_cache = None
-
-        if not rv:
-            ## may cause an exception
-            sock = self._get_sock()
-            if sock is None:
+                self.pool.discard(conn)
+                if self._hooks:
+                    self._run_request_hook(
+                        'do_request_send_error', cmd, conn.host, req, '',
+                        start
+                    )
+                if reused and (idempotent or not flushed):
+                    # the cached connection went stale while idle; either
+                    # the tracker never saw this command or running it
+                    # twice is harmless, so try a fresh one
+                    conn, reused = self._checkout(False, deadline=deadline)
+                    continue
+                if not reused:
+                    self._record_failure(conn.host)
                 raise MogileFSError(
                     """
-                    couldn't connect to any mogilefs backends: %s
-                    """ % self._hosts
+                    couldn't send command: [%s]. reason: %s
+                    """ % (req, e)
                 )
+            break
+
+        self._record_success(conn.host, time.time() - start)
+
+        if self._hooks:
+            self._run_request_hook(
+                'do_request_finished', cmd, conn.host, req, line, start
+            )
+        LOG.debug('RESPONSE: %r', line)
+
+        try:
+            res = self._parse_response(line, decoder)
+        except MogileFSError:
+            self.pool.discard(conn)
+            raise
+        self._checkin(conn)
+        if isinstance(res, MogileFSError):
+            raise res
+        return res
+
+    def _do_hedged_request(self, cmd, req, decoder, user_deadline=None):
+        """
+        Send ``req`` to one tracker and, if it has not answered within the
+        hedge delay, to a second one too.  The first reply wins and the
+        slower connection is dropped, since its reply is still on the way.
+        """
+        start = time.time()
+        deadline = start + timeout_for(user_deadline, self._timeout)
+        hedge_at = start + self._hedge_delay(cmd)
+        if self._hooks:
+            self.run_hook('do_request_start', cmd, None, 0, 0, 0.0, start)
+
+        # [(connection, reused, sent at), ...]
+        pending = []
+        try:
+            pending.append(
+                self._send_request(req, deadline=user_deadline)
+            )
+            first = pending[0]
+            hedged = False
+            winner = line = None
+            while winner is None:
+                if not pending:
+                    raise MogileFSError(
+                        "couldn't send command: [%s] to any tracker" % req
+                    )
+                now = time.time()
+                wait = (hedged and deadline or min(hedge_at, deadline)) - now
+                readable = ()
+                if wait > 0:
+                    readable = select.select(
+                        [c.sock for c, _, _ in pending], [], [], wait
+                    )[0]
+
+                if not readable:
+                    if time.time() >= deadline:
+                        # the caller's budget running out is not the
+                        # trackers' fault
+                        expired = user_deadline is not None and \
+                            user_deadline.expired()
+                        while pending:
+                            conn, _, _ = pending.pop()
+                            self.pool.discard(conn)
+                            if not expired:
+                                self._record_failure(conn.host)
+                        if self._hooks:
+                            self._run_request_hook(
+                                'do_request_read_timeout', cmd, None, req, '',
+                                start
+                            )
+                        if expired:
+                            raise DeadlineExceeded(
+                                "deadline exceeded waiting for an answer to "
+                                "command: [%s]" % req
+                            )
+                        raise MogileFSError(
+                            "no tracker answered command [%s] within %ss" %
+                            (req, self._timeout)
+                        )
+                    hedged = True
+                    try:
+                        pending.append(
+                            self._send_request(
+                                req,
+                                exclude=[c.host for c, _, _ in pending],
+                                deadline=user_deadline
+                            )
+                        )
+                    except MogileFSError:
+                        # no other tracker to ask, keep waiting on the first
+                        continue
+                    self.hedged_requests += 1
+                    if self._hooks:
+                        now = time.time()
+                        self.run_hook(
+                            'do_request_hedged', cmd, pending[-1][0].host, 0,
+                            0, now - start, now
+                        )
+                    continue
+
+                for entry in list(pending):
+                    conn, reused, sent = entry
+                    if conn.sock not in readable:
+                        continue
+                    pending.remove(entry)
+                    try:
+                        line = conn.readline()
+                    except socket.error:
+                        self.pool.discard(conn)
+                        if reused:
+                            pending.append(
+                                self._send_request(
+                                    req, reuse=False, deadline=user_deadline
+                                )
+                            )
+                        else:
+                            self._record_failure(conn.host)
+                        continue
+                    winner = conn
+                    self._record_success(conn.host, time.time() - sent)
+                    if hedged and entry is not first:
+                        self.hedge_wins += 1
+                    break
+        except Exception:
+            # nobody reads these replies any more
+            for conn, _, _ in pending:
+                self.pool.discard(conn)
+            raise
+
+        elapsed = time.time() - start
+        self._latency_window(cmd).add(elapsed)
+        for conn, _, sent in pending:
+            # still alive, just slow: remember how slow
+            self._record_success(conn.host, time.time() - sent)
+            self.pool.discard(conn)
+
+        if self._hooks:
+            self._run_request_hook(
+                'do_request_finished', cmd, winner.host, req, line, start
+            )
 
-            self.run_hook('do_request_start', cmd, self.last_host_connected)
-            LOG.debug("SOCK: %r, REQ: %r" % (sock, req))
+        try:
+            res = self._parse_response(line, decoder)
+        except MogileFSError:
+            self.pool.discard(winner)
+            raise
+        self._checkin(winner)
+        if isinstance(res, MogileFSError):
+            raise res
+        return res
 
-            # send FLAG_NOSIGNAL
+    def _send_request(self, req, reuse=True, exclude=(), deadline=None):
+        """
+        Write ``req`` to a checked out connection without waiting for the
+        reply.  Returns ``(connection, reused, sent at)``.
+        """
+        conn, reused = self._checkout(reuse, exclude, deadline)
+        while True:
+            sent = time.time()
+            conn.write(req)
             try:
-                rv = sock.send(req, FLAG_NOSIGNAL)
+                conn.flush()
             except socket.error, e:
-                self.run_hook(
-                    'do_request_send_error', cmd, self.last_host_connected
-                )
+                self.pool.discard(conn)
+                if reused:
+                    conn, reused = self._checkout(False, exclude, deadline)
+                    continue
+                self._record_failure(conn.host)
                 raise MogileFSError(
-                    """
-                    couldn't send command: [%s]. reason: %s
-                    """ % (req, e)
+                    "couldn't send command: [%s]. reason: %s" % (req, e)
                 )
+            return conn, reused, sent
 
-            if rv != reqlen:
-                self.run_hook(
-                    'do_request_length_mismatch', cmd, self.last_host_connected
-                )
-                raise MogileFSError(
-                    """
-                    send() didn't return expected length (%s,MogileFSError not %s)
-                    """ % (rv, reqlen)
-                )
+    def _hedge_delay(self, cmd):
+        window = self._latency.get(cmd)
+        if window is None or len(window) < self.hedge_min_samples:
+            return self.hedge_delay
+        return window.percentile(self.hedge_percentile)
 
-        ## wait up to 3 seconds for the socket to come to life
-        if not self._wait_for_readability(sock.fileno(), self._timeout):
-            sock.close()
-            self.run_hook(
-                'do_request_read_timeout', cmd, self.last_host_connected
+    def _latency_window(self, cmd):
+        window = self._latency.get(cmd)
+        if window is None:
+            window = self._latency[cmd] = LatencyWindow()
+        return window
+
+    def _run_request_hook(self, hookname, cmd, host, req, line, start):
+        now = time.time()
+        self.run_hook(
+            hookname, cmd, host, len(req), len(line), now - start, now
+        )
+
+    def do_pipeline(
+        self,
+        requests,
+        depth=128,
+        decoder=None,
+        deadline=None,
+        connections=1
+    ):
+        """
+        Send many commands over one tracker socket without waiting for the
+        reply to each of them.
+
+        ``requests`` is an iterable of ``(cmd, args)`` tuples.  Up to
+        ``depth`` commands are written before their replies are read back,
+        in order.  Returns a list with one entry per request: the decoded
+        reply, or a MogileFSError instance if the tracker answered ERR.
+        ``deadline`` bounds the whole pipeline, as for do_request.
+
+        With ``connections`` greater than 1 the requests are split into
+        that many pipelines, run concurrently on their own connections and
+        spread over the trackers.  The results keep the order of
+        ``requests``.
+        """
+        requests = list(requests)
+        deadline = Deadline.coerce(deadline)
+        if connections > 1 and len(requests) > 1:
+            return self._parallel_pipeline(
+                requests, depth, decoder, deadline, connections
             )
-            raise MogileFSError("""
-                tracker socket never became readable (%s) when sending command: [%s]
-                """ % (self.last_host_connected, req))
+        return self._pipeline(requests, depth, decoder, deadline)
+
+    def _parallel_pipeline(self, requests, depth, decoder, deadline, count):
+        count = min(count, len(requests))
+        size = -(-len(requests) // count)
+        results = [None] * count
+        errors = []
+
+        def run(index):
+            # prefer a different tracker for every pipeline
+            start = index * size
+            try:
+                results[index] = self._pipeline(
+                    requests[start:start + size], depth, decoder, deadline,
+                    self._avoid(index)
+                )
+            except Exception, e:
+                errors.append(e)
+
+        threads = [
+            threading.Thread(target=run, args=(index, ))
+            for index in xrange(1, count)
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        run(0)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return [res for chunk in results for res in chunk]
 
-        sockfile = sock.makefile()
-        line = sockfile.readline()
+    def _pipeline(self, requests, depth, decoder, deadline, avoid=()):
+        """do_pipeline on one connection."""
+        results = []
+        if not requests:
+            return results
 
-        self.run_hook('do_request_finished', cmd, self.last_host_connected)
-        LOG.debug('RESPONSE: %r' % line)
+        idempotent = all(cmd in READ_COMMANDS for cmd, _ in requests)
+        conn, reused = self._checkout_avoiding(avoid, deadline)
+        if reused and not idempotent and not conn.is_alive():
+            # see _do_request, the batch is sent again only if harmless
+            self.pool.discard(conn)
+            conn, reused = self._checkout(False, deadline=deadline)
+        start = 0
+        sent = received = 0
+        try:
+            while start < len(requests):
+                batch = requests[start:start + depth]
+                batch_start = time.time()
+                if deadline is not None:
+                    conn.settimeout(deadline.timeout(self._timeout))
+                if self._hooks:
+                    self.run_hook('do_pipeline_start', len(batch), conn.host,
+                                  0, 0, 0.0, batch_start)
+                sent = 0
+                for cmd, args in batch:
+                    req = '%s %s\r\n' % (cmd, _encode_url_string(args))
+                    sent += len(req)
+                    conn.write(req)
+                flushed = False
+                try:
+                    conn.flush()
+                    flushed = True
+                    line = conn.readline()
+                except socket.timeout:
+                    raise
+                except socket.error:
+                    # stale cached connection: once the batch went out the
+                    # tracker may have run some of it, so only read-only
+                    # batches are sent again then
+                    if not (reused and (idempotent or not flushed)):
+                        raise
+                    self.pool.discard(conn)
+                    conn = None
+                    conn, reused = self._checkout(False, deadline=deadline)
+                    continue
+                reused = False
+                self._record_success(conn.host, time.time() - batch_start)
+                received = 0
+                for _ in batch:
+                    if line is None:
+                        line = conn.readline()
+                    received += len(line)
+                    LOG.debug('RESPONSE: %r', line)
+                    results.append(self._parse_response(line, decoder))
+                    line = None
+                if self._hooks:
+                    now = time.time()
+                    self.run_hook('do_pipeline_finished', len(batch),
+                                  conn.host, sent, received, now - batch_start,
+                                  now)
+                start += len(batch)
+        except (socket.error, MogileFSError), e:
+            if conn is None:
+                # no fresh connection in place of the stale one, whose
+                # slot is given back already
+                raise
+            self.pool.discard(conn)
+            expired = deadline is not None and deadline.expired()
+            if isinstance(e, socket.error) and not expired:
+                self._record_failure(conn.host)
+            if self._hooks:
+                now = time.time()
+                self.run_hook('do_pipeline_error', len(requests), conn.host,
+                              sent, received, now - batch_start, now)
+            if expired:
+                raise DeadlineExceeded(
+                    "deadline exceeded in pipeline to %s after %d of %d "
+                    "replies" % (conn.host, len(results), len(requests))
+                )
+            raise MogileFSError(
+                "pipeline to %s failed after %d of %d replies: %s" %
+                (conn.host, len(results), len(requests), e)
+            )
+
+        self._checkin(conn)
+        return results
 
+    def _parse_response(self, line, decoder=None):
+        """
+        Decode a tracker reply line.  Returns the reply arguments for OK,
+        a MogileFSError instance for ERR and raises on anything else.
+        """
         matcher = OK_RE.match(line)
         if matcher:
-            args = _decode_url_string(matcher.group(1))
-            LOG.debug("RETURN_VARS: %r" % args)
+            args = (decoder or _decode_url_string)(matcher.group(1))
+            LOG.debug("RETURN_VARS: %r", args)
             return args
 
         matcher = ERR_RE.match(line)
@@ -188,92 +1027,274 @@ class Backend(object):
                 urllib.unquote_plus, matcher.groups()
             )
             LOG.debug("LASTERR: %s %s" % (self.lasterr, self.lasterrstr))
-            raise MogileFSError(self.lasterrstr, self.lasterr)
+            return MogileFSError(self.lasterrstr, self.lasterr)
 
         raise MogileFSError('invalid response from server: [%s]' % line)
 
-    def run_hook(self, hookname, *args):
-        pass
-
-    def add_hook(self, hookname, *args):
-        pass
-
-    def _sock_to_host(self, tracker):
-        # try preferred ips
-        if tracker[0] in self._pref_ip:
-            prefip = self._pref_ip[tracker[0]]
-            LOG.debug("using preferred ip %s over %s" % (tracker[0], prefip))
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, PROTO_TCP)
-            prefhost = (prefip, tracker[1])
-            if self._connect_sock(sock, prefhost, 0.1):
-                self.last_host_connected = prefhost
-                # successfully connected so return this socket
-                return sock
-            else:
-                LOG.debug(
-                    "failed connect to preferred tracker %s" % str(prefhost)
+    def _checkout(self, reuse=True, exclude=(), deadline=None):
+        """
+        Returns a ``(connection, reused)`` tuple.  An idle pooled connection
+        to the best ranked tracker is preferred; otherwise a new one is
+        opened to the best tracker with a free slot, and if every tracker is
+        at its limit we wait for another thread to check one back in.
+        Trackers in ``exclude`` are not used.  The connection's timeout is
+        set to what is left of ``deadline``, at most the backend timeout.
+        """
+        trackers = [t for t in self._trackers_to_try() if t not in exclude]
+        wait_until = time.time() + timeout_for(deadline, self._timeout)
+        while trackers:
+            conn, tracker = self.pool.acquire(
+                trackers, wait_until, reuse, self._rank, exclude
+            )
+            reuse = True
+            if conn is not None:
+                conn.settimeout(timeout_for(deadline, self._timeout))
+                return conn, True
+            if tracker is None:
+                break
+
+            others = [t for t in trackers if t != tracker]
+            try:
+                sock, tracker, failed = self._connect(
+                    [tracker] + others, timeout_for(deadline, None)
                 )
+            except DeadlineExceeded:
+                self.pool.release(tracker)
+                raise
+            for bad in failed:
+                self._record_failure(bad)
+                trackers.remove(bad)
+            if sock is None:
+                if deadline is not None and deadline.expired():
+                    break
+                continue
+            try:
+                conn = TrackerConnection(
+                    sock, tracker, timeout_for(deadline, self._timeout)
+                )
+            except DeadlineExceeded:
                 sock.close()
+                self.pool.release(tracker)
+                raise
+            return conn, False
 
-        # now try the original ip
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, PROTO_TCP)
-        if self._connect_sock(sock, tracker):
-            self.last_host_connected = tracker
-            return sock
-        else:
-            return None
+        if deadline is not None and deadline.expired():
+            raise DeadlineExceeded(
+                "deadline exceeded connecting to mogilefs backends: %s" %
+                self._hosts
+            )
+        raise MogileFSError(
+            """
+            couldn't connect to any mogilefs backends: %s
+            """ % self._hosts
+        )
 
-    def _connect_sock(self, sock, sin, timeout=0.25):
-        if timeout:
-            # make the socket non-blocking for the connection if wanted, but
-            # unconditionally set it back to blocking mode at the endut:
-            sock.settimeout(timeout)
-        else:
-            sock.setblocking(1)
+    def _avoid(self, tracker_hint):
+        """The trackers other than the one ``tracker_hint`` prefers."""
+        if tracker_hint is None:
+            return ()
+        trackers = self._trackers_to_try()
+        if len(trackers) < 2:
+            return ()
+        preferred = trackers[tracker_hint % len(trackers)]
+        return [t for t in trackers if t != preferred]
 
+    def _checkout_avoiding(self, avoid, deadline):
+        """_checkout, using trackers in ``avoid`` only if no other works."""
         try:
-            err = sock.connect_ex(sin)
-        except socket.gaierror:
-            err = 'bogus error'
+            return self._checkout(exclude=avoid, deadline=deadline)
+        except DeadlineExceeded:
+            raise
+        except MogileFSError:
+            if not avoid:
+                raise
+            return self._checkout(deadline=deadline)
 
-        if err:
-            connected = False
-        else:
-            connected = True
-
-        if err and timeout and err == EINPROGRESS:
-            ret = select.select([], [sock.fileno()], [], timeout)[1]
-            if ret:
-                err = sock.connect_ex(sin)
-                if err == EISCONN:
-                    # EISCONN means connected & won't re-connect, so success.
-                    connected = True
-
-        if timeout:
-            #turn blocking back on, as we expect to do blocking IO on our sockets
-            sock.setblocking(1)
-
-        return connected
-
-    def _get_sock(self):
-        size = len(self._hosts)
-        tries = size > 15 and 15 or size
-        idx = random.randint(0, tries)
+    def _checkin(self, conn):
+        self.pool.put(conn)
+
+    def close(self):
+        """Close all idle tracker connections."""
+        self.pool.clear()
+
+    def coalesce_stats(self):
+        """
+        Returns a dict with the number of read-only commands ``executed``,
+        the number ``collapsed`` into a request already in flight, and
+        the requests ``in_flight`` right now.
+        """
+        return self.singleflight.stats()
+
+    def tracker_stats(self):
+        """Returns a dict of TrackerStats keyed by (host, port)."""
+        return dict(self._stats)
+
+    def _rank(self, tracker):
+        return self._stats[tracker].score()
+
+    def _record_success(self, tracker, elapsed):
+        self._stats[tracker].record_success(elapsed)
+
+    def _record_failure(self, tracker):
+        now = time.time()
+        stats = self._stats[tracker]
+        stats.record_failure(now)
+        LOG.debug(
+            "tracker %s failed %d times, retrying in %.1fs" %
+            (tracker, stats.failures, stats.retry_at - now)
+        )
+
+    def _connect(self, trackers, limit=None):
+        """
+        Connect to whichever of ``trackers`` answers first.
+
+        The slot of the first tracker must already be claimed, slots of the
+        others are claimed when their turn comes and skipped when full.
+        Each tracker is tried on its preferred ip and then its own address.
+        Attempts are started CONNECT_STAGGER apart, or at once when all
+        pending ones have failed, so a dead address costs a few dozen
+        milliseconds instead of a full connect timeout.  ``limit`` bounds
+        the whole call.
+
+        Returns ``(sock, tracker, failed)``; ``failed`` lists the trackers
+        none of whose addresses could be reached, and sock and tracker are
+        None if nothing connected.
+        """
         now = time.time()
+        end = limit is not None and now + limit or None
+        reserved = [trackers[0]]
+        attempts = self._connect_attempts(trackers, reserved)
+        left = {}    # tracker -> attempts started and not failed yet
+        pending = {}    # sock -> (tracker, addr, expires)
+        failed = []
+        winner = current = None
+        next_at = now
+
+        def fail(sock, tracker):
+            sock.close()
+            left[tracker] -= 1
+            if not left[tracker] and tracker != current:
+                failed.append(tracker)
+
+        def done(tracker):
+            # every address of tracker has been tried
+            if tracker is not None and not left[tracker]:
+                failed.append(tracker)
+
+        while winner is None:
+            now = time.time()
+            if end is not None and now >= end:
+                break
 
-        for _ in xrange(1, tries + 1):
-            tracker = self._hosts[idx % size]
-            idx += 1
-            # try dead trackers every 5 seconds
-            if tracker in self._host_dead:
-                if self._host_dead[tracker] > now - 5:
+            if attempts is not None and (now >= next_at or not pending):
+                try:
+                    tracker, addr, timeout = attempts.next()
+                except StopIteration:
+                    attempts = None
+                    done(current)
+                    current = None
                     continue
-            sock = self._sock_to_host(tracker)
-            if sock:
+                if tracker != current:
+                    done(current)
+                    current = tracker
+                left[tracker] = left.get(tracker, 0) + 1
+                next_at = now + CONNECT_STAGGER
+                sock = socket.socket(
+                    socket.AF_INET, socket.SOCK_STREAM, PROTO_TCP
+                )
+                sock.setblocking(0)
+                try:
+                    err = sock.connect_ex(addr)
+                except socket.error:
+                    err = -1
+                if not err:
+                    winner = sock, tracker, addr
+                elif err == EINPROGRESS:
+                    pending[sock] = (tracker, addr, now + timeout)
+                else:
+                    LOG.debug("failed connect to tracker %s", addr)
+                    fail(sock, tracker)
+                continue
+
+            if not pending:
                 break
-            # mark sock as dead
-            LOG.debug("marking tracker dead: %s @ %d" % (tracker, now))
-            self._host_dead[tracker] = now
-        else:
-            sock = None
-        return sock
+            wake = min(e for _, _, e in pending.itervalues())
+            if attempts is not None:
+                wake = min(wake, next_at)
+            if end is not None:
+                wake = min(wake, end)
+            writable = select.select(
+                [], pending.keys(), [], max(0, wake - now)
+            )[1]
+            for sock in writable:
+                tracker, addr, _ = pending.pop(sock)
+                if not sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                    winner = sock, tracker, addr
+                    break
+                LOG.debug("failed connect to tracker %s", addr)
+                fail(sock, tracker)
+            now = time.time()
+            for sock, (tracker, addr, expires) in pending.items():
+                if expires <= now and winner is None:
+                    LOG.debug("timed out connecting to tracker %s", addr)
+                    del pending[sock]
+                    fail(sock, tracker)
+
+        for sock in pending:
+            sock.close()
+        if winner is None:
+            for tracker in reserved:
+                self.pool.release(tracker)
+            return None, None, failed
+
+        sock, tracker, addr = winner
+        for other in reserved:
+            if other != tracker:
+                self.pool.release(other)
+        sock.setblocking(1)
+        self.last_host_connected = addr
+        return sock, tracker, [t for t in failed if t != tracker]
+
+    def _connect_attempts(self, trackers, reserved):
+        """
+        Yields ``(tracker, address, connect timeout)`` for ``trackers``
+        in order, claiming a pool slot for each tracker after the first.
+        """
+        for i, tracker in enumerate(trackers):
+            if i and not self.pool.reserve(tracker):
+                continue
+            if i:
+                reserved.append(tracker)
+            if tracker[0] in self._pref_ip:
+                prefhost = (self._pref_ip[tracker[0]], tracker[1])
+                LOG.debug("using preferred ip %s over %s", prefhost, tracker)
+                yield tracker, prefhost, PREF_CONNECT_TIMEOUT
+            yield tracker, tracker, CONNECT_TIMEOUT
+
+    def _trackers_to_try(self):
+        """
+        Trackers to connect to, best first.  Healthy trackers are ordered by
+        their latency score, ties broken at random.  Failing trackers are
+        skipped until their backoff expires and then tried after the healthy
+        ones, on probation.  If every tracker is backing off, the one due
+        soonest is still tried.
+        """
+        now = time.time()
+        healthy = []
+        probation = []
+        waiting = []
+        for tracker in self._hosts:
+            stats = self._stats[tracker]
+            if stats.is_healthy():
+                healthy.append((stats.score(), random.random(), tracker))
+            elif stats.retry_at <= now:
+                probation.append((stats.retry_at, tracker))
+            else:
+                waiting.append((stats.retry_at, tracker))
+
+        healthy.sort()
+        probation.sort()
+        trackers = [t for _, _, t in healthy] + [t for _, t in probation]
+        if not trackers and waiting:
+            trackers = [min(waiting)[1]]
+        return trackers[:15]
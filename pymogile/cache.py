@@ -0,0 +1,81 @@
+#! coding: utf-8
+"""
+Bounded, thread-safe caches for tracker answers.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    At most ``maxsize`` entries, each valid for ``ttl`` seconds.  When full,
+    the least recently used entry is evicted.
+
+    ``hits`` and ``misses`` count lookups, ``evictions`` the entries dropped
+    to make room and ``expirations`` the ones found past their ttl.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60.0):
+        if maxsize <= 0:
+            raise ValueError("maxsize must be greater than 0")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires, value = entry
+            if expires < time.time():
+                self.expirations += 1
+                self.misses += 1
+                return default
+            # re-insert to mark it the most recently used
+            self._data[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + ttl, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """Returns a dict of the counters, the ``size`` and ``hit_rate``."""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'size': len(self._data),
+            'hit_rate': lookups and float(self.hits) / lookups or 0.0,
+        }
@@ -5,26 +5,150 @@ https://github.com/mogilefs/perl-MogileFS-Client/blob/master/lib/MogileFS/Client
 
 This module is a client library for the MogileFS distributed file system
 """
-from pymogile.backend import Backend
-from pymogile.exceptions import MogileFSError
-from pymogile.file import NormalHTTPFile, LargeHTTPFile
+import Queue
+import httplib
+import itertools
+import threading
+
+from pymogile.hooks import Hooks
+from pymogile.cache import LRUCache
+from pymogile.backend import Backend, decode_records
+from pymogile.deadline import Deadline
+from pymogile.exceptions import MogileFSError, HTTPError
+from pymogile.file import (
+    NormalHTTPFile, LargeHTTPFile, StreamingHTTPFile, SPOOL_SIZE
+)
+from pymogile.put import regular_file_size
+from pymogile.httppool import default_pool
+
+# most keys a tracker returns for one list_keys
+LIST_KEYS_LIMIT = 1000
+
+
+class FileInfo(object):
+    """
+    A file_info reply as returned by Client.file_info_multi.  ``devids`` is
+    None unless the devices were asked for.
+    """
+    __slots__ = (
+        'fid', 'domain', 'key', 'cls', 'length', 'devcount', 'devids'
+    )
+
+    def __init__(
+        self, fid, domain, key, cls, length, devcount, devids=None
+    ):
+        self.fid = fid
+        self.domain = domain
+        self.key = key
+        self.cls = cls
+        self.length = length
+        self.devcount = devcount
+        self.devids = devids
+
+    @classmethod
+    def from_reply(cls, res):
+        devids = res.get('devids')
+        if devids is not None:
+            devids = [int(devid) for devid in devids.split(',') if devid]
+        # domain and class names repeat across millions of records
+        return cls(
+            int(res['fid']), intern(res['domain']), res['key'],
+            intern(res['class']), int(res['length']), int(res['devcount']),
+            devids
+        )
 
+    def __repr__(self):
+        return '<FileInfo fid=%d key=%r length=%d devcount=%d>' % (
+            self.fid, self.key, self.length, self.devcount
+        )
 
-class Client(object):
-    def __init__(self, domain, trackers, readonly=False):
-        """Create new Client object with the given list of trackers."""
-        self.readonly = bool(readonly)
-        self.domain = domain
-        self.backend = Backend(trackers, timeout=3)
 
-    def run_hook(self, hookname, *args):
-        pass
+def _key_before(key):
+    """A string sorting before ``key`` and after nearly all that do."""
+    last = ord(key[-1])
+    if not last:
+        return key[:-1]
+    return key[:-1] + chr(last - 1) + '\xff'
 
-    def add_hook(self, hookname, *args):
-        pass
 
-    def add_backend_hook(self):
-        raise NotImplementedError()
+def _put(queue, item, stop):
+    """Puts ``item`` on ``queue`` unless ``stop`` is set first."""
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+def _produce(pages, out, stop):
+    """
+    Puts every item of ``pages`` on ``out`` and then None, or the exception
+    raised, unless ``stop`` is set first.
+    """
+    try:
+        for page in pages:
+            if not _put(out, page, stop):
+                return
+        _put(out, None, stop)
+    except Exception, e:
+        _put(out, e, stop)
+
+
+class Client(Hooks):
+    def __init__(
+        self,
+        domain,
+        trackers,
+        readonly=False,
+        timeout=3,
+        http_timeout=10,
+        coalesce=False,
+        path_cache=0,
+        path_cache_ttl=60,
+        negative_cache=0,
+        negative_cache_ttl=5,
+        spool_size=SPOOL_SIZE,
+        http_pool=None
+    ):
+        """
+        Create new Client object with the given list of trackers.
+
+        ``timeout`` is the tracker timeout in seconds and ``http_timeout``
+        the socket timeout for storage node requests; both may be floats.
+        With ``coalesce`` concurrent identical lookups such as get_paths
+        share one tracker request, see Backend.coalesce_stats().
+
+        A ``path_cache`` greater than 0 keeps the results of get_paths for
+        up to that many keys, for ``path_cache_ttl`` seconds each, see
+        path_cache_stats().  Likewise a ``negative_cache`` greater than 0
+        remembers keys the tracker answered ``unknown_key`` for, for
+        ``negative_cache_ttl`` seconds, see negative_cache_stats().
+
+        Files from new_file are buffered in memory up to ``spool_size``
+        bytes and in a temporary file past that.
+
+        Storage node requests go over the kept-alive connections of
+        ``http_pool``, a pymogile.httppool.ConnectionPool, by default the
+        one shared by all clients.
+        """
+        self.readonly = bool(readonly)
+        self.domain = domain
+        self.http_timeout = http_timeout
+        self.spool_size = spool_size
+        self.http_pool = http_pool or default_pool
+        self.backend = Backend(trackers, timeout=timeout, coalesce=coalesce)
+        self.path_cache = None
+        if path_cache:
+            self.path_cache = LRUCache(path_cache, path_cache_ttl)
+        self.negative_cache = None
+        if negative_cache:
+            self.negative_cache = LRUCache(negative_cache, negative_cache_ttl)
+
+    def add_backend_hook(self, hookname, callback):
+        """Register a hook on the tracker backend, see Hooks.add_hook."""
+        self.backend.add_hook(hookname, callback)
 
     def errstr(self):
         raise NotImplementedError()
@@ -40,6 +164,36 @@ class Client(object):
         """
         return self.backend.last_host_connected
 
+    def path_cache_stats(self):
+        """
+        Returns a dict with the ``hits``, ``misses``, ``evictions`` and
+        ``expirations`` of the path cache, its ``size`` and ``hit_rate``,
+        or None when the cache is disabled.
+        """
+        if self.path_cache is None:
+            return None
+        return self.path_cache.stats()
+
+    def negative_cache_stats(self):
+        """
+        Returns the counters of the cache of unknown keys like
+        path_cache_stats(), or None when it is disabled.
+        """
+        if self.negative_cache is None:
+            return None
+        return self.negative_cache.stats()
+
+    def invalidate_paths(self, *keys):
+        """
+        Drop ``keys`` from the path and negative caches.  Writes through
+        this client do so on their own; call it when keys are changed by
+        someone else.
+        """
+        for cache in (self.path_cache, self.negative_cache):
+            if cache is not None:
+                for key in keys:
+                    cache.invalidate((self.domain, key))
+
     def new_file(self,
                  key,
                  cls=None,
@@ -47,7 +201,8 @@ class Client(object):
                  content_length=0,
                  create_open_arg=None,
                  create_close_arg=None,
-                 opts=None):
+                 opts=None,
+                 streaming=False):
         """
         Start creating a new filehandle with the given key,
         and option given class and options.
@@ -55,10 +210,17 @@ class Client(object):
         Returns a filehandle you should then print to,
         and later close to complete the operation.
 
+        With ``streaming`` the upload starts at once and proceeds while
+        you write, see StreamingHTTPFile.  ``opts`` may set the
+        ``spool_size`` of the buffer, see Client, the ``buffer_size`` of a
+        streaming file and the ``write_buffer`` of a large file.
+
         NOTE: check the return value from close!
         If your close didn't succeed, the file didn't get saved!
         """
-        self.run_hook('new_file_start', key, cls, opts)
+        if self._hooks:
+            self.run_hook('new_file_start', key, cls, opts)
+        self.invalidate_paths(key)
 
         create_open_arg = create_open_arg or {}
         create_close_arg = create_close_arg or {}
@@ -73,31 +235,36 @@ class Client(object):
         }
         if cls is not None:
             params['class'] = cls
-        res = self.backend.do_request('create_open', params)
+        res = self.backend.do_request(
+            'create_open', params, decoder=decode_records
+        )
         if not res:
             return None
 
         # [(devid, path), (devid, path),... ]
-        dests = []
         # determine old vs. new format to populate destinations
         if 'dev_count' not in res:
-            dests.append((res['devid'], res['path']))
+            dests = [(res['devid'], res['path'])]
         else:
-            for x in xrange(1, int(res['dev_count']) + 1):
-                devid_key = 'devid_%d' % x
-                path_key = 'path_%s' % x
-                dests.append((res[devid_key], res[path_key]))
+            count = res['dev_count']
+            dests = zip(res.list('devid', count), res.list('path', count))
 
         main_dest = dests[0]
         main_devid, main_path = main_dest
 
-        self.run_hook("new_file_end", key, cls, opts)
+        if self._hooks:
+            self.run_hook("new_file_end", key, cls, opts)
 
         # TODO
-        if largefile:
+        kwds = dict(opts or {})
+        if streaming:
+            file_class = StreamingHTTPFile
+        elif largefile:
             file_class = LargeHTTPFile
         else:
             file_class = NormalHTTPFile
+        if streaming or not largefile:
+            kwds.setdefault('spool_size', self.spool_size)
 
         return file_class(
             mg=self,
@@ -109,7 +276,8 @@ class Client(object):
             key=key,
             content_length=content_length,
             create_close_arg=create_close_arg,
-            overwrite=1
+            overwrite=1,
+            **kwds
         )
 
     def edit_file(self, key, overwrite=False):
@@ -131,7 +299,7 @@ class Client(object):
         """
         raise NotImplementedError()
 
-    def read_file(self, key):
+    def read_file(self, key, deadline=None, timeout=None):
         """
         Read the file with the the given key.
         Returns a seekable filehandle you can read() from.
@@ -139,13 +307,34 @@ class Client(object):
 
         Takes the same options as get_paths
         (which is called internally to get the URIs to read from).
+        ``deadline`` also bounds the storage requests of the filehandle,
+        each of which waits at most ``timeout`` (default http_timeout).
         """
-        paths = self.get_paths(key)
+        deadline = Deadline.coerce(deadline)
+        paths, cached = self._get_paths(key, deadline=deadline)
+        try:
+            return self._open_paths(paths, timeout, deadline)
+        except HTTPError, e:
+            if not cached or e.code != httplib.NOT_FOUND:
+                raise
+        # the cached paths are stale, the file was replaced or moved
+        self.invalidate_paths(key)
+        paths = self.get_paths(key, deadline=deadline)
+        return self._open_paths(paths, timeout, deadline)
+
+    def _open_paths(self, paths, timeout, deadline):
         if not paths:
             return None
         path = paths[0]
         backup_dests = [(None, p) for p in paths[1:]]
-        return LargeHTTPFile(path=path, backup_dests=backup_dests, readonly=1)
+        return LargeHTTPFile(
+            path=path,
+            backup_dests=backup_dests,
+            readonly=1,
+            mg=self,
+            timeout=timeout,
+            deadline=deadline
+        )
 
     def store_file(self, key, fp, cls=None, chunk_size=8192):
         """
@@ -154,6 +343,9 @@ class Client(object):
         Given a key, class, and a filehandle or filename, stores the file
         contents in MogileFS.  Returns the number of bytes stored on success,
         undef on failure.
+
+        A regular file on disk is sent whole with a Content-Length, using
+        sendfile(2) when available, see NormalHTTPFile.upload.
         """
         if self.readonly:
             return False
@@ -165,7 +357,8 @@ class Client(object):
             params['class'] = cls
         params[key] = key
 
-        self.run_hook('store_file_start', params)
+        if self._hooks:
+            self.run_hook('store_file_start', params)
 
         try:
             new_file = self.new_file(key, cls)
@@ -174,15 +367,20 @@ class Client(object):
             return False
 
         try:
-            _bytes = 0
-            while True:
-                buf = fp.read(chunk_size)
-                if not buf:
-                    break
-                _bytes += len(buf)
-                new_file.write(buf)
-
-            self.run_hook('store_file_end', params)
+            length = regular_file_size(fp)
+            if length is not None:
+                _bytes = new_file.upload(fp, length)
+            else:
+                _bytes = 0
+                while True:
+                    buf = fp.read(chunk_size)
+                    if not buf:
+                        break
+                    _bytes += len(buf)
+                    new_file.write(buf)
+
+            if self._hooks:
+                self.run_hook('store_file_end', params)
         finally:
             fp.close()
             new_file.close()
@@ -199,24 +397,116 @@ class Client(object):
         if self.readonly:
             return False
 
-        self.run_hook('store_content_start', key, cls, opts)
+        if self._hooks:
+            self.run_hook('store_content_start', key, cls, opts)
 
         output = self.new_file(key, cls, None, **opts)
         output.write(content)
         output.close()
 
-        self.run_hook('store_content_end', key, cls, opts)
+        if self._hooks:
+            self.run_hook('store_content_end', key, cls, opts)
 
         return len(content)
 
-    def get_paths(self, key, noverify=1, zone='alt', pathcount=2):
+    def get_paths(
+        self, key, noverify=1, zone='alt', pathcount=2, deadline=None
+    ):
         """
         Given a key, returns an array of all the locations (HTTP URLs) that the file
         has been replicated to.
+
+        With the path cache enabled, a cached answer is returned unless
+        ``noverify`` is false; the ``zone`` of cached paths is not checked.
         """
-        self.run_hook('get_paths_start', key)
+        return self._get_paths(key, noverify, zone, pathcount, deadline)[0]
 
-        params = {
+    def _get_paths(
+        self, key, noverify=1, zone='alt', pathcount=2, deadline=None
+    ):
+        """get_paths, returning (paths, whether they came from the cache)"""
+        if self._hooks:
+            self.run_hook('get_paths_start', key)
+
+        paths = self._cached_paths(key, noverify, pathcount)
+        if paths is not None:
+            if self._hooks:
+                self.run_hook('get_paths_end', key)
+            return paths, True
+
+        params = self._get_paths_args(key, noverify, zone, pathcount)
+        try:
+            res = self.backend.do_request(
+                'get_paths', params, decoder=decode_records, deadline=deadline
+            )
+        except MogileFSError, e:
+            self._cache_paths(key, pathcount, e)
+            raise
+        paths = self._cache_paths(key, pathcount, res)
+
+        if self._hooks:
+            self.run_hook('get_paths_end', key)
+        return paths, False
+
+    def get_paths_multi(
+        self,
+        keys,
+        noverify=1,
+        zone='alt',
+        pathcount=2,
+        deadline=None,
+        connections=4,
+        depth=128
+    ):
+        """
+        get_paths for many keys at once.  The lookups are pipelined over up
+        to ``connections`` tracker connections at a time, see
+        Backend.do_pipeline.
+
+        Returns a tuple of two dicts: the paths of every key found, and the
+        MogileFSError of every key that was not, e.g. ``err`` is
+        ``'unknown_key'`` for keys that do not exist.
+        """
+        found = {}
+        errors = {}
+        wanted = []
+        for key in keys:
+            if key in found or key in errors:
+                continue
+            try:
+                paths = self._cached_paths(key, noverify, pathcount)
+            except MogileFSError, e:
+                errors[key] = e
+                continue
+            if paths is None:
+                # placeholder, also skips duplicates of the key
+                found[key] = None
+                wanted.append(key)
+            else:
+                found[key] = paths
+
+        requests = [
+            ('get_paths', self._get_paths_args(key, noverify, zone, pathcount))
+            for key in wanted
+        ]
+        results = self.backend.do_pipeline(
+            requests,
+            depth=depth,
+            decoder=decode_records,
+            deadline=deadline,
+            connections=connections
+        )
+        for key, res in zip(wanted, results):
+            paths = self._cache_paths(key, pathcount, res)
+            if isinstance(res, MogileFSError):
+                del found[key]
+                errors[key] = res
+            else:
+                found[key] = paths
+        return found, errors
+
+    def _get_paths_args(self, key, noverify, zone, pathcount):
+        return {
             'domain': self.domain,
             'key': key,
             'noverify': noverify and 1 or 0,
@@ -224,18 +514,53 @@ class Client(object):
             'pathcount': pathcount
         }
 
-        res = self.backend.do_request('get_paths', params)
-        paths = [res["path%d" % x] for x in xrange(1, int(res["paths"]) + 1)]
+    def _cached_paths(self, key, noverify, pathcount):
+        """
+        The cached paths of ``key``, or None.  Raises MogileFSError if the
+        key is cached as unknown.
+        """
+        negative = self.negative_cache
+        if negative is not None:
+            errstr = negative.get((self.domain, key))
+            if errstr is not None:
+                raise MogileFSError(errstr, 'unknown_key')
+
+        cache = self.path_cache
+        if cache is not None and noverify:
+            entry = cache.get((self.domain, key))
+            # an entry fetched with a smaller pathcount may lack paths,
+            # unless the tracker returned fewer than were asked for
+            if entry is not None and (
+                entry[0] >= pathcount or len(entry[1]) < entry[0]
+            ):
+                return list(entry[1][:pathcount])
+        return None
 
-        self.run_hook('get_paths_end', key)
+    def _cache_paths(self, key, pathcount, res):
+        """
+        Caches the get_paths reply ``res`` for ``key``, or the error if it
+        is a MogileFSError, and returns the paths.
+        """
+        if isinstance(res, MogileFSError):
+            if self.negative_cache is not None and res.err == 'unknown_key':
+                self.negative_cache.set((self.domain, key), res.errstr)
+            return None
+
+        paths = res.list('path', res['paths'])
+        if self.path_cache is not None and paths:
+            self.path_cache.set((self.domain, key), (pathcount, tuple(paths)))
         return paths
 
-    def get_file_data(self, key, timeout=10):
+    def get_file_data(self, key, timeout=10, deadline=None):
         """
         Returns scalarref of file contents in a scalarref.
         Don't use for large data, as it all comes back to you in one string.
+
+        ``timeout`` bounds each storage request.  ``deadline``, in seconds,
+        bounds the whole call: tracker lookup, trying replicas and the
+        transfer.  DeadlineExceeded is raised when it runs out.
         """
-        fp = self.read_file(key)
+        fp = self.read_file(key, deadline, timeout)
         if not fp:
             return None
         try:
@@ -251,6 +576,7 @@ class Client(object):
         try:
             if self.readonly:
                 return False
+            self.invalidate_paths(key)
             self.backend.do_request(
                 'delete', {'domain': self.domain,
                            'key': key}
@@ -272,11 +598,96 @@ class Client(object):
                 'from_key': from_key,
                 'to_key': to_key
             }
+            self.invalidate_paths(from_key, to_key)
             self.backend.do_request('rename', params)
             return True
         except MogileFSError:
             return False
 
+    def delete_many(self, keys, connections=4, depth=128, batch=10000):
+        """
+        Delete many keys, pipelining the deletes over up to ``connections``
+        tracker connections at a time, see Backend.do_pipeline.  ``keys``
+        may be any iterable; it is consumed ``batch`` keys at a time.
+
+        Returns a tuple of the list of keys deleted and a dict of the
+        MogileFSError of every key that was not, e.g. ``err`` is
+        ``'unknown_key'`` for keys that did not exist.  When a tracker
+        connection fails the error is raised, and some of the keys may be
+        deleted already.  A readonly client deletes nothing and gives every
+        key the error ``'readonly'``.
+        """
+        if self.readonly:
+            return [], self._readonly_errors(keys)
+
+        def requests():
+            for key in keys:
+                self.invalidate_paths(key)
+                yield key, {'domain': self.domain, 'key': key}
+
+        return self._do_many('delete', requests(), connections, depth, batch)
+
+    def rename_many(self, pairs, connections=4, depth=128, batch=10000):
+        """
+        Rename many keys like delete_many.  ``pairs`` is an iterable of
+        ``(from_key, to_key)`` tuples.  Returns a tuple of the list of pairs
+        renamed and a dict of the MogileFSError of every pair that was not.
+        """
+        if self.readonly:
+            return [], self._readonly_errors(pairs)
+
+        def requests():
+            for from_key, to_key in pairs:
+                self.invalidate_paths(from_key, to_key)
+                yield (from_key, to_key), {
+                    'domain': self.domain,
+                    'from_key': from_key,
+                    'to_key': to_key
+                }
+
+        return self._do_many(
+            'rename', requests(), connections, depth, batch
+        )
+
+    def _readonly_errors(self, items):
+        """The errors of _do_many for items a readonly client skipped."""
+        return dict(
+            (item, MogileFSError("client is readonly", 'readonly'))
+            for item in items
+        )
+
+    def _do_many(self, cmd, requests, connections, depth, batch):
+        """_pipeline_many, sorting the items by outcome."""
+        done = []
+        errors = {}
+        for item, res in self._pipeline_many(
+            cmd, requests, connections, depth, batch
+        ):
+            if isinstance(res, MogileFSError):
+                errors[item] = res
+            else:
+                done.append(item)
+        return done, errors
+
+    def _pipeline_many(self, cmd, requests, connections, depth, batch):
+        """
+        Pipelines ``cmd`` for each ``(item, args)`` of ``requests``, ``batch``
+        at a time, and yields ``(item, reply)`` tuples; the reply is a
+        MogileFSError if the tracker answered ERR.
+        """
+        requests = iter(requests)
+        while True:
+            chunk = list(itertools.islice(requests, batch))
+            if not chunk:
+                return
+            results = self.backend.do_pipeline(
+                [(cmd, args) for _, args in chunk],
+                depth=depth,
+                connections=connections
+            )
+            for (item, _), res in zip(chunk, results):
+                yield item, res
+
     def file_debug(self, **kwargs):
         """
         Thoroughly search for any database notes about a particular fid.
@@ -318,6 +729,29 @@ class Client(object):
             info['devids'] = info['devids'].split(',')
         return info
 
+    def file_info_multi(
+        self, keys, devices=False, connections=4, depth=128, batch=10000
+    ):
+        """
+        file_info for many keys, pipelined like delete_many.  Returns a
+        tuple of a dict of FileInfo records by key and a dict of the
+        MogileFSError of every key without one, e.g. ``unknown_key``.
+        """
+        infos = {}
+        errors = {}
+        args = {'domain': self.domain}
+        if devices:
+            args['devices'] = 1
+        requests = ((key, dict(args, key=key)) for key in keys)
+        for key, res in self._pipeline_many(
+            'file_info', requests, connections, depth, batch
+        ):
+            if isinstance(res, MogileFSError):
+                errors[key] = res
+            else:
+                infos[key] = FileInfo.from_reply(res)
+        return infos, errors
+
     def list_keys(self, prefix=None, after=None, limit=None):
         """
         Used to get a list of keys matching a certain prefix.
@@ -341,38 +775,161 @@ class Client(object):
         if limit:
             params['limit'] = limit
 
-        res = self.backend.do_request('list_keys', params)
-        results = []
-        for x in xrange(1, int(res['key_count']) + 1):
-            results.append(res['key_%d' % x])
-        return results
+        res = self.backend.do_request(
+            'list_keys', params, decoder=decode_records
+        )
+        return res.list('key', res['key_count'])
 
-    def keys(self, prefix=None):
+    def _list_keys_page(self, prefix, after, limit, tracker_hint=None):
         """
-        Get all keys matching a certain prefix
+        One list_keys page as ``(keys, next_after)``, ``([], None)`` when no
+        key is left.
         """
-        params = {'domain': self.domain}
+        params = {'domain': self.domain, 'limit': limit}
         if prefix:
             params['prefix'] = prefix
-        results = []
+        if after:
+            params['after'] = after
+        try:
+            res = self.backend.do_request(
+                'list_keys',
+                params,
+                decoder=decode_records,
+                tracker_hint=tracker_hint
+            )
+        except MogileFSError, e:
+            if e.err == 'none_match':
+                return [], None
+            raise
+        return res.list('key', res['key_count']), res['next_after']
+
+    def iter_keys(self, prefix=None, page_size=1000, after=None):
+        """
+        Yields every key matching ``prefix`` in order, starting after
+        ``after``.  Keys are fetched ``page_size`` at a time, following the
+        ``next_after`` cursor of each page; one thread requests the next
+        page while the caller goes through the current one.
+        Trackers return at most 1000 keys per page.
+        """
+        page_size = min(page_size, LIST_KEYS_LIMIT)
+        # the keys from just past after, for which after is the cursor
+        lower = after and after + '\0'
+        stop = threading.Event()
+        out = Queue.Queue(1)
+        pages = self._key_pages(prefix, lower, None, page_size, None)
+        thread = threading.Thread(target=_produce, args=(pages, out, stop))
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                item = out.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                for key in item:
+                    yield key
+        finally:
+            stop.set()
+
+    def iter_keys_parallel(
+        self, prefix=None, partitions=4, ordered=True, page_size=1000
+    ):
+        """
+        Yields every key matching ``prefix`` like iter_keys, but lists
+        several ranges of keys concurrently, each preferring a different
+        tracker.
+
+        ``partitions`` is either the number of ranges, split evenly on the
+        printable ASCII character following ``prefix``, or the strings
+        following ``prefix`` where ranges start, e.g. ``'48c'`` for hex
+        keys.  With ``ordered`` the keys come in order, otherwise in
+        whatever order the pages arrive.
+        """
+        prefix = prefix or ''
+        if isinstance(partitions, (int, long)):
+            count = max(1, min(partitions, 0x60))
+            starts = [chr(0x20 + x * 0x60 // count) for x in xrange(1, count)]
+        else:
+            starts = sorted(set(p for p in partitions if p))
+        starts = [prefix + start for start in starts]
+        ranges = zip([None] + starts, starts + [None])
+        page_size = min(page_size, LIST_KEYS_LIMIT)
+
+        stop = threading.Event()
+        if ordered:
+            queues = [Queue.Queue(2) for _ in ranges]
+        else:
+            queues = [Queue.Queue(2 * len(ranges))] * len(ranges)
+
+        for index, (lower, upper) in enumerate(ranges):
+            pages = self._key_pages(prefix, lower, upper, page_size, index)
+            thread = threading.Thread(
+                target=_produce, args=(pages, queues[index], stop)
+            )
+            thread.daemon = True
+            thread.start()
+
+        try:
+            # one None per range marks its end
+            pending = len(ranges)
+            for out in ordered and queues or queues[:1]:
+                while pending:
+                    item = out.get()
+                    if item is None:
+                        pending -= 1
+                        if ordered:
+                            break
+                    elif isinstance(item, Exception):
+                        raise item
+                    else:
+                        for key in item:
+                            yield key
+        finally:
+            stop.set()
+
+    def _key_pages(self, prefix, lower, upper, page_size, tracker_hint):
+        """
+        Yields list_keys pages of the keys from ``lower`` up to, but not
+        including, ``upper``; None for either means no bound.  Pages follow
+        the ``next_after`` cursor until the tracker has no key left: it may
+        well return fewer than ``page_size`` keys before the last page.
+        """
+        after = lower and _key_before(lower)
         while True:
-            res = self.backend.do_request('list_keys', params)
-            for x in res.keys():
-                if x not in ['key_count', 'next_after']:
-                    results.append(res[x])
-            if len(res) < 1002:
-                break
-            params['after'] = res['next_after']
-        return list(set(results))
+            keys, after = self._list_keys_page(
+                prefix, after, page_size, tracker_hint
+            )
+            last = not keys or not after
+            if lower and keys and keys[0] < lower:
+                keys = [key for key in keys if key >= lower]
+            if upper and keys and keys[-1] >= upper:
+                keys = [key for key in keys if key < upper]
+                last = True
+            if keys:
+                yield keys
+            if last:
+                return
 
-    def foreach_key(self, *args, **kwds):
+    def keys(self, prefix=None):
+        """
+        Get all keys matching a certain prefix, in order.  Prefer iter_keys
+        when there may be many.
+        """
+        return list(self.iter_keys(prefix))
+
+    def foreach_key(self, callback, prefix=None, page_size=1000):
         """
         Functional interface/wrapper around list_keys.
 
-        Given some %OPTIONS (currently only one, "prefix"),
-        calls your callback for each key matching the provided prefix.
+        Calls ``callback(key)`` for each key matching ``prefix`` and returns
+        the number of keys.
         """
-        raise NotImplementedError()
+        count = 0
+        for key in self.iter_keys(prefix, page_size):
+            callback(key)
+            count += 1
+        return count
 
     def update_class(self, key, new_class):
         """
@@ -383,6 +940,7 @@ class Client(object):
             if self.readonly:
                 return False
             params = {"domain": self.domain, "key": key, "class": new_class}
+            self.invalidate_paths(key)
             res = self.backend.do_request("updateclass", params)
             return res
         except MogileFSError:
@@ -0,0 +1,60 @@
+#! coding: utf-8
+"""
+End-to-end time budgets.
+
+A Deadline is created once per user call, e.g. ``get_file_data(key,
+deadline=0.5)``, and handed down to the tracker lookup and every storage
+request the call makes.  Each blocking step then waits no longer than
+whatever is left of the budget.
+"""
+import time
+
+from pymogile.exceptions import DeadlineExceeded
+
+
+class Deadline(object):
+    """The point in time by which an operation must have finished."""
+
+    __slots__ = ('at', )
+
+    def __init__(self, seconds):
+        self.at = time.time() + seconds
+
+    def __repr__(self):
+        return '<Deadline in %.3fs>' % self.remaining()
+
+    @classmethod
+    def coerce(cls, deadline):
+        """Accepts None, a Deadline or a number of seconds from now."""
+        if deadline is None or isinstance(deadline, cls):
+            return deadline
+        try:
+            return cls(float(deadline))
+        except (TypeError, ValueError):
+            raise ValueError("deadline must be a number of seconds")
+
+    def remaining(self):
+        return self.at - time.time()
+
+    def expired(self):
+        return time.time() >= self.at
+
+    def timeout(self, cap=None):
+        """
+        Seconds the next blocking step may take: what is left of the
+        budget, no more than ``cap``.  Raises DeadlineExceeded once the
+        budget is spent.
+        """
+        remaining = self.at - time.time()
+        if remaining <= 0:
+            raise DeadlineExceeded("deadline exceeded")
+        if cap is not None and cap < remaining:
+            return cap
+        return remaining
+
+
+def timeout_for(deadline, cap):
+    """``cap`` when there is no deadline, else deadline.timeout(cap)."""
+    if deadline is None:
+        return cap
+    return deadline.timeout(cap)
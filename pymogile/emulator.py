@@ -0,0 +1,1055 @@
+#! coding: utf-8
+"""
+In-process MogileFS emulator.
+
+Runs trackers speaking the mogilefsd line protocol and storage nodes
+speaking enough WebDAV (PUT, GET, HEAD, MKCOL, DELETE, MOVE, ranges) for
+the client, in background threads of the current process:
+
+    with Emulator(nodes=3) as emu:
+        client = Client('testdomain', emu.trackers)
+        client.store_content('key', 'data')
+
+Every tracker and storage node has a Faults object to add latency, cap
+bandwidth and inject errors or dropped connections, so tests and
+benchmarks can run without a real cluster.  ``python -m
+pymogile.emulator --port 7001`` serves one from the command line.
+"""
+import sys
+import time
+import socket
+import random
+import urllib
+import urlparse
+import logging
+import threading
+import SocketServer
+import BaseHTTPServer
+from optparse import OptionParser
+
+LOG = logging.getLogger("MogileFS Emulator")
+
+# bodies are streamed in pieces of this size so bandwidth caps are smooth
+CHUNK_SIZE = 64 * 1024
+
+
+class Faults(object):
+    """
+    What goes wrong with one emulated server.
+
+    ``latency`` is added before every answer, in seconds or as a ``(low,
+    high)`` range to draw from.  ``bandwidth`` caps request and response
+    bodies in bytes per second.  ``error_rate`` and ``drop_rate`` are the
+    odds that a request is answered with an error, or that its connection
+    is closed without an answer.  fail_next() forces the next failures.
+    """
+
+    def __init__(
+        self,
+        latency=0,
+        bandwidth=None,
+        error_rate=0,
+        drop_rate=0,
+        seed=None
+    ):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.requests = 0
+        self.injected = 0
+        self._forced = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<Faults latency=%r bandwidth=%r error_rate=%r drop_rate=%r>' % (
+            self.latency, self.bandwidth, self.error_rate, self.drop_rate
+        )
+
+    def fail_next(self, count=1, how='error'):
+        """Make the next ``count`` requests fail with 'error' or 'drop'."""
+        if how not in ('error', 'drop'):
+            raise ValueError("how must be 'error' or 'drop'")
+        with self._lock:
+            self._forced.extend([how] * count)
+
+    def reset(self):
+        with self._lock:
+            self.latency = 0
+            self.bandwidth = None
+            self.error_rate = self.drop_rate = 0
+            del self._forced[:]
+
+    def outcome(self):
+        """None for a normal answer, else 'error' or 'drop'."""
+        with self._lock:
+            self.requests += 1
+            if self._forced:
+                how = self._forced.pop(0)
+            else:
+                roll = self._random.random()
+                if roll < self.drop_rate:
+                    how = 'drop'
+                elif roll < self.drop_rate + self.error_rate:
+                    how = 'error'
+                else:
+                    return None
+            self.injected += 1
+            return how
+
+    def delay(self):
+        latency = self.latency
+        if isinstance(latency, (tuple, list)):
+            with self._lock:
+                latency = self._random.uniform(*latency)
+        if latency > 0:
+            time.sleep(latency)
+
+    def throttle(self, nbytes):
+        if self.bandwidth:
+            time.sleep(float(nbytes) / self.bandwidth)
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address, handler):
+        SocketServer.TCPServer.__init__(self, address, handler)
+        self.faults = Faults()
+        self._conns = set()
+        self._conns_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def address(self):
+        return '%s:%d' % self.server_address
+
+    def start(self):
+        # poll often so stop() returns quickly
+        self._thread = threading.Thread(
+            target=self.serve_forever, args=(0.05, )
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        # wake up handlers blocked on kept-alive connections
+        with self._conns_lock:
+            for sock in self._conns:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            self._conns.clear()
+
+    def track(self, sock, add=True):
+        with self._conns_lock:
+            if add:
+                self._conns.add(sock)
+            else:
+                self._conns.discard(sock)
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], socket.error):
+            LOG.exception("emulator error serving %s", client_address)
+
+
+class _Error(Exception):
+    def __init__(self, code, message=None):
+        Exception.__init__(self, code)
+        self.code = code
+        self.message = message or code.replace('_', ' ')
+
+
+def _ok(args=None):
+    if not args:
+        return 'OK \r\n'
+    return 'OK %s\r\n' % '&'.join(
+        '%s=%s' % (urllib.quote_plus(str(k)), urllib.quote_plus(str(v)))
+        for k, v in args.iteritems()
+    )
+
+
+def _err(code, message):
+    return 'ERR %s %s\r\n' % (code, urllib.quote_plus(message))
+
+
+def _fid_path(devid, fid):
+    fid = '%010d' % fid
+    return '/dev%d/%s/%s/%s/%s.fid' % (devid, fid[0], fid[1:4], fid[4:7], fid)
+
+
+class _File(object):
+    __slots__ = ('fid', 'domain', 'key', 'cls', 'length', 'devids')
+
+    def __init__(self, fid, domain, key, cls, length=0, devids=None):
+        self.fid = fid
+        self.domain = domain
+        self.key = key
+        self.cls = cls
+        self.length = length
+        self.devids = devids or []
+
+
+class Cluster(object):
+    """
+    The metadata every emulated tracker shares: domains and classes,
+    hosts and devices, files, and server settings.  Storage nodes attached
+    with add_node() hold the file contents.
+    """
+
+    def __init__(self, seed=None, replicate=True):
+        self.replicate = replicate
+        self.domains = {}
+        self.hosts = {}
+        self.devices = {}
+        self.settings = {'schema_version': '15'}
+        self._files = {}
+        self._fids = {}
+        self._open = {}
+        self._nodes = {}
+        self._next_fid = 1
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+
+    def add_node(self, node, devices=1, hostname=None):
+        """Register a StorageNode as a host with ``devices`` devices."""
+        with self._lock:
+            hostid = len(self.hosts) + 1
+            ip, port = node.server_address
+            self.hosts[hostid] = {
+                'hostid': hostid,
+                'hostname': hostname or 'node%d' % hostid,
+                'hostip': ip,
+                'http_port': port,
+                'status': 'alive',
+            }
+            self._nodes[hostid] = node
+            for _ in xrange(devices):
+                devid = len(self.devices) + 1
+                self.devices[devid] = {
+                    'devid': devid,
+                    'hostid': hostid,
+                    'status': 'alive',
+                    'weight': 100,
+                    'mb_total': 100000,
+                }
+                node.add_device(devid)
+            return hostid
+
+    def dispatch(self, line):
+        """Answer one request line with a reply line."""
+        cmd, _, rest = line.strip().partition(' ')
+        args = dict(urlparse.parse_qsl(rest, keep_blank_values=True))
+        handler = getattr(self, 'cmd_' + cmd, None)
+        if handler is None:
+            return _err('unknown_command', 'Unknown server command')
+        try:
+            with self._lock:
+                return _ok(handler(args))
+        except _Error, e:
+            return _err(e.code, e.message)
+        except (KeyError, ValueError), e:
+            return _err('invalid_args', 'bad arguments: %s' % e)
+
+    # -- domains and classes
+
+    def _domain(self, args):
+        domain = args.get('domain')
+        if domain not in self.domains:
+            raise _Error('unreg_domain', 'Domain name invalid/not found')
+        return domain
+
+    def cmd_create_domain(self, args):
+        domain = args['domain']
+        if domain in self.domains:
+            raise _Error('domain_exists', 'That domain already exists')
+        self.domains[domain] = {'default': 2}
+        return {'domain': domain}
+
+    def cmd_delete_domain(self, args):
+        domain = args.get('domain')
+        if domain not in self.domains:
+            raise _Error('domain_not_found', 'Domain not found')
+        for d, _ in self._files:
+            if d == domain:
+                raise _Error('domain_has_files', 'Domain still has files')
+        del self.domains[domain]
+        return {'domain': domain}
+
+    def cmd_get_domains(self, args):
+        res = {'domains': len(self.domains)}
+        for i, domain in enumerate(sorted(self.domains), 1):
+            classes = self.domains[domain]
+            res['domain%d' % i] = domain
+            res['domain%dclasses' % i] = len(classes)
+            for j, cls in enumerate(sorted(classes), 1):
+                res['domain%dclass%dname' % (i, j)] = cls
+                res['domain%dclass%dmindevcount' % (i, j)] = classes[cls]
+        return res
+
+    def cmd_create_class(self, args):
+        domain = self._domain(args)
+        cls = args['class']
+        if cls in self.domains[domain]:
+            raise _Error('class_exists', 'That class already exists')
+        self.domains[domain][cls] = int(args.get('mindevcount') or 2)
+        return {'domain': domain, 'class': cls,
+                'mindevcount': self.domains[domain][cls]}
+
+    def cmd_update_class(self, args):
+        domain = self._domain(args)
+        cls = args['class']
+        if cls not in self.domains[domain]:
+            raise _Error('class_not_found', 'Class not found')
+        self.domains[domain][cls] = int(args.get('mindevcount') or 2)
+        return {'domain': domain, 'class': cls,
+                'mindevcount': self.domains[domain][cls]}
+
+    def cmd_delete_class(self, args):
+        domain = self._domain(args)
+        cls = args['class']
+        if cls not in self.domains[domain] or cls == 'default':
+            raise _Error('class_not_found', 'Class not found')
+        for f in self._fids.itervalues():
+            if f.domain == domain and f.cls == cls:
+                raise _Error('class_has_files', 'Class still has files')
+        del self.domains[domain][cls]
+        return {'domain': domain, 'class': cls}
+
+    # -- hosts and devices
+
+    def _host(self, name):
+        for host in self.hosts.itervalues():
+            if host['hostname'] == name:
+                return host
+        raise _Error('unknown_host', 'Host not found')
+
+    def cmd_create_host(self, args):
+        name = args['host']
+        if any(h['hostname'] == name for h in self.hosts.itervalues()):
+            raise _Error('host_exists', 'That host already exists')
+        hostid = max(self.hosts or [0]) + 1
+        self.hosts[hostid] = {
+            'hostid': hostid,
+            'hostname': name,
+            'hostip': args.get('ip', ''),
+            'http_port': int(args.get('port') or 7500),
+            'status': args.get('status') or 'down',
+        }
+        return self.hosts[hostid]
+
+    def cmd_update_host(self, args):
+        host = self._host(args['host'])
+        for arg, field in (('ip', 'hostip'), ('port', 'http_port'),
+                           ('status', 'status')):
+            if args.get(arg):
+                host[field] = args[arg]
+        return host
+
+    def cmd_delete_host(self, args):
+        host = self._host(args['host'])
+        if any(d['hostid'] == host['hostid']
+               for d in self.devices.itervalues()):
+            raise _Error('host_not_empty', 'Host still has devices')
+        del self.hosts[host['hostid']]
+        return {}
+
+    def cmd_get_hosts(self, args):
+        hosts = sorted(self.hosts)
+        if args.get('hostid'):
+            hosts = [int(args['hostid'])]
+        res = {'hosts': len(hosts)}
+        for i, hostid in enumerate(hosts, 1):
+            for field, value in self.hosts[hostid].iteritems():
+                res['host%d_%s' % (i, field)] = value
+        return res
+
+    def cmd_create_device(self, args):
+        host = self._host(args['hostname'])
+        devid = int(args['devid'])
+        if devid in self.devices:
+            raise _Error('existing_devid', 'That device already exists')
+        self.devices[devid] = {
+            'devid': devid,
+            'hostid': host['hostid'],
+            'status': args.get('state') or 'alive',
+            'weight': 100,
+            'mb_total': 100000,
+        }
+        return {}
+
+    def _device(self, args):
+        devid = int(args['device'])
+        if devid not in self.devices:
+            raise _Error('unknown_device', 'Device not found')
+        return self.devices[devid]
+
+    def cmd_set_state(self, args):
+        self._device(args)['status'] = args['state']
+        return {}
+
+    def cmd_set_weight(self, args):
+        self._device(args)['weight'] = int(args['weight'])
+        return {}
+
+    def cmd_get_devices(self, args):
+        devids = sorted(self.devices)
+        if args.get('devid'):
+            devids = [int(args['devid'])]
+        res = {'devices': len(devids)}
+        for i, devid in enumerate(devids, 1):
+            dev = self.devices[devid]
+            used = self._used_mb(devid)
+            fields = dict(dev)
+            fields.update({
+                'observed_state': 'writeable',
+                'mb_used': used,
+                'utilization': '%.2f' % (100.0 * used / dev['mb_total']),
+            })
+            for field, value in fields.iteritems():
+                res['dev%d_%s' % (i, field)] = value
+        return res
+
+    def _used_mb(self, devid):
+        used = sum(f.length for f in self._fids.itervalues()
+                   if devid in f.devids)
+        return used // (1024 * 1024)
+
+    def _writable(self):
+        devids = [
+            devid for devid, dev in self.devices.iteritems()
+            if dev['status'] == 'alive' and dev['hostid'] in self._nodes
+            and self.hosts[dev['hostid']]['status'] == 'alive'
+        ]
+        self._random.shuffle(devids)
+        return devids
+
+    def _url(self, devid, fid):
+        host = self.hosts[self.devices[devid]['hostid']]
+        return 'http://%s:%s%s' % (
+            host['hostip'], host['http_port'], _fid_path(devid, fid)
+        )
+
+    def _node(self, devid):
+        return self._nodes.get(self.devices[devid]['hostid'])
+
+    # -- files
+
+    def _file(self, args):
+        domain = self._domain(args)
+        f = self._files.get((domain, args.get('key')))
+        if f is None:
+            raise _Error('unknown_key', 'unknown_key')
+        return f
+
+    def cmd_create_open(self, args):
+        domain = self._domain(args)
+        cls = args.get('class') or 'default'
+        if cls not in self.domains[domain]:
+            raise _Error('unreg_class', 'Class name invalid/not found')
+        devids = self._writable()[:3]
+        if not devids:
+            raise _Error('no_devices', 'No devices available')
+        fid = int(args.get('fid') or 0)
+        if not fid:
+            fid = self._next_fid
+            self._next_fid += 1
+        self._open[fid] = _File(fid, domain, args.get('key'), cls)
+        if not int(args.get('multi_dest') or 0):
+            devids = devids[:1]
+            return {'fid': fid, 'devid': devids[0],
+                    'path': self._url(devids[0], fid)}
+        res = {'fid': fid, 'dev_count': len(devids)}
+        for i, devid in enumerate(devids, 1):
+            res['devid_%d' % i] = devid
+            res['path_%d' % i] = self._url(devid, fid)
+        return res
+
+    def cmd_create_close(self, args):
+        fid = int(args['fid'])
+        f = self._open.pop(fid, None)
+        if f is None:
+            raise _Error('no_temp_file', 'No tempfile or file already closed')
+        devid = int(args['devid'])
+        node = self._node(devid)
+        size = node and node.size(_fid_path(devid, fid))
+        if size is None:
+            raise _Error('missing_file', 'File not found on storage node')
+        if args.get('size') not in (None, '') and int(args['size']) != size:
+            raise _Error('size_mismatch', 'Size mismatch on close')
+        f.length = size
+        f.devids = [devid]
+        old = self._files.get((f.domain, f.key))
+        if old is not None:
+            self._remove(old)
+        self._files[(f.domain, f.key)] = f
+        self._fids[fid] = f
+        if self.replicate:
+            self._replicate(f)
+        return {}
+
+    def _replicate(self, f):
+        """Copy ``f`` at once to as many devices as its class asks for."""
+        wanted = self.domains[f.domain].get(f.cls, 2)
+        source = self._node(f.devids[0])
+        data = source.read(_fid_path(f.devids[0], f.fid))
+        hosts = set(self.devices[d]['hostid'] for d in f.devids)
+        candidates = self._writable()
+        # prefer devices on hosts that have no copy yet
+        candidates.sort(key=lambda d: self.devices[d]['hostid'] in hosts)
+        for devid in candidates:
+            if len(f.devids) >= wanted:
+                break
+            if devid in f.devids:
+                continue
+            self._node(devid).write(_fid_path(devid, f.fid), data)
+            f.devids.append(devid)
+
+    def _remove(self, f):
+        for devid in f.devids:
+            node = self._node(devid)
+            if node is not None:
+                node.delete(_fid_path(devid, f.fid))
+        del self._files[(f.domain, f.key)]
+        del self._fids[f.fid]
+
+    def cmd_get_paths(self, args):
+        f = self._file(args)
+        devids = [
+            d for d in f.devids
+            if self.devices[d]['status'] in ('alive', 'drain')
+            and self.hosts[self.devices[d]['hostid']]['status'] == 'alive'
+        ]
+        self._random.shuffle(devids)
+        pathcount = int(args.get('pathcount') or 2)
+        devids = devids[:max(pathcount, 1)]
+        res = {'paths': len(devids)}
+        for i, devid in enumerate(devids, 1):
+            res['path%d' % i] = self._url(devid, f.fid)
+        return res
+
+    def cmd_delete(self, args):
+        self._remove(self._file(args))
+        return {}
+
+    def cmd_rename(self, args):
+        domain = self._domain(args)
+        f = self._files.get((domain, args['from_key']))
+        if f is None:
+            raise _Error('unknown_key', 'unknown_key')
+        if (domain, args['to_key']) in self._files:
+            raise _Error('key_exists', 'Target key name already exists')
+        del self._files[(domain, f.key)]
+        f.key = args['to_key']
+        self._files[(domain, f.key)] = f
+        return {}
+
+    def cmd_updateclass(self, args):
+        f = self._file(args)
+        cls = args['class']
+        if cls not in self.domains[f.domain]:
+            raise _Error('class_not_found', 'Class not found')
+        f.cls = cls
+        if self.replicate:
+            self._replicate(f)
+        return {}
+
+    def cmd_file_info(self, args):
+        f = self._file(args)
+        res = {
+            'fid': f.fid,
+            'domain': f.domain,
+            'class': f.cls,
+            'key': f.key,
+            'length': f.length,
+            'devcount': len(f.devids),
+        }
+        if args.get('devices'):
+            res['devids'] = ','.join(str(d) for d in f.devids)
+        return res
+
+    def cmd_file_debug(self, args):
+        if args.get('fid'):
+            f = self._fids.get(int(args['fid']))
+            if f is None:
+                raise _Error('unknown_fid', 'Fid not found')
+        else:
+            f = self._file(args)
+        res = {
+            'fid_fid': f.fid,
+            'fid_dmid': f.domain,
+            'fid_dkey': f.key,
+            'fid_length': f.length,
+            'fid_classid': f.cls,
+            'fid_devcount': len(f.devids),
+            'devids': ','.join(str(d) for d in f.devids),
+        }
+        return res
+
+    def cmd_list_keys(self, args):
+        domain = self._domain(args)
+        prefix = args.get('prefix', '')
+        after = args.get('after', '')
+        limit = min(int(args.get('limit') or 1000), 1000)
+        keys = sorted(
+            k for d, k in self._files
+            if d == domain and k.startswith(prefix) and k > after
+        )[:limit]
+        if not keys:
+            raise _Error('none_match', 'No keys match that pattern')
+        res = {'key_count': len(keys), 'next_after': keys[-1]}
+        for i, key in enumerate(keys, 1):
+            res['key_%d' % i] = key
+        return res
+
+    def cmd_list_fids(self, args):
+        low, high = int(args['from']), int(args['to'])
+        fids = sorted(fid for fid in self._fids if low <= fid <= high)[:1000]
+        res = {'fid_count': len(fids)}
+        for i, fid in enumerate(fids, 1):
+            f = self._fids[fid]
+            res.update({
+                'fid_%d_fid' % i: fid,
+                'fid_%d_key' % i: f.key,
+                'fid_%d_domain' % i: f.domain,
+                'fid_%d_class' % i: f.cls,
+                'fid_%d_length' % i: f.length,
+                'fid_%d_devcount' % i: len(f.devids),
+            })
+        return res
+
+    def cmd_stats(self, args):
+        files = {}
+        for f in self._fids.itervalues():
+            key = (f.domain, f.cls)
+            files[key] = files.get(key, 0) + 1
+        res = {'filescount': len(files), 'fidmax': self._next_fid - 1}
+        for i, (key, count) in enumerate(sorted(files.items()), 1):
+            res['files%d_domain' % i], res['files%d_class' % i] = key
+            res['files%d_files' % i] = count
+        res['devicescount'] = len(self.devices)
+        for i, devid in enumerate(sorted(self.devices), 1):
+            dev = self.devices[devid]
+            res['devices%d_id' % i] = devid
+            res['devices%d_host' % i] = self.hosts[dev['hostid']]['hostname']
+            res['devices%d_status' % i] = dev['status']
+            res['devices%d_files' % i] = sum(
+                1 for f in self._fids.itervalues() if devid in f.devids
+            )
+        return res
+
+    # -- server settings and housekeeping
+
+    def cmd_server_setting(self, args):
+        key = args['key']
+        if key not in self.settings:
+            return {}
+        return {'key': key, 'value': self.settings[key]}
+
+    def cmd_server_settings(self, args):
+        res = {'key_count': len(self.settings)}
+        for i, key in enumerate(sorted(self.settings), 1):
+            res['key_%d' % i] = key
+            res['value_%d' % i] = self.settings[key]
+        return res
+
+    def cmd_set_server_setting(self, args):
+        self.settings[args['key']] = args.get('value', '')
+        return {}
+
+    def cmd_sleep(self, args):
+        # sleep without holding up the other trackers
+        self._lock.release()
+        try:
+            time.sleep(min(float(args.get('duration') or 0), 10))
+        finally:
+            self._lock.acquire()
+        return {}
+
+    def cmd_noop(self, args):
+        return {}
+
+    def cmd_clear_cache(self, args):
+        return {}
+
+    def cmd_replicate_now(self, args):
+        return {'count': 0}
+
+    def cmd_fsck_start(self, args):
+        return {}
+
+    def cmd_fsck_stop(self, args):
+        return {}
+
+    def cmd_fsck_reset(self, args):
+        return {}
+
+    def cmd_fsck_clearlog(self, args):
+        return {}
+
+    def cmd_fsck_status(self, args):
+        return {'running': 0, 'host': '', 'max_fid_checked': 0}
+
+    def cmd_fsck_getlog(self, args):
+        return {'row_count': 0}
+
+
+class _TrackerHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        server.track(self.connection)
+        try:
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                outcome = server.faults.outcome()
+                server.faults.delay()
+                if outcome == 'drop':
+                    return
+                elif outcome == 'error':
+                    reply = _err('emulated_failure', 'Injected failure')
+                else:
+                    reply = server.cluster.dispatch(line)
+                self.wfile.write(reply)
+        finally:
+            server.track(self.connection, False)
+
+
+class TrackerServer(_Server):
+    """An emulated mogilefsd answering from a shared Cluster."""
+
+    def __init__(self, cluster, host='127.0.0.1', port=0):
+        _Server.__init__(self, (host, port), _TrackerHandler)
+        self.cluster = cluster
+
+
+class _StorageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'pymogile-emulator'
+    # the status line and every header go out in their own write; on a
+    # kept-alive connection Nagle would hold them for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, fmt, *args):
+        LOG.debug(fmt, *args)
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.track(self.connection)
+
+    def finish(self):
+        self.server.track(self.connection, False)
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def _begin(self):
+        """Apply the node's faults; False when the request is handled."""
+        faults = self.server.faults
+        outcome = faults.outcome()
+        faults.delay()
+        if outcome is None:
+            return True
+        self.close_connection = 1
+        if outcome == 'error':
+            self._reply(500, 'emulated failure\n')
+        return False
+
+    def _reply(self, status, body='', headers=None, send_body=True):
+        self.send_response(status)
+        for name, value in (headers or {}).iteritems():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        if send_body and body:
+            faults = self.server.faults
+            for i in xrange(0, len(body), CHUNK_SIZE):
+                chunk = body[i:i + CHUNK_SIZE]
+                faults.throttle(len(chunk))
+                self.wfile.write(chunk)
+
+    def _read_body(self):
+        faults = self.server.faults
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            parts = []
+            while True:
+                size = int(self.rfile.readline().split(';')[0].strip(), 16)
+                if not size:
+                    # trailers end with a blank line
+                    while self.rfile.readline().strip():
+                        pass
+                    break
+                parts.append(self.rfile.read(size))
+                self.rfile.readline()
+                faults.throttle(size)
+            return ''.join(parts)
+        length = int(self.headers.get('Content-Length') or 0)
+        parts = []
+        while length > 0:
+            chunk = self.rfile.read(min(length, CHUNK_SIZE))
+            if not chunk:
+                break
+            faults.throttle(len(chunk))
+            parts.append(chunk)
+            length -= len(chunk)
+        return ''.join(parts)
+
+    @property
+    def _path(self):
+        return urlparse.urlsplit(self.path).path
+
+    def do_PUT(self):
+        body = self._read_body()
+        if not self._begin():
+            return
+        node = self.server
+        path = self._path
+        if node.require_mkcol and not node.has_dir(path.rsplit('/', 1)[0]):
+            return self._reply(403, 'parent collection does not exist\n')
+        offset = None
+        content_range = self.headers.get('Content-Range')
+        if content_range:
+            offset = int(content_range.split()[-1].split('-')[0])
+        created = node.write(path, body, offset)
+        self._reply(created and 201 or 204)
+
+    def _send_file(self, send_body):
+        if not self._begin():
+            return
+        data = self.server.read(self._path)
+        if data is None:
+            return self._reply(404, 'not found\n', send_body=send_body)
+        size = len(data)
+        ranges = self.headers.get('Range', '')
+        if not ranges.startswith('bytes='):
+            return self._reply(200, data, send_body=send_body)
+        first, _, last = ranges[6:].split(',')[0].partition('-')
+        if first:
+            start = int(first)
+            end = last and min(int(last), size - 1) or size - 1
+        else:
+            start, end = max(size - int(last), 0), size - 1
+        if start >= size or start > end:
+            return self._reply(
+                416, '', {'Content-Range': 'bytes */%d' % size},
+                send_body=send_body
+            )
+        self._reply(
+            206, data[start:end + 1],
+            {'Content-Range': 'bytes %d-%d/%d' % (start, end, size)},
+            send_body=send_body
+        )
+
+    def do_GET(self):
+        self._send_file(True)
+
+    def do_HEAD(self):
+        self._send_file(False)
+
+    def do_MKCOL(self):
+        self._read_body()
+        if not self._begin():
+            return
+        if not self.server.make_dir(self._path):
+            return self._reply(405, 'collection exists\n')
+        self._reply(201)
+
+    def do_DELETE(self):
+        if not self._begin():
+            return
+        self._reply(self.server.delete(self._path) and 204 or 404)
+
+    def do_MOVE(self):
+        if not self._begin():
+            return
+        target = urlparse.urlsplit(self.headers.get('Destination', '')).path
+        data = self.server.read(self._path)
+        if data is None or not target:
+            return self._reply(404, 'not found\n')
+        self.server.write(target, data)
+        self.server.delete(self._path)
+        self._reply(201)
+
+
+class StorageNode(_Server):
+    """
+    An emulated storage node keeping files in memory.  With
+    ``require_mkcol`` a PUT into a missing directory is refused with 403,
+    like a plain WebDAV server, instead of creating it like mogstored.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, require_mkcol=False):
+        _Server.__init__(self, (host, port), _StorageHandler)
+        self.require_mkcol = require_mkcol
+        self.files = {}
+        self._dirs = set()
+        self._lock = threading.Lock()
+
+    def add_device(self, devid):
+        with self._lock:
+            self._dirs.add('/dev%d' % devid)
+
+    def has_dir(self, path):
+        with self._lock:
+            return path.rstrip('/') in self._dirs
+
+    def make_dir(self, path):
+        path = path.rstrip('/')
+        with self._lock:
+            if path in self._dirs:
+                return False
+            self._dirs.add(path)
+            return True
+
+    def size(self, path):
+        with self._lock:
+            data = self.files.get(path)
+            if data is None:
+                return None
+            return len(data)
+
+    def read(self, path):
+        with self._lock:
+            data = self.files.get(path)
+            if data is None:
+                return None
+            return str(data)
+
+    def write(self, path, data, offset=None):
+        """Store ``data``, at ``offset`` for a partial PUT.  True if new."""
+        with self._lock:
+            created = path not in self.files
+            if offset is None or created:
+                current = self.files[path] = bytearray(offset or 0)
+            else:
+                current = self.files[path]
+            offset = offset or 0
+            if len(current) < offset:
+                current.extend('\0' * (offset - len(current)))
+            current[offset:offset + len(data)] = data
+            self._dirs.add(path.rsplit('/', 1)[0])
+            return created
+
+    def delete(self, path):
+        with self._lock:
+            return self.files.pop(path, None) is not None
+
+
+class Emulator(object):
+    """
+    A whole emulated cluster: ``trackers`` tracker servers sharing one
+    Cluster, and ``nodes`` storage nodes with ``devices`` devices each.
+    The domains in ``domains`` are created up front.  ``port`` is where
+    the first tracker listens, any free port by default.
+    """
+
+    def __init__(
+        self,
+        nodes=2,
+        devices=1,
+        trackers=1,
+        domains=('testdomain', ),
+        host='127.0.0.1',
+        port=0,
+        require_mkcol=False,
+        replicate=True,
+        seed=None
+    ):
+        self.cluster = Cluster(seed, replicate)
+        self.nodes = []
+        self.tracker_servers = []
+        self._host = host
+        self._port = port
+        self._counts = (nodes, devices, trackers)
+        self._require_mkcol = require_mkcol
+        for domain in domains:
+            self.cluster.cmd_create_domain({'domain': domain})
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def trackers(self):
+        """Tracker addresses for Client and Admin."""
+        return [t.address for t in self.tracker_servers]
+
+    def start(self):
+        nodes, devices, trackers = self._counts
+        for _ in xrange(nodes):
+            node = StorageNode(self._host, 0, self._require_mkcol)
+            self.cluster.add_node(node, devices)
+            node.start()
+            self.nodes.append(node)
+        for i in xrange(trackers):
+            port = i == 0 and self._port or 0
+            tracker = TrackerServer(self.cluster, self._host, port)
+            tracker.start()
+            self.tracker_servers.append(tracker)
+        return self
+
+    def stop(self):
+        for server in self.tracker_servers + self.nodes:
+            server.stop()
+        self.tracker_servers = []
+        self.nodes = []
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option(
+        '--port',
+        type='int',
+        default=7001,
+        help='port of the first tracker, 0 for any'
+    )
+    parser.add_option('--trackers', type='int', default=1)
+    parser.add_option('--nodes', type='int', default=2)
+    parser.add_option(
+        '--devices', type='int', default=1, help='devices per storage node'
+    )
+    parser.add_option(
+        '--latency', type='float', default=0,
+        help='seconds added to every storage request'
+    )
+    parser.add_option(
+        '--bandwidth', type='int', help='storage node bytes per second'
+    )
+    parser.add_option(
+        '--domain', action='append', default=[], help='create this domain'
+    )
+    options, _ = parser.parse_args(argv)
+
+    emulator = Emulator(
+        options.nodes, options.devices, options.trackers, options.domain,
+        options.host, options.port
+    ).start()
+    for node in emulator.nodes:
+        node.faults.latency = options.latency
+        node.faults.bandwidth = options.bandwidth
+    print 'trackers: %s' % ' '.join(emulator.trackers)
+    print 'storage nodes: %s' % ' '.join(n.address for n in emulator.nodes)
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        emulator.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -23,3 +23,11 @@ class HTTPError(Exception):
 
     def __str__(self):
         return 'HTTP Error %d, %s' % (self.code, self.content)
+
+
+class DeadlineExceeded(MogileFSError):
+    def __init__(self, errstr):
+        MogileFSError.__init__(self, errstr, 'deadline_exceeded')
+
+    def __repr__(self):
+        return '<pymogile.exceptions.DeadlineExceeded: %s>' % self.errstr
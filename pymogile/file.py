@@ -1,11 +1,20 @@
 #! coding: utf-8
 import put
+import time
+import socket
+import tempfile
 import logging
 import httplib
 import urlparse
-from cStringIO import StringIO
 
-from pymogile.exceptions import MogileFSError, HTTPError
+from pymogile.deadline import timeout_for
+from pymogile.httppool import default_pool
+from pymogile.exceptions import MogileFSError, HTTPError, DeadlineExceeded
+
+# bytes NormalHTTPFile keeps in memory before spilling to a temporary file
+SPOOL_SIZE = 8 << 20
+# bytes LargeHTTPFile collects from sequential writes before one PUT
+WRITE_BUFFER = 4 << 20
 
 
 def is_success(response):
@@ -20,12 +29,25 @@ def get_content_length(response):
 
 
 class HTTPFile(object):
-    def __init__(self, mg, fid, key, cls, create_close_arg=None):
+    def __init__(
+        self,
+        mg,
+        fid,
+        key,
+        cls,
+        create_close_arg=None,
+        timeout=None,
+        deadline=None
+    ):
         self.mg = mg
         self.fid = fid
         self.key = key
         self.cls = cls
         self.create_close_arg = create_close_arg or {}
+        if timeout is None and mg is not None:
+            timeout = getattr(mg, 'http_timeout', None)
+        self.timeout = timeout
+        self.deadline = deadline
         self._is_closed = False
 
     def __enter__(self):
@@ -43,13 +65,82 @@ class HTTPFile(object):
             except Exception, e:
                 logging.debug("got an exception in __del__: %s" % str(e))
 
+    def _http(self, scheme, netloc, method, target, path, *args, **kwds):
+        """
+        Do one HTTP exchange with a storage node over a pooled connection,
+        running the ``http_request_*`` hooks of the client when it has any.
+        """
+        hooks = self.mg is not None and self.mg._hooks
+        if hooks:
+            start = time.time()
+            self.mg.run_hook(
+                'http_request_start', method, path, 0, 0, 0.0, start
+            )
+
+        def send(conn):
+            conn.request(method, target, *args, **kwds)
+            return conn.getresponse()
+
+        try:
+            res = self._pool().exchange(
+                scheme, netloc, send, timeout=self._timeout()
+            )
+        except Exception, e:
+            if hooks:
+                self._run_http_hook(
+                    'http_request_error', method, path, args, kwds, None, start
+                )
+            if isinstance(e, socket.timeout) and self._expired():
+                raise DeadlineExceeded(
+                    "deadline exceeded during %s %s" % (method, path)
+                )
+            raise
+
+        if hooks:
+            self._run_http_hook(
+                'http_request_finished', method, path, args, kwds, res, start
+            )
+        return res
+
+    def _pool(self):
+        return getattr(self.mg, 'http_pool', None) or default_pool
+
+    def _timeout(self):
+        """Socket timeout for the next storage request."""
+        timeout = timeout_for(self.deadline, self.timeout)
+        if timeout is None:
+            return socket.getdefaulttimeout()
+        return timeout
+
+    def _expired(self):
+        return self.deadline is not None and self.deadline.expired()
+
+    def _run_http_hook(self, hookname, method, path, args, kwds, res, start):
+        body = args and args[0] or kwds.get('body')
+        sent = isinstance(body, basestring) and len(body) or 0
+        try:
+            received = int(res.getheader('content-length'))
+        except (AttributeError, TypeError, ValueError):
+            received = 0
+        now = time.time()
+        self.mg.run_hook(
+            hookname, method, path, sent, received, now - start, now
+        )
+
+    def _create_close(self, params):
+        """Commits the file, so the key now points at its fid."""
+        try:
+            self.mg.backend.do_request('create_close', params)
+        except MogileFSError, e:
+            if e.err != 'empty_file':
+                raise
+        finally:
+            # readers may have cached the paths of the previous fid
+            self.mg.invalidate_paths(self.key)
+
     def _makedirs(self, path):
         url = urlparse.urlsplit(path)
-        if url.scheme == 'http':
-            connection = httplib.HTTPConnection
-        elif url.scheme == 'https':
-            connection = httplib.HTTPSConnection
-        else:
+        if url.scheme not in ('http', 'https'):
             raise ValueError("unsupported url scheme")
 
         # MogileFS file path usually looks like
@@ -77,9 +168,9 @@ class HTTPFile(object):
             # /dev1/0/000/
             # /dev1/0/000/000/
             parent = "/".join(elements[:idx]) + "/"
-            conn = connection(url.netloc)
-            conn.request("MKCOL", parent)
-            res = conn.getresponse()
+            res = self._http(url.scheme, url.netloc, "MKCOL", parent, path)
+            # frees the connection for the next one
+            res.read()
             if res.status >= 200 and res.status < 300:
                 created = idx == length
             elif res.status >= 400 and res.status < 500:
@@ -93,32 +184,31 @@ class HTTPFile(object):
 
     def _request(self, path, method, *args, **kwds):
         url = urlparse.urlsplit(path)
-        if url.scheme == 'http':
-            connection = httplib.HTTPConnection
-        elif url.scheme == 'https':
-            connection = httplib.HTTPSConnection
-        elif not url.scheme:
+        if not url.scheme:
             raise ValueError("url scheme is empty")
-        else:
+        elif url.scheme not in ('http', 'https'):
             raise ValueError("unsupported url scheme '%s'" % url.scheme)
 
-        conn = connection(url.netloc)
         target = urlparse.urlunsplit(
             (None, None, url.path, url.query, url.fragment)
         )
-        conn.request(method, target, *args, **kwds)
-        res = conn.getresponse()
+        res = self._http(
+            url.scheme, url.netloc, method, target, path, *args, **kwds
+        )
         if is_success(res):
             return res
 
+        res.read()
         if method == 'PUT' and res.status == 403:
             created = self._makedirs(path)
             if created:
-                conn = connection(url.netloc)
-                conn.request(method, target, *args, **kwds)
-                res = conn.getresponse()
+                res = self._http(
+                    url.scheme, url.netloc, method, target, path, *args,
+                    **kwds
+                )
                 if is_success(res):
                     return res
+                res.read()
 
         raise HTTPError(res.status, res.reason)
 
@@ -136,27 +226,45 @@ class LargeHTTPFile(HTTPFile):
         key=None,
         readonly=False,
         create_close_arg=None,
+        timeout=None,
+        deadline=None,
+        write_buffer=WRITE_BUFFER,
         **kwds
     ):
 
-        super(LargeHTTPFile, self
-              ).__init__(mg, fid, key, cls, create_close_arg)
+        super(LargeHTTPFile, self).__init__(
+            mg, fid, key, cls, create_close_arg, timeout, deadline
+        )
 
         if backup_dests is None:
             backup_dests = []
 
+        # sequential writes not sent yet, starting at offset _wstart
+        self.write_buffer = write_buffer
+        self._wbuf = []
+        self._wlen = 0
+        self._wstart = 0
+
+        error = None
         for tried_devid, tried_path in [(devid, path)] + list(backup_dests):
             self._path = tried_path
 
-            if overwrite:
-                # Ensure file overwritten/created, even if they don't print anything
-                res = self._request(
-                    tried_path,
-                    "PUT",
-                    "", headers={'Content-Length': '0'}
-                )
-            else:
-                res = self._request(tried_path, "HEAD")
+            try:
+                if overwrite:
+                    # Ensure file overwritten/created, even if they don't print anything
+                    res = self._request(
+                        tried_path,
+                        "PUT",
+                        "", headers={'Content-Length': '0'}
+                    )
+                else:
+                    res = self._request(tried_path, "HEAD")
+            except DeadlineExceeded:
+                raise
+            except (HTTPError, httplib.HTTPException, socket.error), e:
+                # try the next replica
+                error = e
+                continue
 
             if is_success(res):
                 if overwrite:
@@ -168,7 +276,11 @@ class LargeHTTPFile(HTTPFile):
                 self.path = tried_path
                 break
         else:
-            raise HTTPError("couldn't connect to any storage nodes")
+            if isinstance(error, HTTPError):
+                raise error
+            raise MogileFSError(
+                "couldn't connect to any storage nodes: %s" % error
+            )
 
         self.overwrite = overwrite
         self.readonly = readonly
@@ -177,6 +289,22 @@ class LargeHTTPFile(HTTPFile):
         self._pos = 0
         self._eof = 0
 
+    def flush(self):
+        """Sends the buffered writes in one ranged PUT."""
+        if not self._wlen:
+            return
+        content = ''.join(self._wbuf)
+        start = self._wstart
+        end = start + len(content) - 1
+        self._wbuf = []
+        self._wlen = 0
+        headers = {
+            'Content-Range': "bytes %d-%d/*" % (start, end),
+            'Content-Length': len(content)
+        }
+        # read the answer so the connection goes back to the pool
+        self._request(self._path, "PUT", content, headers=headers).read()
+
     def read(self, n=-1):
         if self._is_closed:
             return False
@@ -184,6 +312,8 @@ class LargeHTTPFile(HTTPFile):
         if self._eof:
             return ''
 
+        self.flush()
+
         headers = {}
         if n == 0:
             return ''
@@ -204,7 +334,14 @@ class LargeHTTPFile(HTTPFile):
             else:
                 raise e
 
-        content = res.read()
+        try:
+            content = res.read()
+        except socket.timeout:
+            if self._expired():
+                raise DeadlineExceeded(
+                    "deadline exceeded reading %s" % self._path
+                )
+            raise
         self._pos += len(content)
 
         if n < 0:
@@ -225,22 +362,26 @@ class LargeHTTPFile(HTTPFile):
             return False
 
         length = len(content)
-        start = self._pos
-        end = self._pos + length - 1
-        headers = {
-            'Content-Range': "bytes %d-%d/*" % (start, end),
-            'Content-Length': length
-        }
-        self._request(self._path, "PUT", content, headers=headers)
+        if not length:
+            return
+        if not self._wlen:
+            self._wstart = self._pos
+        self._wbuf.append(content)
+        self._wlen += length
 
         if self._pos + length > self.length:
             self.length = self._pos + length
 
-        self._pos += len(content)
+        self._pos += length
+        if self._wlen >= self.write_buffer:
+            self.flush()
 
     def close(self):
         if not self._is_closed:
-            self._is_closed = 1
+            try:
+                self.flush()
+            finally:
+                self._is_closed = 1
             if self.devid:
                 params = {
                     'fid': self.fid,
@@ -252,17 +393,15 @@ class LargeHTTPFile(HTTPFile):
                 }
                 if self.create_close_arg:
                     params.update(self.create_close_arg)
-                try:
-                    self.mg.backend.do_request('create_close', params)
-                except MogileFSError, e:
-                    if e.err != 'empty_file':
-                        raise
+                self._create_close(params)
 
     def seek(self, pos, mode=0):
         if self._is_closed:
             return False
         if pos < 0:
             pos = 0
+        if pos != self._pos:
+            self.flush()
         self._pos = pos
 
     def tell(self):
@@ -282,15 +421,23 @@ class NormalHTTPFile(HTTPFile):
         cls=None,
         key=None,
         create_close_arg=None,
+        timeout=None,
+        deadline=None,
+        spool_size=SPOOL_SIZE,
         **kwds
     ):
 
-        super(NormalHTTPFile, self
-              ).__init__(mg, fid, key, cls, create_close_arg)
+        super(NormalHTTPFile, self).__init__(
+            mg, fid, key, cls, create_close_arg, timeout, deadline
+        )
 
         if backup_dests is None:
             backup_dests = []
-        self._fp = StringIO()
+        # in memory up to spool_size bytes, in a temporary file past that
+        self._fp = tempfile.SpooledTemporaryFile(spool_size)
+        self._spool_size = spool_size
+        # the furthest end of a write, which decides where the buffer is
+        self._extent = 0
         self._paths = [(devid, path)] + list(backup_dests)
         self._is_closed = 0
 
@@ -308,50 +455,356 @@ class NormalHTTPFile(HTTPFile):
 
     def write(self, content):
         self._fp.write(content)
+        self._extent = max(self._extent, self._fp.tell())
+
+    def _on_disk(self):
+        """
+        True once the buffer went to a temporary file, which happens as soon
+        as a write ends past spool_size.
+        """
+        return bool(self._spool_size) and self._extent > self._spool_size
 
     def close(self):
         if not self._is_closed:
-            self._is_closed = True
+            self._fp.seek(0, 2)
+            size = self._fp.tell()
 
-            #      content = self._fp.getvalue()
-            #      self._fp.close()
+            def send(path):
+                self._fp.seek(0)
+                status, res = put.putfd(
+                    self._fp,
+                    path,
+                    size,
+                    hook=self.mg._hooks and self.mg.run_hook,
+                    timeout=self._timeout(),
+                    # only once the buffer is a file on disk
+                    zero_copy=self._on_disk(),
+                    pool=self._pool()
+                )
+                # read to the end, the connection goes back to the pool
+                res.read()
+                if not is_success(res):
+                    raise HTTPError(status, res.reason)
 
-            for tried_devid, tried_path in self._paths:
-                try:
-                    #          self._request(tried_path, "PUT", content)
-                    self._fp.seek(0)
-                    put.putfile(self._fp, tried_path)
-                    devid = tried_devid
-                    path = tried_path
-                    break
-                except HTTPError, e:
-                    continue
-            else:
-                devid = None
-                path = None
+            try:
+                self._commit(send, size)
+            finally:
+                self._fp.close()
+
+    def upload(self, fp, length):
+        """
+        Stores ``length`` bytes of the regular file ``fp``, from its current
+        position, in place of anything written and closes.  The bytes go
+        from the page cache to the socket with sendfile(2) when os.sendfile
+        or pysendfile is available, see put.putfd.
+        """
+        if self._is_closed:
+            return False
+        offset = fp.tell()
+
+        def send(path):
+            fp.seek(offset)
+            status, res = put.putfd(
+                fp,
+                path,
+                length,
+                hook=self.mg._hooks and self.mg.run_hook,
+                timeout=self._timeout(),
+                pool=self._pool()
+            )
+            res.read()
+            if not is_success(res):
+                raise HTTPError(status, res.reason)
 
-            self._fp.seek(0, 2)
-            size = self._fp.tell()
+        try:
+            self._commit(send, length)
+        finally:
             self._fp.close()
-            if devid:
-                params = {
-                    'fid': self.fid,
-                    'domain': self.mg.domain,
-                    'key': self.key,
-                    'path': path,
-                    'devid': devid,
-                    'size': size
-                }
-                if self.create_close_arg:
-                    params.update(self.create_close_arg)
-                try:
-                    self.mg.backend.do_request('create_close', params)
-                except MogileFSError, e:
-                    if e.err != 'empty_file':
-                        raise
+        return length
+
+    def _commit(self, send, size):
+        """
+        Stores the file with ``send(path)`` on the first destination that
+        takes it and tells the tracker.
+        """
+        self._is_closed = True
+        for tried_devid, tried_path in self._paths:
+            try:
+                send(tried_path)
+                devid = tried_devid
+                path = tried_path
+                break
+            except DeadlineExceeded:
+                raise
+            except (HTTPError, httplib.HTTPException, socket.error), e:
+                # try the next destination
+                continue
+        else:
+            devid = None
+            path = None
+
+        if devid:
+            params = {
+                'fid': self.fid,
+                'domain': self.mg.domain,
+                'key': self.key,
+                'path': path,
+                'devid': devid,
+                'size': size
+            }
+            if self.create_close_arg:
+                params.update(self.create_close_arg)
+            self._create_close(params)
 
     def seek(self, pos, mode=0):
         return self._fp.seek(pos, mode)
 
     def tell(self):
         return self._fp.tell()
+
+
+class StreamingHTTPFile(HTTPFile):
+    """
+    A new file that is sent while it is written: a chunked PUT to the
+    first destination starts right away and every ``buffer_size`` bytes
+    written go out as one chunk.
+
+    Everything written is also kept in a SpooledTemporaryFile, in memory
+    up to ``spool_size`` bytes and on disk past that, so when a destination
+    fails before close() the upload starts over on the next of
+    ``backup_dests``.  With ``spool_size`` None nothing is kept and such a
+    failure is raised.
+    """
+
+    def __init__(
+        self,
+        path,
+        devid,
+        backup_dests=None,
+        mg=None,
+        fid=None,
+        cls=None,
+        key=None,
+        create_close_arg=None,
+        timeout=None,
+        deadline=None,
+        buffer_size=65536,
+        spool_size=1 << 20,
+        **kwds
+    ):
+
+        super(StreamingHTTPFile, self).__init__(
+            mg, fid, key, cls, create_close_arg, timeout, deadline
+        )
+
+        self.buffer_size = buffer_size
+        self.length = 0
+        self._buf = bytearray()
+        self._spool = None
+        if spool_size is not None:
+            self._spool = tempfile.SpooledTemporaryFile(spool_size)
+        # backup_dests from Client.new_file start with the main one too
+        self._dests = [(devid, path)] + [
+            dest for dest in backup_dests or () if dest != (devid, path)
+        ]
+        self._conn = None
+        self._reused = False
+        self._sent = 0
+        self._is_closed = 0
+        # what ended the upload, raised again by any later write or close
+        self._error = None
+        self._next_dest(None)
+
+    def _open(self, path):
+        url = urlparse.urlsplit(path)
+        target = urlparse.urlunsplit(
+            (None, None, url.path, url.query, url.fragment)
+        )
+        self._start = time.time()
+        if self.mg is not None and self.mg._hooks:
+            self.mg.run_hook(
+                'http_request_start', 'PUT', path, 0, 0, 0.0, self._start
+            )
+        self._sent = 0
+        self._conn, self._reused = self._pool().get(
+            url.scheme, url.netloc, self._timeout()
+        )
+        self._conn.putrequest('PUT', target)
+        self._conn.putheader('Transfer-Encoding', 'chunked')
+        self._conn.endheaders()
+
+    def _send(self, data):
+        self._conn.send('%X\r\n' % len(data))
+        self._conn.send(data)
+        self._conn.send('\r\n')
+        self._sent += len(data)
+
+    def _next_dest(self, error):
+        """
+        Starts the upload on the next destination, replaying what was
+        written so far.  Raises when no destination is left.
+        """
+        if self._conn is not None:
+            self._finish_hook('http_request_error', None)
+            self._drop_conn()
+        if error is not None and self._spool is None and self.length:
+            raise self._fail(error)
+        while self._dests:
+            self.devid, self.path = self._dests.pop(0)
+            try:
+                self._open(self.path)
+                if self._spool is not None and self.length:
+                    self._spool.seek(0)
+                    while True:
+                        data = self._spool.read(self.buffer_size)
+                        if not data:
+                            break
+                        self._send(data)
+                    self._spool.seek(0, 2)
+                    # the buffer was part of the replay
+                    del self._buf[:]
+                return
+            except DeadlineExceeded, e:
+                raise self._fail(e)
+            except (httplib.HTTPException, socket.error), e:
+                self._timed_out(e)
+                error = e
+                if self._conn is not None:
+                    self._drop_conn()
+        if isinstance(error, HTTPError):
+            raise self._fail(error)
+        raise self._fail(MogileFSError(
+            "couldn't store %s on any storage node: %s" % (self.key, error)
+        ))
+
+    def _fail(self, error):
+        """Returns error, after which the upload is over."""
+        self._error = error
+        return error
+
+    def _drop_conn(self):
+        """
+        Closes the connection after a failure; when it was a reused one
+        the node may just have closed it, so the destination gets one more
+        try on a new connection.
+        """
+        self._pool().discard(self._conn)
+        self._conn = None
+        if self._reused:
+            self._reused = False
+            self._dests.insert(0, (self.devid, self.path))
+
+    def _timed_out(self, error):
+        if isinstance(error, socket.timeout) and self._expired():
+            raise self._fail(DeadlineExceeded(
+                "deadline exceeded storing %s on %s" % (self.key, self.path)
+            ))
+
+    def _finish_hook(self, hookname, res):
+        if self.mg is None or not self.mg._hooks:
+            return
+        try:
+            received = int(res.getheader('content-length'))
+        except (AttributeError, TypeError, ValueError):
+            received = 0
+        now = time.time()
+        self.mg.run_hook(
+            hookname, 'PUT', self.path, self._sent, received,
+            now - self._start, now
+        )
+
+    def _flush(self):
+        if not self._buf:
+            return
+        try:
+            self._send(self._buf)
+        except (httplib.HTTPException, socket.error), e:
+            self._timed_out(e)
+            self._next_dest(e)
+        del self._buf[:]
+
+    def write(self, content):
+        if self._error is not None:
+            raise self._error
+        if self._is_closed:
+            return False
+        if self._spool is not None:
+            self._spool.write(content)
+        self._buf += content
+        self.length += len(content)
+        if len(self._buf) >= self.buffer_size:
+            self._flush()
+
+    def _response(self):
+        """Ends the chunked body and returns the response."""
+        try:
+            self._flush()
+            self._conn.send('0\r\n\r\n')
+        except socket.error:
+            # the server may have answered early, e.g. 403 for a missing
+            # directory, and closed the connection
+            pass
+        res = self._conn.getresponse()
+        res.read()
+        return res
+
+    def close(self):
+        if self._error is not None:
+            # a failed upload is never committed
+            if not self._is_closed:
+                self._is_closed = 1
+                if self._conn is not None:
+                    self._pool().discard(self._conn)
+                    self._conn = None
+                if self._spool is not None:
+                    self._spool.close()
+            raise self._error
+        if self._is_closed:
+            return
+        self._is_closed = 1
+        made_dirs = set()
+        try:
+            while True:
+                try:
+                    res = self._response()
+                except (httplib.HTTPException, socket.error), e:
+                    self._timed_out(e)
+                    self._next_dest(e)
+                    continue
+                # the node answered, so the connection was not stale
+                self._reused = False
+                if not res.will_close:
+                    self._pool().put(self._conn)
+                self._conn = None
+                if is_success(res):
+                    self._finish_hook('http_request_finished', res)
+                    break
+                self._finish_hook('http_request_error', res)
+                error = HTTPError(res.status, res.reason)
+                if res.status == 403 and self.path not in made_dirs:
+                    made_dirs.add(self.path)
+                    if self._makedirs(self.path):
+                        # try the same destination again
+                        self._dests.insert(0, (self.devid, self.path))
+                self._next_dest(error)
+        finally:
+            if self._conn is not None:
+                self._pool().discard(self._conn)
+                self._conn = None
+            if self._spool is not None:
+                self._spool.close()
+
+        params = {
+            'fid': self.fid,
+            'domain': self.mg.domain,
+            'key': self.key,
+            'path': self.path,
+            'devid': self.devid,
+            'size': self.length
+        }
+        if self.create_close_arg:
+            params.update(self.create_close_arg)
+        self._create_close(params)
+
+    def tell(self):
+        return self.length
@@ -0,0 +1,49 @@
+#! coding: utf-8
+"""
+Hook registration shared by Backend and Client.
+
+Hooks are plain callables registered by name.  Callers guard every hook
+site with ``if self._hooks:``, which stays None until the first hook is
+added, so instrumentation costs nothing while it is not used.
+"""
+import logging
+
+LOG = logging.getLogger("MogileFS Hooks")
+
+
+class Hooks(object):
+    _hooks = None
+
+    def add_hook(self, hookname, callback):
+        """
+        Call ``callback`` whenever ``hookname`` runs.  Tracker hooks
+        (``do_request_*``) receive ``(cmd, tracker, bytes_sent,
+        bytes_received, elapsed, timestamp)``; storage hooks
+        (``http_request_*``) receive ``(method, url, bytes_sent,
+        bytes_received, elapsed, timestamp)``.
+        """
+        hooks = dict(self._hooks or {})
+        hooks[hookname] = hooks.get(hookname, []) + [callback]
+        self._hooks = hooks
+
+    def remove_hook(self, hookname, callback=None):
+        """Remove one callback, or all callbacks, for ``hookname``."""
+        hooks = dict(self._hooks or {})
+        if callback is None:
+            hooks.pop(hookname, None)
+        else:
+            callbacks = [c for c in hooks.get(hookname, []) if c != callback]
+            if callbacks:
+                hooks[hookname] = callbacks
+            else:
+                hooks.pop(hookname, None)
+        self._hooks = hooks or None
+
+    def run_hook(self, hookname, *args):
+        if not self._hooks:
+            return
+        for callback in self._hooks.get(hookname, ()):
+            try:
+                callback(*args)
+            except Exception:
+                LOG.exception("hook %s failed" % hookname)
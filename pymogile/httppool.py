@@ -0,0 +1,194 @@
+#! coding: utf-8
+"""
+Kept-alive HTTP connections to storage nodes, shared by all the files of
+all clients unless a Client is given a pool of its own.
+"""
+import time
+import select
+import socket
+import httplib
+import threading
+from collections import deque
+
+CONNECTION_CLASSES = {
+    'http': httplib.HTTPConnection,
+    'https': httplib.HTTPSConnection,
+}
+
+
+class PooledResponse(httplib.HTTPResponse):
+    """Gives its connection back to the pool once the body is read."""
+
+    _release = None
+
+    def close(self):
+        httplib.HTTPResponse.close(self)
+        release, self._release = self._release, None
+        # with a body of unknown length, or not read to its end, the
+        # connection is not safe to reuse
+        if release is not None and self.length == 0:
+            release()
+
+
+class ConnectionPool(object):
+    """
+    Keeps at most ``max_idle_per_host`` idle connections to every storage
+    node, each for at most ``idle_timeout`` seconds.  A connection is idle
+    again once the body of its last response was read to the end; one whose
+    body is left unread is not reused.
+
+    This caps only the idle connections.  How many requests run against a
+    node at once is up to the callers: when no connection is idle a new one
+    is opened, and closed on its return if the node has enough idle ones.
+
+    ``connects`` counts the connections opened, ``reuses`` the requests
+    made on an idle one and ``retries`` the requests made again because
+    the node had closed it meanwhile.
+    """
+
+    def __init__(self, max_idle_per_host=8, idle_timeout=30.0):
+        if max_idle_per_host <= 0:
+            raise ValueError("max_idle_per_host must be greater than 0")
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # (scheme, netloc) -> deque of (conn, idle since), oldest first
+        self._idle = {}
+        self.connects = 0
+        self.reuses = 0
+        self.retries = 0
+
+    def get(self, scheme, netloc, timeout=None):
+        """
+        Returns (conn, reused): an idle connection to netloc if there is
+        one, else a new one.
+        """
+        if scheme not in CONNECTION_CLASSES:
+            raise ValueError("unsupported url scheme '%s'" % scheme)
+        if timeout is None:
+            timeout = socket.getdefaulttimeout()
+        key = (scheme, netloc)
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    self.connects += 1
+                    break
+                conn, since = idle.pop()
+            # checked outside the lock, it takes a system call
+            if time.time() - since > self.idle_timeout or not _usable(conn):
+                conn.close()
+                continue
+            with self._lock:
+                self.reuses += 1
+            conn.sock.settimeout(timeout)
+            return conn, True
+
+        conn = CONNECTION_CLASSES[scheme](netloc, timeout=timeout)
+        conn.response_class = PooledResponse
+        conn._pool_key = key
+        conn.connect()
+        # headers and body often go out in separate sends, which Nagle's
+        # algorithm would hold back for the delayed ACK of the node
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return conn, False
+
+    def received(self, conn, res):
+        """Lets conn go back to the pool once the body of res is read."""
+        if res.will_close:
+            # httplib has closed conn already
+            return
+        res._release = lambda: self.put(conn)
+        if res.length == 0:
+            res.close()
+
+    def put(self, conn):
+        """Gives back conn, which must not be in the middle of a request."""
+        if conn.sock is None:
+            return
+        now = time.time()
+        expired = []
+        with self._lock:
+            idle = self._idle.setdefault(conn._pool_key, deque())
+            while idle and (
+                now - idle[0][1] > self.idle_timeout or
+                len(idle) >= self.max_idle_per_host
+            ):
+                expired.append(idle.popleft()[0])
+            idle.append((conn, now))
+        for candidate in expired:
+            candidate.close()
+
+    def discard(self, conn):
+        """
+        Closes conn after a failed request, with every idle connection to
+        its node: if one went stale the others likely did as well.
+        """
+        conn.close()
+        with self._lock:
+            idle = self._idle.pop(getattr(conn, '_pool_key', None), ())
+        for candidate, _ in idle:
+            candidate.close()
+
+    def exchange(self, scheme, netloc, send, timeout=None, retry=True):
+        """
+        Returns send(conn), the response to a request made on a connection
+        to netloc.  When a reused connection turns out to be closed by the
+        node, send is called once more with a new one, unless ``retry`` is
+        false.
+        """
+        conn, reused = self.get(scheme, netloc, timeout)
+        try:
+            res = send(conn)
+        except (httplib.BadStatusLine, socket.error), e:
+            self.discard(conn)
+            if not reused or not retry or isinstance(e, socket.timeout):
+                raise
+            with self._lock:
+                self.retries += 1
+            conn, _ = self.get(scheme, netloc, timeout)
+            try:
+                res = send(conn)
+            except Exception:
+                self.discard(conn)
+                raise
+        except Exception:
+            self.discard(conn)
+            raise
+        self.received(conn, res)
+        return res
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.itervalues():
+            for conn, _ in conns:
+                conn.close()
+
+    def stats(self):
+        """Returns a dict of the counters and the ``idle`` connections."""
+        with self._lock:
+            idle = sum(len(conns) for conns in self._idle.itervalues())
+        return {
+            'connects': self.connects,
+            'reuses': self.reuses,
+            'retries': self.retries,
+            'idle': idle,
+        }
+
+
+def _usable(conn):
+    """
+    False when the node closed conn, or sent something nobody asked for,
+    while it was idle.
+    """
+    if conn.sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+        return False
+    return not readable
+
+
+default_pool = ConnectionPool()
@@ -18,16 +18,32 @@ auth = {'username': 'myuser', 'password': 'mypass'}
 put.put(bytes, 'http://example.org/test', **auth)
 """
 
+import os
 import sys
+import stat
+import time
+import errno
+import select
 import base64
+import socket
 import urllib2
-import httplib
 import urlparse
 from optparse import OptionParser
+
+import httppool
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
+try:
+    # Python 3.3+
+    from os import sendfile
+except ImportError:
+    try:
+        # pysendfile, https://pypi.python.org/pypi/pysendfile
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
 
 # True by default when running as a script
 # Otherwise, we turn the noise off...
@@ -66,9 +82,48 @@ def parseuri(uri):
     return host, port, path
 
 
-def putfile(f, uri, username=None, password=None):
-    """HTTP PUT the file f to uri, with optional auth data."""
+def putfile(
+    f, uri, username=None, password=None, hook=None, timeout=None, pool=None
+):
+    """HTTP PUT the file f to uri, with optional auth data.
+
+    ``timeout`` is the socket timeout in seconds, None for the default.
+    The connection comes from ``pool``, httppool.default_pool by default.
+
+    If given, ``hook(hookname, method, uri, bytes_sent, bytes_received,
+    elapsed, timestamp)`` is called with http_request_start and then
+    http_request_finished or http_request_error.
+    """
+    if hook:
+        start = time.time()
+        hook('http_request_start', 'PUT', uri, 0, 0, 0.0, start)
+        try:
+            status, resp = putfile(
+                f, uri, username, password, timeout=timeout, pool=pool
+            )
+        except Exception:
+            now = time.time()
+            hook('http_request_error', 'PUT', uri, f.tell(), 0, now - start,
+                 now)
+            raise
+        now = time.time()
+        try:
+            received = int(resp.getheader('content-length'))
+        except (TypeError, ValueError):
+            received = 0
+        hook('http_request_finished', 'PUT', uri, f.tell(), received,
+             now - start, now)
+        return status, resp
+
     host, port, path = parseuri(uri)
+    if timeout is None:
+        timeout = socket.getdefaulttimeout()
+    pool = pool or httppool.default_pool
+    try:
+        offset = f.tell()
+    except (AttributeError, IOError):
+        # a pipe, which cannot be sent again on a new connection
+        offset = None
 
     redirect = set([301, 302, 307])
     authenticate = set([401])
@@ -78,9 +133,9 @@ def putfile(f, uri, username=None, password=None):
     authorization = None
     tries = 0
 
-    while True:
-        # Attempt to HTTP PUT the data
-        h = httplib.HTTPConnection(host, port)
+    def send(h):
+        if offset is not None:
+            f.seek(offset)
 
         h.putrequest('PUT', path)
 
@@ -107,7 +162,14 @@ def putfile(f, uri, username=None, password=None):
             h.send(bytes + '\r\n')
         h.send('0\r\n\r\n')
 
-        resp = h.getresponse()
+        return h.getresponse()
+
+    while True:
+        # Attempt to HTTP PUT the data
+        resp = pool.exchange(
+            'http', '%s:%d' % (host, port), send, timeout,
+            retry=offset is not None
+        )
         status = resp.status    # an int
 
         # Got a response, now decide how to act upon it
@@ -215,6 +277,109 @@ def putfile(f, uri, username=None, password=None):
     return status, resp
 
 
+def putfd(
+    f, uri, length, hook=None, timeout=None, zero_copy=True, pool=None
+):
+    """HTTP PUT ``length`` bytes of the file f to uri.
+
+    The bytes from the current position of f are sent with a known
+    Content-Length.  With ``zero_copy`` f must be a regular file, which
+    is sent straight from the page cache with sendfile(2) when os.sendfile
+    or pysendfile is available.  Returns (status, response) like putfile,
+    without following redirects.  The connection comes from ``pool``,
+    httppool.default_pool by default.
+    """
+    start = time.time()
+    sent = [0]
+    if hook:
+        hook('http_request_start', 'PUT', uri, 0, 0, 0.0, start)
+    try:
+        host, port, path = parseuri(uri)
+        if timeout is None:
+            timeout = socket.getdefaulttimeout()
+        offset = f.tell()
+
+        def send(h):
+            f.seek(offset)
+            sent[0] = 0
+            h.putrequest('PUT', path)
+            h.putheader('User-Agent', 'put.py/1.0')
+            h.putheader('Content-Length', str(length))
+            h.endheaders()
+            send_file(h.sock, f, length, sent, zero_copy=zero_copy)
+            return h.getresponse()
+
+        resp = (pool or httppool.default_pool).exchange(
+            'http', '%s:%d' % (host, port), send, timeout
+        )
+    except Exception:
+        if hook:
+            now = time.time()
+            hook('http_request_error', 'PUT', uri, sent[0], 0, now - start,
+                 now)
+        raise
+
+    if hook:
+        now = time.time()
+        try:
+            received = int(resp.getheader('content-length'))
+        except (TypeError, ValueError):
+            received = 0
+        hook('http_request_finished', 'PUT', uri, sent[0], received,
+             now - start, now)
+    return resp.status, resp
+
+
+def send_file(sock, f, length, sent=None, blocksize=1 << 20, zero_copy=True):
+    """Send ``length`` bytes of f from its current position over sock.
+
+    ``sent``, a one item list, counts the bytes sent so far.
+    """
+    sent = sent or [0]
+    offset = f.tell()
+    if sendfile is None or not zero_copy:
+        while sent[0] < length:
+            data = f.read(min(blocksize, length - sent[0]))
+            if not data:
+                raise IOError("%s is shorter than %d bytes" % (f, length))
+            sock.sendall(data)
+            sent[0] += len(data)
+        return sent[0]
+
+    # sockets with a timeout are non-blocking underneath
+    timeout = sock.gettimeout()
+    fd = f.fileno()
+    while sent[0] < length:
+        try:
+            n = sendfile(sock.fileno(), fd, offset + sent[0],
+                         min(blocksize, length - sent[0]))
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno != errno.EAGAIN:
+                raise socket.error(e.errno, e.strerror)
+            if not select.select([], [sock], [], timeout)[1]:
+                raise socket.timeout('timed out')
+            continue
+        if not n:
+            raise IOError("%s is shorter than %d bytes" % (f, length))
+        sent[0] += n
+    f.seek(offset + sent[0])
+    return sent[0]
+
+
+def regular_file_size(f):
+    """Bytes left after the current position of f when it is a regular
+    file on disk, None for anything else."""
+    try:
+        st = os.fstat(f.fileno())
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return max(st.st_size - f.tell(), 0)
+
+
 def putname(fn, uri, username=None, password=None):
     """HTTP PUT the file with filename fn to uri, with optional auth data."""
     auth = {'username': username, 'password': password}
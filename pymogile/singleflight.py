@@ -0,0 +1,95 @@
+#! coding: utf-8
+"""
+Coalescing of concurrent identical calls.
+
+When many threads ask the tracker the same read-only question at once,
+only the first one sends it; the rest wait for that answer.
+"""
+import threading
+
+from pymogile.exceptions import DeadlineExceeded
+
+
+class _Call(object):
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def share(result):
+    """
+    The result as handed to each caller.  Dicts are copied since
+    callers such as Client.file_info update the reply in place.
+    """
+    if isinstance(result, dict):
+        return dict(result)
+    return result
+
+
+class SingleFlight(object):
+    """
+    Runs at most one call per key at a time.  Callers arriving while a
+    call with the same key is in flight wait for it and get its result,
+    or its exception.
+
+    ``executed`` counts the calls actually made and ``collapsed`` the ones
+    that were answered by another caller's call.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.executed = 0
+        self.collapsed = 0
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+    def stats(self):
+        return {
+            'executed': self.executed,
+            'collapsed': self.collapsed,
+            'in_flight': self.in_flight(),
+        }
+
+    def do(self, key, timeout, func, *args):
+        """
+        ``func(*args)``, unless a call with ``key`` is already running.  A
+        waiting caller gives up with DeadlineExceeded after ``timeout``
+        seconds; the running call is not affected.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+                leader = True
+            else:
+                self.collapsed += 1
+                leader = False
+
+        if not leader:
+            if not call.done.wait(timeout):
+                raise DeadlineExceeded(
+                    "deadline exceeded waiting for a coalesced request"
+                )
+            if call.error is not None:
+                raise call.error
+            return share(call.result)
+
+        try:
+            call.result = func(*args)
+        except Exception, e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        # the leader's copy too, the waiting callers copy call.result
+        # while it may be updating its own
+        return share(call.result)
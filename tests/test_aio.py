@@ -0,0 +1,140 @@
+#! coding: utf-8
+# pylint: disable-msg=W0311
+import time
+import random
+import socket
+import unittest
+import threading
+from pymogile import Admin, AsyncClient, MogileFSError
+from pymogile import Deadline, DeadlineExceeded
+from pymogile import aio
+
+TEST_NS = "mogilefs.client::test_aio"
+HOSTS   = ["127.0.0.1:7001"]
+
+
+@unittest.skipIf(aio.asyncio is None, "trollius is not installed")
+class TestAsyncClient(unittest.TestCase):
+  def setUp(self):
+    self.moga = Admin(HOSTS)
+    try:
+      self.moga.create_domain(TEST_NS)
+    except MogileFSError:
+      pass
+    self.loop = aio.asyncio.new_event_loop()
+    self.client = AsyncClient(TEST_NS, HOSTS, loop=self.loop)
+
+  def tearDown(self):
+    self.client.close()
+    self.loop.close()
+    try:
+      self.moga.delete_domain(TEST_NS)
+    except MogileFSError:
+      pass
+
+  def run_coro(self, coro):
+    return self.loop.run_until_complete(coro)
+
+  def test_store_content(self):
+    key = 'test_file_%s_%s' % (random.random(), time.time())
+    data = "0123456789" * 50
+    self.assertEqual(self.run_coro(self.client.store_content(key, data)),
+                     len(data))
+    self.assertTrue(self.run_coro(self.client.get_paths(key)))
+    self.assertEqual(self.run_coro(self.client.get_file_data(key)), data)
+
+  def test_concurrent_get_paths(self):
+    key = 'test_file_%s_%s' % (random.random(), time.time())
+    self.run_coro(self.client.store_content(key, key))
+    coros = [self.client.get_paths(key) for _ in xrange(50)]
+    results = self.run_coro(aio.asyncio.gather(*coros, loop=self.loop))
+    self.assertEqual(len(results), 50)
+    self.assertTrue(all(results))
+
+  def test_coalesced_get_paths(self):
+    key = 'test_file_%s_%s' % (random.random(), time.time())
+    self.run_coro(self.client.store_content(key, key))
+    client = AsyncClient(TEST_NS, HOSTS, loop=self.loop, coalesce=True)
+    coros = [client.get_paths(key) for _ in xrange(50)]
+    results = self.run_coro(aio.asyncio.gather(*coros, loop=self.loop))
+    client.close()
+    self.assertEqual(len(set(map(tuple, results))), 1)
+    self.assertEqual(client.backend.coalesce_stats()['collapsed'], 49)
+
+  def test_delete(self):
+    key = 'test_file_%s_%s' % (random.random(), time.time())
+    self.run_coro(self.client.store_content(key, key))
+    self.assertEqual(self.run_coro(self.client.delete(key)), True)
+    self.assertEqual(self.run_coro(self.client.delete(key)), False)
+
+  def test_list_keys(self):
+    key = 'test_file_%s_%s' % (random.random(), time.time())
+    self.run_coro(self.client.store_content(key, key))
+    keys = self.run_coro(self.client.list_keys(prefix=key))
+    self.assertEqual(keys, [key])
+
+  def test_timeouts(self):
+    # a storage node that accepts connections and never answers
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    try:
+      url = 'http://127.0.0.1:%d/dev1/0/000/000/0000000001.fid' % \
+          server.getsockname()[1]
+      start = time.time()
+      self.assertRaises(socket.timeout, self.run_coro,
+                        aio.http_request(url, loop=self.loop, timeout=0.1))
+      self.assertTrue(time.time() - start < 1)
+    finally:
+      server.close()
+    self.assertRaises(DeadlineExceeded, self.run_coro,
+                      self.client.backend._checkout(deadline=Deadline(-1)))
+
+  def test_do_request_not_repeated(self):
+    # a tracker that answers the first command of every connection and
+    # drops the connection after reading the second
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    received = []
+    def serve():
+      while True:
+        try:
+          sock, _ = server.accept()
+        except socket.error:
+          return
+        rfile = sock.makefile('rb')
+        received.append(rfile.readline().split()[0])
+        sock.sendall('OK \r\n')
+        line = rfile.readline()
+        if line:
+          received.append(line.split()[0])
+        rfile.close()
+        sock.close()
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    try:
+      backend = aio.AsyncBackend(['127.0.0.1:%d' % server.getsockname()[1]],
+                                 loop=self.loop)
+      self.run_coro(backend.do_request("get_domains"))
+      self.assertRaises(MogileFSError, self.run_coro,
+                        backend.do_request("delete", {'key': 'k'}))
+      self.assertEqual(received, ['get_domains', 'delete'])
+      del received[:]
+      self.run_coro(backend.do_request("get_domains"))
+      self.assertRaises(MogileFSError, self.run_coro,
+                        backend.do_pipeline([("delete", {'key': 'k'})]))
+      self.assertEqual(received, ['get_domains', 'delete'])
+      # read-only commands are safe to send again
+      del received[:]
+      self.run_coro(backend.do_request("get_domains"))
+      self.run_coro(backend.do_request("get_domains"))
+      self.assertEqual(received, ['get_domains'] * 3)
+      backend.close()
+    finally:
+      server.close()
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,8 +1,13 @@
 #! coding: utf-8
 # pylint: disable-msg=W0311
+import socket
 import unittest
-from pymogile.backend import Backend
-from pymogile.exceptions import MogileFSError
+import threading
+from pymogile.backend import Backend, TrackerStats, Records, LatencyWindow
+from pymogile.deadline import Deadline
+from pymogile.singleflight import SingleFlight
+from pymogile.emulator import Emulator
+from pymogile.exceptions import MogileFSError, DeadlineExceeded
 
 
 class TestBackend(unittest.TestCase):
@@ -37,6 +42,264 @@ class TestBackend(unittest.TestCase):
     else:
       assert False
   
+  def test_do_pipeline(self):
+    res = self.backend.do_pipeline([("get_domains", None),
+                                    ("asdfkljweioav", None),
+                                    ("get_domains", None)])
+    self.assertEqual(len(res), 3)
+    assert res[0]
+    assert isinstance(res[1], MogileFSError)
+    self.assertEqual(res[0], res[2])
+
+  def test_do_pipeline_empty(self):
+    self.assertEqual(self.backend.do_pipeline([]), [])
+
+  def test_do_pipeline_connections(self):
+    # the pipeline preferring the dead tracker falls back to the live one
+    backend = Backend(['127.0.0.1:7001', '127.0.0.1:1'])
+    requests = [("get_domains", None), ("asdfkljweioav", None)] * 10
+    res = backend.do_pipeline(requests, depth=3, connections=4)
+    self.assertEqual(len(res), 20)
+    for x in xrange(0, 20, 2):
+      assert res[x]
+      assert isinstance(res[x + 1], MogileFSError)
+    for hint in xrange(4):
+      assert backend.do_request("get_domains", tracker_hint=hint)
+
+  def test_do_pipeline_tracker_restart(self):
+    emulator = Emulator(nodes=1, trackers=1).start()
+    backend = Backend(emulator.trackers)
+    assert backend.do_request("get_domains")
+    # the idle connection goes stale and no new one can be opened
+    emulator.stop()
+    self.assertRaises(MogileFSError, backend.do_pipeline,
+                      [("get_domains", None)])
+    self.assertEqual(backend.pool.connection_counts(), {})
+    self.assertEqual(min(backend.pool._count.values()), 0)
+
+  def test_do_request_threads(self):
+    backend = Backend(['127.0.0.1:7001'], max_connections=2)
+    errors = []
+    def worker():
+      for _ in xrange(20):
+        try:
+          backend.do_request("get_domains")
+        except Exception, e:
+          errors.append(e)
+    threads = [threading.Thread(target=worker) for _ in xrange(8)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertEqual(errors, [])
+    assert max(backend.pool.connection_counts().values()) <= 2
+
+  def test_tracker_stats_backoff(self):
+    stats = TrackerStats()
+    self.assertEqual(stats.score(), 0.0)
+    stats.record_success(0.01)
+    self.assertAlmostEqual(stats.score(), 0.01)
+    stats.record_failure(100)
+    self.assertFalse(stats.is_healthy())
+    self.assertEqual(stats.retry_at, 101)
+    stats.record_failure(100)
+    self.assertEqual(stats.retry_at, 102)
+    assert stats.score() > 1
+    stats.record_success(0.01)
+    self.assertTrue(stats.is_healthy())
+    self.assertEqual(stats.retry_at, 0)
+
+  def test_failing_tracker_is_skipped(self):
+    backend = Backend(["127.0.0.1:7012", "127.0.0.1:7001"])
+    backend._record_failure(("127.0.0.1", 7012))
+    self.assertEqual(backend._trackers_to_try(), [("127.0.0.1", 7001)])
+    assert backend.do_request("get_domains")
+    self.assertEqual(backend.pool.connection_counts().keys(),
+                     [("127.0.0.1", 7001)])
+
+  def test_records(self):
+    res = Records("key_count=3&key_2=b%2Fc&key_1=a+b&key_3=d&next_after=d"
+                  "&dev2_status=dead&dev1_mb_used=12&dev1_status=alive"
+                  "&altip=&domain1class1name=default")
+    self.assertEqual(res['key_count'], '3')
+    self.assertEqual(res.list('key', res['key_count']), ['a b', 'b/c', 'd'])
+    self.assertEqual(res.list('key', 4), ['a b', 'b/c', 'd', None])
+    self.assertEqual(res.rows('dev'), [{'mb_used': '12', 'status': 'alive'},
+                                       {'status': 'dead'}])
+    self.assertEqual(res.get('altip'), None)
+    self.assertEqual(res['domain1class1name'], 'default')
+
+  def test_latency_window(self):
+    window = LatencyWindow(size=100)
+    self.assertEqual(window.percentile(95), None)
+    for i in xrange(200):
+      window.add(i / 1000.0)
+    self.assertEqual(len(window), 100)
+    self.assertEqual(window.percentile(0), 0.1)
+    self.assertEqual(window.percentile(95), 0.195)
+    self.assertEqual(window.percentile(100), 0.199)
+
+  def test_do_request_hedged(self):
+    backend = Backend(["127.0.0.1:7001", "127.0.0.1:7012"], hedge=True,
+                      hedge_delay=0)
+    for _ in xrange(5):
+      assert backend.do_request("get_domains")
+    self.assertEqual(backend.hedge_wins, 0)
+    self.assertEqual(len(backend._latency["get_domains"]), 5)
+
+  def test_do_request_hedged_tracker_restart(self):
+    # whether the hedge goes out before the failure is noticed depends on
+    # timing, so try a few times
+    for _ in xrange(10):
+      emulator = Emulator(nodes=1, trackers=2).start()
+      backend = Backend(emulator.trackers, hedge=True, hedge_delay=0)
+      first, _ = backend._checkout()
+      second, _ = backend._checkout(False, exclude=[first.host])
+      backend._checkin(first)
+      backend._checkin(second)
+      # both idle connections go stale and no new one can be opened
+      emulator.stop()
+      self.assertRaises(MogileFSError, backend.do_request, "get_domains")
+      # an idle connection the hedge never got to may be left, no more
+      self.assertEqual(sum(backend.pool.connection_counts().values()),
+                       backend.pool.idle_count())
+
+  def test_do_request_not_repeated(self):
+    # a tracker that answers the first command of every connection and
+    # drops the connection after reading the second
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    received = []
+    def serve():
+      while True:
+        try:
+          sock, _ = server.accept()
+        except socket.error:
+          return
+        rfile = sock.makefile('rb')
+        received.append(rfile.readline().split()[0])
+        sock.sendall('OK \r\n')
+        line = rfile.readline()
+        if line:
+          received.append(line.split()[0])
+        rfile.close()
+        sock.close()
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    try:
+      backend = Backend(['127.0.0.1:%d' % server.getsockname()[1]])
+      backend.do_request("get_domains")
+      self.assertRaises(MogileFSError, backend.do_request, "delete",
+                        {'domain': 'd', 'key': 'k'})
+      self.assertEqual(received, ['get_domains', 'delete'])
+      del received[:]
+      backend.do_request("get_domains")
+      self.assertRaises(MogileFSError, backend.do_pipeline,
+                        [("delete", {'domain': 'd', 'key': 'k'})])
+      self.assertEqual(received, ['get_domains', 'delete'])
+      # read-only commands are safe to send again
+      del received[:]
+      backend.do_request("get_domains")
+      assert backend.do_request("get_domains") is not None
+      self.assertEqual(received, ['get_domains'] * 3)
+    finally:
+      server.close()
+
+  def test_do_request_hedged_deadline(self):
+    # trackers that accept connections and never answer
+    servers = [socket.socket(), socket.socket()]
+    for server in servers:
+      server.bind(('127.0.0.1', 0))
+      server.listen(5)
+    try:
+      backend = Backend(['127.0.0.1:%d' % s.getsockname()[1]
+                         for s in servers], hedge=True, hedge_delay=0)
+      self.assertRaises(DeadlineExceeded, backend.do_request, "get_domains",
+                        deadline=0.2)
+      # running out of the caller's budget is not the trackers' fault
+      for stats in backend.tracker_stats().values():
+        self.assertEqual(stats.failures, 0)
+    finally:
+      for server in servers:
+        server.close()
+
+  def test_float_timeout(self):
+    self.assertEqual(Backend(['127.0.0.1:7001'], timeout=0.25)._timeout, 0.25)
+    self.assertRaises(ValueError, Backend, ['127.0.0.1:7001'], timeout='x')
+    self.assertRaises(ValueError, Backend, ['127.0.0.1:7001'], timeout=0)
+
+  def test_deadline(self):
+    deadline = Deadline(10)
+    self.assertEqual(deadline.timeout(0.5), 0.5)
+    assert 9 < deadline.timeout() <= 10
+    assert Deadline.coerce(deadline) is deadline
+    self.assertEqual(Deadline.coerce(None), None)
+    self.assertRaises(DeadlineExceeded, Deadline(-1).timeout, 3)
+
+  def test_do_request_deadline_exceeded(self):
+    try:
+      self.backend.do_request("get_domains", deadline=Deadline(-1))
+    except DeadlineExceeded, e:
+      self.assertEqual(e.err, 'deadline_exceeded')
+    else:
+      assert False
+
+  def test_connect_races_dead_trackers(self):
+    backend = Backend(["127.0.0.1:7011", "127.0.0.1:7012", "127.0.0.1:7001"])
+    # rank the dead trackers first
+    backend._record_success(("127.0.0.1", 7011), 0.0001)
+    backend._record_success(("127.0.0.1", 7012), 0.0001)
+    backend._record_success(("127.0.0.1", 7001), 0.01)
+    assert backend.do_request("get_domains")
+    self.assertEqual(backend.last_host_connected, ("127.0.0.1", 7001))
+    self.assertEqual(backend.tracker_stats()[("127.0.0.1", 7011)].failures, 1)
+    self.assertEqual(backend.pool.connection_counts(),
+                     {("127.0.0.1", 7001): 1})
+
+  def test_singleflight(self):
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    def slow():
+      calls.append(1)
+      started.set()
+      release.wait()
+      return {'paths': '1'}
+    results = []
+    def worker():
+      results.append(flight.do('key', None, slow))
+    threads = [threading.Thread(target=worker) for _ in xrange(5)]
+    threads[0].start()
+    started.wait()
+    for t in threads[1:]:
+      t.start()
+    while flight.collapsed < 4:
+      release.wait(0.01)
+    release.set()
+    for t in threads:
+      t.join()
+    self.assertEqual(len(calls), 1)
+    self.assertEqual(results, [{'paths': '1'}] * 5)
+    self.assertEqual(flight.stats(),
+                     {'executed': 1, 'collapsed': 4, 'in_flight': 0})
+
+  def test_do_request_coalesced(self):
+    backend = Backend(['127.0.0.1:7001'], coalesce=True)
+    results = []
+    def worker():
+      results.append(backend.do_request("get_domains"))
+    threads = [threading.Thread(target=worker) for _ in xrange(10)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertEqual(len(results), 10)
+    stats = backend.coalesce_stats()
+    self.assertEqual(stats['executed'] + stats['collapsed'], 10)
+
   def test_do_request_with_no_cmd(self):
     try:
       self.backend.do_request()   # pylint: disable-msg=E1120
@@ -2,9 +2,14 @@
 # pylint: disable-msg=W0311
 import time
 import random
+import tempfile
+import threading
 import unittest
 from cStringIO import StringIO
 from pymogile import Client, Admin, MogileFSError
+from pymogile.cache import LRUCache
+from pymogile.emulator import Emulator
+from pymogile.httppool import ConnectionPool
 
 TEST_NS = "mogilefs.client::test_client"
 HOSTS   = ["127.0.0.1:7001"]
@@ -50,6 +55,79 @@ class TestClient(unittest.TestCase):
         mogc.delete(k)
       self.moga.delete_domain(domain)
 
+  def test_iter_keys(self):
+    domain = "test:iter_keys:%s:%s:%s" % (random.random(), time.time(), TEST_NS)
+    self.moga.create_domain(domain)
+    mogc = Client(domain, HOSTS)
+    keys = ['key/%03d' % x for x in xrange(25)]
+    for k in keys:
+      mogc.store_content(k, k)
+    mogc.store_content('other', 'other')
+
+    try:
+      events = []
+      mogc.add_backend_hook('do_request_start',
+                            lambda *args: events.append(args[0]))
+      self.assertEqual(list(mogc.iter_keys('key/', page_size=10)), keys)
+      # the short last page is followed by one answered with none_match
+      self.assertEqual(events, ['list_keys'] * 4)
+      self.assertEqual(list(mogc.iter_keys('key/', page_size=5)), keys)
+
+      # a tracker may return fewer keys than asked before the last page
+      list_keys_page = mogc._list_keys_page
+      def short_page(*args):
+        page = list_keys_page(*args)[0][:3]
+        return page, page and page[-1] or None
+      mogc._list_keys_page = short_page
+      self.assertEqual(list(mogc.iter_keys('key/', page_size=10)), keys)
+      self.assertEqual(list(mogc.iter_keys_parallel('key/', page_size=10)),
+                       keys)
+      del mogc._list_keys_page
+      self.assertEqual(list(mogc.iter_keys('key/', after='key/020')),
+                       keys[21:])
+      self.assertEqual(list(mogc.iter_keys('nothing/')), [])
+      self.assertEqual(mogc.keys(), keys + ['other'])
+
+      seen = []
+      self.assertEqual(mogc.foreach_key(seen.append, prefix='key/'), 25)
+      self.assertEqual(seen, keys)
+    finally:
+      for k in keys + ['other']:
+        mogc.delete(k)
+      self.moga.delete_domain(domain)
+
+  def test_iter_keys_parallel(self):
+    domain = "test:iter_keys:%s:%s:%s" % (random.random(), time.time(), TEST_NS)
+    self.moga.create_domain(domain)
+    mogc = Client(domain, HOSTS)
+    keys = ['k/%x' % x for x in xrange(0, 4096, 97)] + ['k/', 'k/8', 'k/\xff']
+    keys.sort()
+    for k in keys:
+      mogc.store_content(k, k)
+    mogc.store_content('other', 'other')
+
+    try:
+      self.assertEqual(list(mogc.iter_keys_parallel('k/', page_size=4)), keys)
+      self.assertEqual(
+        list(mogc.iter_keys_parallel('k/', partitions='48c', page_size=3)),
+        keys)
+      self.assertEqual(
+        sorted(mogc.iter_keys_parallel('k/', partitions=7, ordered=False)),
+        keys)
+      self.assertEqual(list(mogc.iter_keys_parallel(partitions=1)),
+                       keys + ['other'])
+      # stopping early leaves no thread behind
+      threads = threading.active_count()
+      it = mogc.iter_keys_parallel('k/', page_size=2)
+      self.assertEqual(it.next(), keys[0])
+      it.close()
+      time.sleep(0.3)
+      self.assertTrue(threading.active_count() <= threads)
+    finally:
+      for k in keys + ['other']:
+        mogc.delete(k)
+      self.moga.delete_domain(domain)
+
   def test_new_file(self):
     client = Client(TEST_NS, HOSTS)
 
@@ -200,6 +278,63 @@ class TestClient(unittest.TestCase):
     content = client.get_file_data(key)
     self.assertEqual(content, data)
 
+  def test_store_real_file(self):
+    client = Client(TEST_NS, HOSTS)
+    key = 'test_file_%s_%s' % (random.random(), time.time())
+    events = []
+    client.add_hook('http_request_finished', lambda *args: events.append(args))
+
+    data = ''.join(random.choice("0123456789") for _ in xrange(300000))
+    fp = tempfile.TemporaryFile()
+    fp.write('skipped' + data)
+    fp.seek(7)
+    self.assertEqual(client.store_file(key, fp), len(data))
+    self.assertEqual(client.get_file_data(key), data)
+    # one PUT of the whole file
+    self.assertEqual([e[2] for e in events if e[0] == 'PUT'], [len(data)])
+
+  def test_streaming_file(self):
+    client = Client(TEST_NS, HOSTS)
+    key = 'test_file_%s_%s' % (random.random(), time.time())
+    events = []
+    client.add_hook('http_request_start', lambda *args: events.append(args))
+
+    fp = client.new_file(key, streaming=True)
+    # the PUT is already on its way
+    self.assertEqual([e[0] for e in events], ['PUT'])
+    fp.buffer_size = 1000
+    data = ''.join(random.choice("0123456789") for _ in xrange(10000))
+    for x in xrange(0, len(data), 300):
+      fp.write(data[x:x + 300])
+    self.assertEqual(fp.tell(), len(data))
+    fp.close()
+    self.assertEqual(client.get_file_data(key), data)
+
+  def test_large_file_coalescing(self):
+    pool = ConnectionPool()
+    client = Client(TEST_NS, HOSTS, http_pool=pool)
+    key = 'test_file_%s_%s' % (random.random(), time.time())
+    events = []
+    client.add_hook('http_request_start', lambda *args: events.append(args))
+
+    fp = client.new_file(key, largefile=True, opts={'write_buffer': 1000})
+    del events[:]
+    data = ''.join(random.choice("0123456789") for _ in xrange(10000))
+    for x in xrange(0, len(data), 100):
+      fp.write(data[x:x + 100])
+    self.assertEqual(fp.tell(), len(data))
+    # ten PUTs of 1000 bytes over the same connection
+    self.assertEqual([e[0] for e in events], ['PUT'] * 10)
+    self.assertEqual(pool.stats()['connects'], 1)
+
+    fp.write('spam')
+    fp.seek(1)
+    fp.write('P')
+    fp.close()
+    self.assertEqual(len(events), 12)
+    self.assertEqual(client.get_file_data(key),
+                     data[:1] + 'P' + data[2:] + 'spam')
+
   def test_store_content(self): 
     client = Client(TEST_NS, HOSTS)
     key = 'test_file_%s_%s' % (random.random(), time.time())
@@ -232,6 +367,104 @@ class TestClient(unittest.TestCase):
     paths = client.get_paths(key)
     self.assertFalse(paths)
 
+  def test_delete_many(self):
+    client = Client(TEST_NS, HOSTS, path_cache=100)
+    prefix = 'test_file_%s_%s' % (random.random(), time.time())
+    keys = ['%s_%d' % (prefix, x) for x in xrange(20)]
+    for key in keys[:10]:
+      client.store_content(key, key)
+    client.get_paths(keys[0])
+
+    deleted, errors = client.delete_many(iter(keys), connections=3, batch=7)
+    self.assertEqual(deleted, keys[:10])
+    self.assertEqual(sorted(errors), keys[10:])
+    for key in keys[10:]:
+      self.assertEqual(errors[key].err, 'unknown_key')
+    self.assertRaises(MogileFSError, client.get_paths, keys[0])
+
+  def test_rename_many(self):
+    client = Client(TEST_NS, HOSTS)
+    prefix = 'test_file_%s_%s' % (random.random(), time.time())
+    for key in ('a', 'b', 'c'):
+      client.store_content(prefix + key, key)
+
+    pairs = [(prefix + 'a', prefix + 'x'), (prefix + 'b', prefix + 'c'),
+             (prefix + 'missing', prefix + 'y')]
+    renamed, errors = client.rename_many(pairs)
+    self.assertEqual(renamed, pairs[:1])
+    self.assertEqual(errors[pairs[1]].err, 'key_exists')
+    self.assertEqual(errors[pairs[2]].err, 'unknown_key')
+    self.assertEqual(client.get_file_data(prefix + 'x'), 'a')
+    client.delete_many([prefix + 'x', prefix + 'b', prefix + 'c'])
+
+  def test_many_readonly(self):
+    client = Client(TEST_NS, HOSTS)
+    prefix = 'test_file_%s_%s' % (random.random(), time.time())
+    client.store_content(prefix + 'a', 'a')
+    readonly = Client(TEST_NS, HOSTS, readonly=True)
+
+    deleted, errors = readonly.delete_many(iter([prefix + 'a']))
+    self.assertEqual(deleted, [])
+    self.assertEqual(errors[prefix + 'a'].err, 'readonly')
+    pairs = [(prefix + 'a', prefix + 'b')]
+    renamed, errors = readonly.rename_many(pairs)
+    self.assertEqual(renamed, [])
+    self.assertEqual(errors.keys(), pairs)
+    self.assertEqual(errors[pairs[0]].err, 'readonly')
+    self.assertEqual(client.get_file_data(prefix + 'a'), 'a')
+    client.delete(prefix + 'a')
+
+  def test_file_info_coalesced(self):
+    emulator = Emulator(nodes=2, trackers=1).start()
+    client = Client(TEST_NS, emulator.trackers, coalesce=True)
+    try:
+      Admin(emulator.trackers).create_domain(TEST_NS)
+      client.store_content('spam', 'eggs')
+      # slow enough for the lookups to share one request
+      emulator.tracker_servers[0].faults.latency = 0.05
+      results = []
+      errors = []
+      def worker():
+        try:
+          results.append(client.file_info('spam', devices=True))
+        except Exception, e:
+          errors.append(e)
+      threads = [threading.Thread(target=worker) for _ in xrange(16)]
+      for t in threads:
+        t.start()
+      for t in threads:
+        t.join()
+      self.assertEqual(errors, [])
+      self.assertEqual(len(results), 16)
+      for info in results:
+        self.assertEqual(info['length'], 4)
+        self.assertEqual(len(info['devids']), 2)
+      self.assertTrue(client.backend.coalesce_stats()['collapsed'] > 0)
+    finally:
+      client.backend.close()
+      emulator.stop()
+
+  def test_file_info_multi(self):
+    client = Client(TEST_NS, HOSTS)
+    prefix = 'test_file_%s_%s' % (random.random(), time.time())
+    keys = ['%s_%d' % (prefix, x) for x in xrange(5)]
+    for key in keys:
+      client.store_content(key, key)
+
+    infos, errors = client.file_info_multi(keys + ['missing'], devices=True)
+    self.assertEqual(errors.keys(), ['missing'])
+    self.assertEqual(errors['missing'].err, 'unknown_key')
+    for key in keys:
+      info = infos[key]
+      single = client.file_info(key, devices=True)
+      self.assertEqual(info.fid, int(single['fid']))
+      self.assertEqual((info.key, info.domain, info.cls), (key, TEST_NS, 'default'))
+      self.assertEqual(info.length, len(key))
+      self.assertEqual(info.devcount, single['devcount'])
+      self.assertEqual(info.devids, [int(d) for d in single['devids']])
+    self.assertEqual(client.file_info_multi(keys[:1])[0][keys[0]].devids, None)
+    client.delete_many(keys)
+
   def test_mkcol(self): 
     client = Client(TEST_NS, HOSTS)
     for x in xrange(0, 10):
@@ -258,6 +491,104 @@ class TestClient(unittest.TestCase):
 #
 #    assert cl.get_file_data(key) == "sPaM"
   
+  def test_hooks(self):
+    client = Client(TEST_NS, HOSTS)
+    key = 'test_file_%s_%s' % (random.random(), time.time())
+    events = []
+    client.add_backend_hook('do_request_finished',
+                            lambda *args: events.append(args))
+    client.add_hook('http_request_finished',
+                    lambda *args: events.append(args))
+    client.store_content(key, "SPAM")
+    client.get_file_data(key)
+
+    cmds = [e[0] for e in events]
+    self.assertEqual(cmds[:2], ['create_open', 'PUT'])
+    assert 'create_close' in cmds and 'GET' in cmds
+    for _, _, sent, received, elapsed, timestamp in events:
+      assert sent >= 0 and received >= 0 and elapsed >= 0 and timestamp
+
+    client.backend.remove_hook('do_request_finished')
+    client.remove_hook('http_request_finished')
+    self.assertEqual(client.backend._hooks, None)
+    self.assertEqual(client._hooks, None)
+
+  def test_lru_cache(self):
+    cache = LRUCache(2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    self.assertEqual(cache.get('a'), 1)
+    cache.set('c', 3)
+    # 'b' was the least recently used
+    self.assertEqual(cache.get('b'), None)
+    self.assertEqual(cache.get('c'), 3)
+    cache.set('d', 4, ttl=0.01)
+    time.sleep(0.02)
+    self.assertEqual(cache.get('d'), None)
+    cache.invalidate('c')
+    self.assertEqual(len(cache), 0)
+    stats = cache.stats()
+    self.assertEqual((stats['hits'], stats['misses'], stats['evictions'],
+                      stats['expirations']), (2, 2, 2, 1))
+
+  def test_path_cache(self):
+    client = Client(TEST_NS, HOSTS, path_cache=100)
+    other = Client(TEST_NS, HOSTS)
+    key = 'test_file_%s_%s' % (random.random(), time.time())
+    client.store_content(key, "SPAM")
+
+    paths = client.get_paths(key)
+    self.assertEqual(client.get_paths(key), paths)
+    self.assertEqual(client.get_paths(key, pathcount=1), paths[:1])
+    stats = client.path_cache_stats()
+    self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+
+    # replaced behind the client's back, the cached paths are gone now
+    other.store_content(key, "EGGS")
+    self.assertEqual(client.get_file_data(key), "EGGS")
+
+    # writes through the client drop the entry
+    client.store_content(key, "HAM")
+    self.assertEqual(client.get_file_data(key), "HAM")
+    client.rename(key, key + '.renamed')
+    self.assertRaises(MogileFSError, client.get_paths, key)
+    client.delete(key + '.renamed')
+    self.assertRaises(MogileFSError, client.get_paths, key + '.renamed')
+
+  def test_negative_cache(self):
+    client = Client(TEST_NS, HOSTS, negative_cache=100)
+    key = 'test_file_%s_%s' % (random.random(), time.time())
+    events = []
+    client.add_backend_hook('do_request_start',
+                            lambda *args: events.append(args[0]))
+
+    for _ in xrange(3):
+      self.assertRaises(MogileFSError, client.get_file_data, key)
+    self.assertEqual(events, ['get_paths'])
+    stats = client.negative_cache_stats()
+    self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+
+    # storing the key clears the entry
+    client.store_content(key, "SPAM")
+    self.assertEqual(client.get_file_data(key), "SPAM")
+
+  def test_get_paths_multi(self):
+    client = Client(TEST_NS, HOSTS, path_cache=100)
+    prefix = 'test_file_%s_%s' % (random.random(), time.time())
+    keys = ['%s_%d' % (prefix, x) for x in xrange(10)]
+    for key in keys[:5]:
+      client.store_content(key, key)
+    client.get_paths(keys[0])
+
+    found, errors = client.get_paths_multi(keys + keys[:2], connections=3)
+    self.assertEqual(sorted(found), keys[:5])
+    self.assertEqual(sorted(errors), keys[5:])
+    for key in keys[5:]:
+      self.assertEqual(errors[key].err, 'unknown_key')
+    for key in keys[:5]:
+      self.assertEqual(found[key], client.get_paths(key))
+    self.assertEqual(client.path_cache_stats()['hits'], 6)
+
   def test_file_like_object(self): 
     client = Client(TEST_NS, HOSTS)
     key = 'test_file_%s_%s' % (random.random(), time.time())
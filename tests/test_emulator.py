@@ -0,0 +1,182 @@
+#! coding: utf-8
+# pylint: disable-msg=W0311
+import time
+import cStringIO
+import httplib
+import unittest
+import urlparse
+from pymogile import Client, Admin, MogileFSError
+from pymogile.emulator import Emulator
+
+TEST_NS = "testdomain"
+
+
+class TestEmulator(unittest.TestCase):
+  def setUp(self):
+    self.emulator = Emulator(nodes=2, trackers=2, seed=1).start()
+    self.client = Client(TEST_NS, self.emulator.trackers)
+
+  def tearDown(self):
+    self.client.backend.close()
+    self.emulator.stop()
+
+  def get(self, url, headers=None):
+    url = urlparse.urlsplit(url)
+    conn = httplib.HTTPConnection(url.netloc)
+    conn.request('GET', url.path, headers=headers or {})
+    res = conn.getresponse()
+    return res.status, res.getheader('content-range'), res.read()
+
+  def test_store_and_read(self):
+    self.assertEqual(self.client.store_content('spam', 'eggs' * 100), 400)
+    self.assertEqual(self.client.get_file_data('spam'), 'eggs' * 100)
+    paths = self.client.get_paths('spam')
+    self.assertEqual(len(paths), 2)
+    self.assertNotEqual(urlparse.urlsplit(paths[0]).netloc,
+                        urlparse.urlsplit(paths[1]).netloc)
+    info = self.client.file_info('spam', devices=True)
+    self.assertEqual(info['length'], 400)
+    self.assertEqual(info['devcount'], 2)
+
+  def test_keys(self):
+    for key in ('a1', 'a2', 'b1'):
+      self.client.store_content(key, key)
+    self.assertEqual(self.client.list_keys(prefix='a'), ['a1', 'a2'])
+    self.assertEqual(self.client.list_keys(after='a1', limit=1), ['a2'])
+    self.assertTrue(self.client.rename('b1', 'a3'))
+    self.assertFalse(self.client.rename('b1', 'a4'))
+    self.assertTrue(self.client.delete('a1'))
+    self.assertFalse(self.client.delete('a1'))
+    self.assertEqual(self.client.list_keys(prefix='a'), ['a2', 'a3'])
+    self.assertRaises(MogileFSError, self.client.get_paths, 'a1')
+
+  def test_admin(self):
+    admin = Admin(self.emulator.trackers)
+    self.assertEqual(admin.create_domain('other'), True)
+    self.assertEqual(admin.create_class('other', 'big', 3), True)
+    self.assertEqual(admin.get_domains()['other'], {'default': 2, 'big': 3})
+    self.assertEqual(len(admin.get_devices()), 2)
+    self.assertEqual(len(admin.get_hosts()), 2)
+    admin.set_server_setting('memcache_servers', '127.0.0.1:11211')
+    self.assertEqual(admin.server_settings()['memcache_servers'],
+                     '127.0.0.1:11211')
+
+  def test_ranges(self):
+    self.client.store_content('digits', '0123456789')
+    url = self.client.get_paths('digits')[0]
+    self.assertEqual(self.get(url, {'Range': 'bytes=1-3'}),
+                     (206, 'bytes 1-3/10', '123'))
+    self.assertEqual(self.get(url, {'Range': 'bytes=-2'}),
+                     (206, 'bytes 8-9/10', '89'))
+    self.assertEqual(self.get(url, {'Range': 'bytes=20-'})[0], 416)
+    self.assertEqual(self.get(url)[0], 200)
+
+  def test_require_mkcol(self):
+    emulator = Emulator(nodes=1, require_mkcol=True).start()
+    try:
+      client = Client(TEST_NS, emulator.trackers)
+      fp = client.new_file('big', largefile=True)
+      fp.write('0123456789')
+      fp.close()
+      self.assertEqual(client.get_file_data('big'), '0123456789')
+    finally:
+      emulator.stop()
+
+  def node(self, url):
+    netloc = urlparse.urlsplit(url).netloc
+    return [n for n in self.emulator.nodes if n.address == netloc][0]
+
+  def test_streaming_failover(self):
+    fp = self.client.new_file('spam', streaming=True,
+                              opts={'spool_size': 100})
+    first = fp.path
+    # the first destination fails the PUT once it got the whole body
+    self.node(first).faults.fail_next(1)
+    fp.buffer_size = 10
+    for _ in xrange(50):
+      fp.write('eggs')
+    fp.close()
+    self.assertNotEqual(fp.path, first)
+    self.assertEqual(self.client.get_file_data('spam'), 'eggs' * 50)
+
+  def test_streaming_require_mkcol(self):
+    emulator = Emulator(nodes=1, require_mkcol=True).start()
+    try:
+      client = Client(TEST_NS, emulator.trackers)
+      fp = client.new_file('big', streaming=True)
+      fp.write('0123456789')
+      fp.close()
+      self.assertEqual(client.get_file_data('big'), '0123456789')
+    finally:
+      emulator.stop()
+
+  def test_streaming_node_lost(self):
+    emulator = Emulator(nodes=1).start()
+    try:
+      client = Client(TEST_NS, emulator.trackers)
+      fp = client.new_file('spam', streaming=True)
+      fp.buffer_size = 10
+      fp.write('eggs' * 10)
+      emulator.nodes[0].stop()
+      # a send may still go out before the node's end is noticed
+      error = None
+      for _ in xrange(100):
+        try:
+          fp.write('eggs' * 10)
+        except MogileFSError, e:
+          error = e
+          break
+      self.assertTrue(error is not None)
+      self.assertRaises(MogileFSError, fp.write, 'eggs')
+      self.assertRaises(MogileFSError, fp.close)
+      self.assertRaises(MogileFSError, fp.close)
+      # never committed
+      self.assertRaises(MogileFSError, client.get_paths, 'spam')
+    finally:
+      emulator.stop()
+
+  def test_spooled_failover(self):
+    fp = self.client.new_file('spam', opts={'spool_size': 100})
+    first = fp.paths()[0][1]
+    self.node(first).faults.fail_next(1)
+    for _ in xrange(50):
+      fp.write('eggs')
+    # past spool_size the buffer went to disk
+    self.assertTrue(fp._on_disk())
+    self.assertFalse(isinstance(fp._fp._file, cStringIO.OutputType))
+    fp.seek(0)
+    fp.write('ham!')
+    fp.close()
+    self.assertEqual(self.client.get_file_data('spam'),
+                     'ham!' + 'eggs' * 49)
+
+  def test_tracker_faults(self):
+    for tracker in self.emulator.tracker_servers:
+      tracker.faults.fail_next(1)
+    self.assertRaises(MogileFSError, self.client.get_paths, 'missing')
+    tracker = self.emulator.tracker_servers[0]
+    tracker.faults.latency = 0.1
+    client = Client(TEST_NS, self.emulator.trackers[:1], timeout=0.05)
+    self.assertRaises(MogileFSError, client.list_keys)
+    self.assertTrue(tracker.faults.injected >= 1)
+
+  def test_storage_faults(self):
+    self.client.store_content('spam', 'eggs')
+    faults = self.emulator.nodes[0].faults
+    faults.fail_next(5, 'drop')
+    # whenever the first replica drops the connection the second answers
+    for _ in xrange(5):
+      self.assertEqual(self.client.get_file_data('spam'), 'eggs')
+    self.assertTrue(faults.injected >= 1)
+
+  def test_bandwidth(self):
+    self.client.store_content('spam', 'x' * 20000)
+    for node in self.emulator.nodes:
+      node.faults.bandwidth = 100000
+    start = time.time()
+    self.assertEqual(len(self.client.get_file_data('spam')), 20000)
+    self.assertTrue(time.time() - start >= 0.15)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,86 @@
+#! coding: utf-8
+# pylint: disable-msg=W0311
+import socket
+import unittest
+from pymogile import Client
+from pymogile.emulator import Emulator
+from pymogile.httppool import ConnectionPool
+
+TEST_NS = "testdomain"
+
+
+class TestConnectionPool(unittest.TestCase):
+  def setUp(self):
+    self.emulator = Emulator(nodes=1, trackers=1).start()
+    self.node = self.emulator.nodes[0]
+    self.pool = ConnectionPool()
+    self.client = Client(TEST_NS, self.emulator.trackers,
+                         http_pool=self.pool)
+
+  def tearDown(self):
+    self.client.backend.close()
+    self.pool.clear()
+    self.emulator.stop()
+
+  def test_reuse(self):
+    self.client.store_content('spam', 'eggs')
+    for _ in xrange(5):
+      self.assertEqual(self.client.get_file_data('spam'), 'eggs')
+    stats = self.pool.stats()
+    self.assertEqual(stats['connects'], 1)
+    # a HEAD and a GET for every read
+    self.assertEqual(stats['reuses'], 10)
+    self.assertEqual(stats['idle'], 1)
+
+  def test_put_released(self):
+    emulator = Emulator(nodes=1, require_mkcol=True).start()
+    client = Client(TEST_NS, emulator.trackers, http_pool=self.pool)
+    try:
+      # every PUT is refused with a body, read before the next PUT
+      for _ in xrange(3):
+        fp = client.new_file('spam')
+        fp.write('eggs')
+        fp.close()
+      stats = self.pool.stats()
+      self.assertEqual(stats['connects'], 1)
+      self.assertEqual(stats['idle'], 1)
+    finally:
+      client.backend.close()
+      emulator.stop()
+
+  def test_stale_retry(self):
+    self.client.store_content('spam', 'eggs')
+    # the node drops the kept-alive connection without an answer
+    self.node.faults.fail_next(1, 'drop')
+    self.assertEqual(self.client.get_file_data('spam'), 'eggs')
+    stats = self.pool.stats()
+    self.assertEqual(stats['retries'], 1)
+    self.assertEqual(stats['connects'], 2)
+
+  def test_closed_by_node(self):
+    self.client.store_content('spam', 'eggs')
+    with self.node._conns_lock:
+      for sock in self.node._conns:
+        sock.shutdown(socket.SHUT_RDWR)
+    # noticed before the request is sent, so nothing to retry
+    self.assertEqual(self.client.get_file_data('spam'), 'eggs')
+    stats = self.pool.stats()
+    self.assertEqual(stats['retries'], 0)
+    self.assertEqual(stats['connects'], 2)
+
+  def test_limits(self):
+    address = self.node.address
+    pool = ConnectionPool(max_idle_per_host=1)
+    first, _ = pool.get('http', address)
+    second, _ = pool.get('http', address)
+    pool.put(first)
+    pool.put(second)
+    self.assertEqual(pool.stats()['idle'], 1)
+    self.assertTrue(first.sock is None)
+    self.assertTrue(pool.get('http', address) == (second, True))
+
+    pool = ConnectionPool(idle_timeout=0)
+    conn, _ = pool.get('http', address)
+    pool.put(conn)
+    self.assertEqual(pool.get('http', address)[1], False)
+    self.assertRaises(ValueError, pool.get, 'ftp', address)